@@ -0,0 +1,48 @@
+"""
+Admin endpoints: profiling captures
+"""
+from typing import Optional
+from fastapi import APIRouter, Depends, Header, HTTPException, Query, Request
+from fastapi.concurrency import run_in_threadpool
+from fastapi.responses import FileResponse, HTMLResponse, PlainTextResponse
+from app.profiling import check_admin_token, list_captures, capture_path, render_capture
+from app.config import PROFILING_ENABLED, PROFILE_SAMPLE_RATE, PROFILE_MAX_CAPTURES, ADMIN_TOKEN, ADMIN_ALLOW_LOOPBACK
+
+def require_admin(request: Request, x_admin_token: Optional[str] = Header(None)):
+    """Reject requests without the admin token; with none configured, reject all (but loopback clients if allowed)"""
+    if check_admin_token(x_admin_token, request.client.host if request.client else None):
+        return
+    if not ADMIN_TOKEN:
+        if ADMIN_ALLOW_LOOPBACK:
+            raise HTTPException(status_code=403, detail="Admin endpoints are only served to local clients unless ADMIN_TOKEN is set")
+        raise HTTPException(status_code=403, detail="Admin endpoints are disabled: set ADMIN_TOKEN")
+    raise HTTPException(status_code=401, detail="Missing or invalid X-Admin-Token")
+
+admin_router = APIRouter(dependencies=[Depends(require_admin)])
+
+@admin_router.get("/profiles")
+async def list_profiles():
+    """Stored profiling captures, newest first"""
+    return {
+        "enabled": PROFILING_ENABLED,
+        "sample_rate": PROFILE_SAMPLE_RATE,
+        "max_captures": PROFILE_MAX_CAPTURES,
+        "profiles": await run_in_threadpool(list_captures)
+    }
+
+@admin_router.get("/profiles/{profile_id}")
+async def download_profile(profile_id: str, format: str = Query("html", pattern="^(html|text|session)$")):
+    """
+    Download a capture as an interactive HTML page, a text call tree, or the raw
+    session (view it with `pyinstrument --load <file>`)
+    """
+    if format == "session":
+        path = capture_path(profile_id)
+        if path is None:
+            raise HTTPException(status_code=404, detail="Profile not found")
+        return FileResponse(path, media_type="application/json", filename=f"{profile_id}.pyisession")
+    
+    rendered = await run_in_threadpool(render_capture, profile_id, format)
+    if rendered is None:
+        raise HTTPException(status_code=404, detail="Profile not found")
+    return HTMLResponse(rendered) if format == "html" else PlainTextResponse(rendered)
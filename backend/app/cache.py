@@ -0,0 +1,374 @@
+"""
+Caches used on the ingestion and retrieval paths
+"""
+import hashlib
+import os
+import sqlite3
+import threading
+import time
+import unicodedata
+from array import array
+from collections import OrderedDict
+from typing import Dict, List, Optional
+import numpy as np
+
+from app.config import (
+    EMBEDDING_CACHE_PATH,
+    EMBEDDING_CACHE_MAX_ENTRIES,
+    EMBEDDING_CACHE_ENABLED,
+    QUERY_CACHE_TTL_SECONDS,
+    QUERY_CACHE_MAX_ENTRIES,
+    ANSWER_CACHE_THRESHOLD,
+    ANSWER_CACHE_MAX_ENTRIES,
+    ANSWER_CACHE_TTL_SECONDS
+)
+from app.metrics import CACHE_LOOKUPS, count_cache
+
+
+def embedding_cache_key(text: str, model: str) -> str:
+    """Content address of an embedding: hash of the model name and chunk text"""
+    digest = hashlib.sha256()
+    digest.update(model.encode("utf-8"))
+    digest.update(b"\x00")
+    digest.update(text.encode("utf-8"))
+    return digest.hexdigest()
+
+
+class EmbeddingCache:
+    """
+    On-disk embedding cache with size-bounded LRU eviction.
+
+    Entries are keyed by embedding_cache_key() so identical chunk text embedded
+    with the same model is only ever sent to the embedding API once. The file is
+    shared by all workers, so the entry count lives in a meta row that every
+    write updates in its own transaction.
+    """
+
+    def __init__(self, path: str, max_entries: int):
+        self.path = path
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._lock = threading.Lock()
+
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+
+        self._conn = sqlite3.connect(path, check_same_thread=False, timeout=30)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute(
+            """CREATE TABLE IF NOT EXISTS embeddings (
+                key TEXT PRIMARY KEY,
+                vector BLOB NOT NULL,
+                last_used REAL NOT NULL
+            )"""
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS idx_embeddings_last_used ON embeddings(last_used)")
+        self._conn.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value INTEGER NOT NULL)")
+        self._conn.commit()
+        # Caches created before the count was kept are counted once
+        self._conn.execute("BEGIN IMMEDIATE")
+        self._conn.execute(
+            "INSERT OR IGNORE INTO meta (key, value) SELECT 'entries', COUNT(*) FROM embeddings"
+        )
+        self._conn.commit()
+
+    def _size(self) -> int:
+        return self._conn.execute("SELECT value FROM meta WHERE key = 'entries'").fetchone()[0]
+
+    def _add_to_size(self, delta: int) -> None:
+        if delta:
+            self._conn.execute("UPDATE meta SET value = value + ? WHERE key = 'entries'", (delta,))
+
+    def get_many(self, keys: List[str]) -> Dict[str, List[float]]:
+        """Look up several keys at once, returning only the ones that are cached"""
+        found: Dict[str, List[float]] = {}
+        unique_keys = list(dict.fromkeys(keys))
+        with self._lock:
+            # Stay well below SQLite's bound-parameter limit
+            for start in range(0, len(unique_keys), 500):
+                batch = unique_keys[start:start + 500]
+                placeholders = ",".join("?" * len(batch))
+                rows = self._conn.execute(
+                    f"SELECT key, vector FROM embeddings WHERE key IN ({placeholders})", batch
+                ).fetchall()
+                for key, blob in rows:
+                    found[key] = array("d", blob).tolist()
+
+            if found:
+                now = time.time()
+                self._conn.executemany(
+                    "UPDATE embeddings SET last_used = ? WHERE key = ?",
+                    [(now, key) for key in found]
+                )
+                self._conn.commit()
+
+            hits = sum(1 for key in keys if key in found)
+            self.hits += hits
+            self.misses += len(keys) - hits
+        count_cache("embedding", hits, len(keys) - hits)
+        return found
+
+    def put_many(self, items: Dict[str, List[float]]) -> None:
+        """Store embeddings and evict the least recently used entries beyond the size bound"""
+        if not items:
+            return
+        now = time.time()
+        with self._lock:
+            # Take the write lock up front so the count read below includes every worker's inserts
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                before = self._conn.total_changes
+                self._conn.executemany(
+                    "INSERT OR IGNORE INTO embeddings (key, vector, last_used) VALUES (?, ?, ?)",
+                    [(key, array("d", vector).tobytes(), now) for key, vector in items.items()]
+                )
+                self._add_to_size(self._conn.total_changes - before)
+
+                overflow = self._size() - self.max_entries
+                if overflow > 0:
+                    before = self._conn.total_changes
+                    self._conn.execute(
+                        "DELETE FROM embeddings WHERE key IN "
+                        "(SELECT key FROM embeddings ORDER BY last_used ASC LIMIT ?)",
+                        (overflow,)
+                    )
+                    evicted = self._conn.total_changes - before
+                    self._add_to_size(-evicted)
+                    self.evictions += evicted
+                self._conn.commit()
+            except Exception:
+                self._conn.rollback()
+                raise
+
+    def stats(self) -> Dict:
+        """Hit/miss counters and current size"""
+        lookups = self.hits + self.misses
+        with self._lock:
+            entries = self._size()
+        return {
+            "entries": entries,
+            "max_entries": self.max_entries,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "hit_rate": self.hits / lookups if lookups else 0.0
+        }
+
+    def clear(self) -> None:
+        """Drop every cached embedding"""
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            self._conn.execute("DELETE FROM embeddings")
+            self._conn.execute("UPDATE meta SET value = 0 WHERE key = 'entries'")
+            self._conn.commit()
+
+
+_embedding_cache: Optional[EmbeddingCache] = None
+_embedding_cache_lock = threading.Lock()
+
+
+def get_embedding_cache() -> Optional[EmbeddingCache]:
+    """Get the process-wide embedding cache, or None if it is disabled"""
+    global _embedding_cache
+    if not EMBEDDING_CACHE_ENABLED:
+        return None
+    if _embedding_cache is None:
+        with _embedding_cache_lock:
+            if _embedding_cache is None:
+                _embedding_cache = EmbeddingCache(EMBEDDING_CACHE_PATH, EMBEDDING_CACHE_MAX_ENTRIES)
+    return _embedding_cache
+
+
+def normalize_query(query: str) -> str:
+    """Normalize a query so trivially different spellings share a cache entry"""
+    return " ".join(unicodedata.normalize("NFKC", query).casefold().split())
+
+
+class QueryEmbeddingCache:
+    """
+    In-process LRU cache of query embeddings with a TTL and a max-entry bound.
+    """
+
+    def __init__(self, max_entries: int, ttl_seconds: float):
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries: "OrderedDict[str, tuple]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, query: str) -> Optional[List[float]]:
+        """Return the cached embedding for a query, or None if missing or expired"""
+        key = normalize_query(query)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and time.monotonic() - entry[1] > self.ttl_seconds:
+                del self._entries[key]
+                entry = None
+            if entry is None:
+                self.misses += 1
+                count_cache("query_embedding", 0, 1)
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            count_cache("query_embedding", 1, 0)
+            return entry[0]
+
+    def put(self, query: str, embedding: List[float]) -> None:
+        """Cache a query embedding, evicting the least recently used entries if full"""
+        key = normalize_query(query)
+        with self._lock:
+            self._entries[key] = (embedding, time.monotonic())
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def stats(self) -> Dict:
+        """Hit/miss counters and current size"""
+        lookups = self.hits + self.misses
+        return {
+            "entries": len(self._entries),
+            "max_entries": self.max_entries,
+            "ttl_seconds": self.ttl_seconds,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "hit_rate": self.hits / lookups if lookups else 0.0
+        }
+
+    def clear(self) -> int:
+        """Drop every cached query embedding and return how many were dropped"""
+        with self._lock:
+            count = len(self._entries)
+            self._entries.clear()
+            return count
+
+
+query_embedding_cache = QueryEmbeddingCache(QUERY_CACHE_MAX_ENTRIES, QUERY_CACHE_TTL_SECONDS)
+
+
+class SemanticAnswerCache:
+    """
+    In-process cache of chat answers looked up by query-embedding similarity.
+
+    A question whose embedding has cosine similarity of at least `threshold` with a
+    cached one gets the cached answer. Every entry records the corpus version it was
+    answered against and is only served while that version is current, so an upload,
+    update or delete invalidates everything answered before it.
+    """
+
+    def __init__(self, threshold: float, max_entries: int, ttl_seconds: float):
+        self.threshold = threshold
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self.hits = 0
+        self.misses = 0
+        self.bypassed = 0
+        self.evictions = 0
+        self.invalidations = 0
+        self._entries: "OrderedDict[int, Dict]" = OrderedDict()
+        self._next_id = 0
+        self._matrix: Optional[np.ndarray] = None
+        self._matrix_ids: List[int] = []
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _normalize(embedding: List[float]) -> np.ndarray:
+        vector = np.asarray(embedding, dtype=np.float32)
+        return vector / max(float(np.linalg.norm(vector)), 1e-12)
+
+    def _drop_stale(self, corpus_version: int) -> None:
+        """
+        Drop expired entries and ones answered against an older corpus version. Entries of a
+        newer version are kept: a request that read the version just before an upload
+        mustn't wipe the answers already cached for the new corpus
+        """
+        now = time.monotonic()
+        stale = [
+            entry_id for entry_id, entry in self._entries.items()
+            if entry["corpus_version"] < corpus_version or now - entry["created"] > self.ttl_seconds
+        ]
+        for entry_id in stale:
+            del self._entries[entry_id]
+        if stale:
+            self.invalidations += len(stale)
+            self._matrix = None
+
+    def get(self, embedding: List[float], use_context: bool, corpus_version: int) -> Optional[Dict]:
+        """Cached answer for a similar question asked against the same corpus version, or None"""
+        query = self._normalize(embedding)
+        with self._lock:
+            self._drop_stale(corpus_version)
+            if self._entries and self._matrix is None:
+                self._matrix_ids = list(self._entries)
+                self._matrix = np.stack([self._entries[entry_id]["embedding"] for entry_id in self._matrix_ids])
+
+            if self._entries and self._matrix.shape[1] == query.shape[0]:
+                similarities = self._matrix @ query
+                for position in np.argsort(-similarities):
+                    if similarities[position] < self.threshold:
+                        break
+                    entry_id = self._matrix_ids[position]
+                    entry = self._entries[entry_id]
+                    if entry["use_context"] == use_context and entry["corpus_version"] == corpus_version:
+                        self._entries.move_to_end(entry_id)
+                        self.hits += 1
+                        count_cache("answer", 1, 0)
+                        return {**entry["answer"], "similarity": float(similarities[position])}
+            self.misses += 1
+            count_cache("answer", 0, 1)
+            return None
+
+    def put(self, embedding: List[float], use_context: bool, corpus_version: int, answer: Dict) -> None:
+        """Cache an answer, evicting the least recently used entries if full"""
+        with self._lock:
+            self._entries[self._next_id] = {
+                "embedding": self._normalize(embedding),
+                "use_context": use_context,
+                "corpus_version": corpus_version,
+                "created": time.monotonic(),
+                "answer": answer
+            }
+            self._next_id += 1
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+            self._matrix = None
+
+    def count_bypass(self) -> None:
+        with self._lock:
+            self.bypassed += 1
+        CACHE_LOOKUPS.labels("answer", "bypass").inc()
+
+    def stats(self) -> Dict:
+        """Hit/miss counters and current size"""
+        lookups = self.hits + self.misses
+        return {
+            "entries": len(self._entries),
+            "max_entries": self.max_entries,
+            "threshold": self.threshold,
+            "ttl_seconds": self.ttl_seconds,
+            "hits": self.hits,
+            "misses": self.misses,
+            "bypassed": self.bypassed,
+            "evictions": self.evictions,
+            "invalidations": self.invalidations,
+            "hit_rate": self.hits / lookups if lookups else 0.0
+        }
+
+    def clear(self) -> int:
+        """Drop every cached answer and return how many were dropped"""
+        with self._lock:
+            count = len(self._entries)
+            self._entries.clear()
+            self._matrix = None
+            return count
+
+
+answer_cache = SemanticAnswerCache(ANSWER_CACHE_THRESHOLD, ANSWER_CACHE_MAX_ENTRIES, ANSWER_CACHE_TTL_SECONDS)
@@ -1,39 +1,43 @@
 """
 Chat endpoints with multi-turn conversation support
 """
-from fastapi import APIRouter, HTTPException
+import json
+from fastapi import APIRouter, Depends, HTTPException
+from fastapi.responses import StreamingResponse
 from pydantic import BaseModel
-from typing import List, Optional, Dict, Any
+from typing import List, Optional, Dict, Any, Tuple
 from app.llm import get_llm
-from app.vector_store import search_similar_documents
-from langchain.chains import ConversationalRetrievalChain
-from langchain.memory import ConversationBufferMemory
-from langchain.prompts import PromptTemplate
+from app.vector_store import aretrieve_context, aembed_query_cached, get_corpus_version
+from app.cache import query_embedding_cache, answer_cache
+from app.database import run_db
+from app.conversations import get_conversation_store
+from app.prompt_packer import pack_prompt, schedule_summary_refresh
+from app.config import ANSWER_CACHE_ENABLED, PROMPT_HISTORY_MESSAGES
+from app.metrics import StageTimer, timed_operation, stage, count_error, LLM_IN_FLIGHT, TOKENS
+from app.tokens import count_tokens
+from app.warmup import require_ready
 
 chat_router = APIRouter()
 
-# Store conversation histories (in production, use Redis or database)
-conversation_memories: Dict[str, ConversationBufferMemory] = {}
-
 class ChatMessage(BaseModel):
     message: str
     conversation_id: Optional[str] = "default"
     use_context: bool = True
+    # Skip the semantic answer cache and always ask the model (the fresh answer is still cached)
+    bypass_cache: bool = False
 
 class ChatResponse(BaseModel):
     response: str
     citations: List[Dict[str, Any]]
     conversation_id: str
+    cached: bool = False
+    # Token counts of the prompt (None for cached answers)
+    prompt_usage: Optional[Dict[str, Any]] = None
 
-def get_conversation_memory(conversation_id: str) -> ConversationBufferMemory:
-    """Get or create conversation memory"""
-    if conversation_id not in conversation_memories:
-        conversation_memories[conversation_id] = ConversationBufferMemory(
-            memory_key="chat_history",
-            return_messages=True,
-            output_key="answer"
-        )
-    return conversation_memories[conversation_id]
+async def get_history(conversation_id: str) -> Tuple[Optional[str], List[Dict]]:
+    """Rolling summary and recent messages of a conversation, oldest first"""
+    with stage("history"):
+        return await run_db(get_conversation_store().get_history, conversation_id, PROMPT_HISTORY_MESSAGES)
 
 def format_citations(search_results: List[Dict]) -> List[Dict]:
     """Format search results as citations"""
@@ -45,6 +49,7 @@ def format_citations(search_results: List[Dict]) -> List[Dict]:
         if source not in seen_sources:
             citations.append({
                 "source": source,
+                "page": result.get("metadata", {}).get("page"),
                 "content": result.get("document", "")[:200] + "...",  # Truncate for display
                 "relevance_score": 1 - result.get("distance", 1.0) if result.get("distance") else None
             })
@@ -52,37 +57,7 @@ def format_citations(search_results: List[Dict]) -> List[Dict]:
     
     return citations
 
-@chat_router.post("/", response_model=ChatResponse)
-async def chat(message: ChatMessage):
-    """
-    Chat endpoint with multi-turn conversation support and citations
-    """
-    try:
-        llm = get_llm()
-        memory = get_conversation_memory(message.conversation_id)
-        
-        # If use_context is True, search for relevant documents
-        context = ""
-        citations = []
-        
-        if message.use_context:
-            # Search for relevant documents
-            search_results = search_similar_documents(message.message, n_results=5)
-            
-            if search_results:
-                # Build context from search results
-                context_parts = []
-                for i, result in enumerate(search_results, 1):
-                    doc_text = result.get("document", "")
-                    source = result.get("metadata", {}).get("filename", "Unknown")
-                    context_parts.append(f"[Source {i}: {source}]\n{doc_text}\n")
-                
-                context = "\n\n".join(context_parts)
-                citations = format_citations(search_results)
-        
-        # Create prompt template
-        if context:
-            prompt_template = """You are a helpful AI assistant. Use the following context to answer the question. 
+CONTEXT_PROMPT = """You are a helpful AI assistant. Use the following context to answer the question. 
 Always cite your sources when using information from the context.
 
 Context:
@@ -94,8 +69,8 @@ Chat History:
 Question: {question}
 
 Answer:"""
-        else:
-            prompt_template = """You are a helpful AI assistant. Answer the question based on your knowledge.
+
+NO_CONTEXT_PROMPT = """You are a helpful AI assistant. Answer the question based on your knowledge.
 
 Chat History:
 {chat_history}
@@ -103,63 +78,242 @@ Chat History:
 Question: {question}
 
 Answer:"""
-        
-        prompt = PromptTemplate(
-            template=prompt_template,
-            input_variables=["context", "chat_history", "question"]
-        )
-        
-        # Get chat history
-        chat_history = memory.chat_memory.messages if hasattr(memory, 'chat_memory') else []
-        chat_history_str = "\n".join([
-            f"{'Human' if i % 2 == 0 else 'Assistant'}: {msg.content if hasattr(msg, 'content') else str(msg)}"
-            for i, msg in enumerate(chat_history[-6:])  # Last 3 exchanges
+
+async def build_prompt(message: ChatMessage, summary: Optional[str], history: List[Dict]):
+    """
+    Retrieve context for a message and pack the full prompt into the token budget.
+    Returns (prompt, citations, prompt token counts)
+    """
+    search_results = []
+    if message.use_context:
+        # Search for relevant documents (diversified, with neighbouring chunks merged)
+        with stage("retrieve"):
+            search_results = await aretrieve_context(message.message, n_results=5)
+    
+    template = CONTEXT_PROMPT if search_results else NO_CONTEXT_PROMPT
+    with stage("prompt"):
+        full_prompt, included, usage = pack_prompt(template, message.message, search_results, summary, history)
+    TOKENS.labels("prompt").inc(usage["prompt_tokens"])
+    # Only cite what made it into the prompt
+    return full_prompt, format_citations(included), usage
+
+async def lookup_cached_answer(message: ChatMessage, summary: Optional[str], history: List[Dict]) -> Tuple[Optional[Dict], Optional[Tuple]]:
+    """
+    Look a message up in the semantic answer cache. Only first turns are cached, since
+    later answers depend on the conversation. Returns the cached answer (or None) and
+    the key to cache a fresh answer under (None if the cache doesn't apply)
+    """
+    if not ANSWER_CACHE_ENABLED or summary or history:
+        return None, None
+    
+    with stage("answer_cache"):
+        # Read the version before retrieval, so an answer racing a corpus change is never served later
+        corpus_version = await run_db(get_corpus_version)
+        embedding = await aembed_query_cached(message.message)
+        key = (embedding, message.use_context, corpus_version)
+        if message.bypass_cache:
+            answer_cache.count_bypass()
+            return None, key
+        return answer_cache.get(*key), key
+
+async def save_exchange(conversation_id: str, user_message: str, response_text: str):
+    """Save a question/answer pair to the conversation store"""
+    with stage("history"):
+        await run_db(get_conversation_store().append, conversation_id, [
+            {"role": "user", "content": user_message},
+            {"role": "assistant", "content": response_text}
         ])
-        
-        # Generate response
-        if context:
-            full_prompt = prompt.format(
-                context=context,
-                chat_history=chat_history_str,
-                question=message.message
-            )
-        else:
-            full_prompt = prompt.format(
-                context="",
-                chat_history=chat_history_str,
-                question=message.message
+    schedule_summary_refresh(conversation_id)
+
+def format_sse(event: str, data: Dict[str, Any]) -> str:
+    """Format a server-sent event"""
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+@chat_router.post("/", response_model=ChatResponse, dependencies=[Depends(require_ready)])
+async def chat(message: ChatMessage):
+    """
+    Chat endpoint with multi-turn conversation support and citations
+    """
+    with timed_operation("chat"):
+        try:
+            llm = get_llm()
+            summary, history = await get_history(message.conversation_id)
+            
+            # Repeated first questions are answered from the semantic answer cache
+            cached, cache_key = await lookup_cached_answer(message, summary, history)
+            if cached:
+                await save_exchange(message.conversation_id, message.message, cached["response"])
+                return ChatResponse(
+                    response=cached["response"],
+                    citations=cached["citations"],
+                    conversation_id=message.conversation_id,
+                    cached=True
+                )
+            
+            full_prompt, citations, usage = await build_prompt(message, summary, history)
+            
+            # Generate response
+            with stage("llm"), LLM_IN_FLIGHT.track_inprogress():
+                response = await llm.ainvoke(full_prompt)
+            response_text = response.content if hasattr(response, 'content') else str(response)
+            TOKENS.labels("completion").inc(count_tokens(response_text))
+            
+            # Save to conversation history
+            await save_exchange(message.conversation_id, message.message, response_text)
+            if cache_key:
+                answer_cache.put(*cache_key, {"response": response_text, "citations": citations})
+            
+            return ChatResponse(
+                response=response_text,
+                citations=citations,
+                conversation_id=message.conversation_id,
+                prompt_usage=usage
             )
-        
-        response = llm.invoke(full_prompt)
-        response_text = response.content if hasattr(response, 'content') else str(response)
-        
-        # Save to memory
-        memory.chat_memory.add_user_message(message.message)
-        memory.chat_memory.add_ai_message(response_text)
-        
-        return ChatResponse(
-            response=response_text,
-            citations=citations,
-            conversation_id=message.conversation_id
-        )
-        
+            
+        except Exception as e:
+            count_error("chat", e)
+            raise HTTPException(status_code=500, detail=f"Error processing chat: {str(e)}")
+
+@chat_router.post("/stream", dependencies=[Depends(require_ready)])
+async def chat_stream(message: ChatMessage):
+    """
+    Streaming chat endpoint (server-sent events).
+    Emits a `citations` event first, then one `token` event per generated token,
+    and finally a `done` event with the full response (or an `error` event).
+    A cached answer arrives as a single `token` event and `done` has `cached: true`.
+    """
+    # The timer runs until the stream ends, so it is handed to the generators explicitly
+    timer = StageTimer("chat_stream").start()
+    try:
+        with timer.active():
+            llm = get_llm()
+            summary, history = await get_history(message.conversation_id)
+            cached, cache_key = await lookup_cached_answer(message, summary, history)
+            if not cached:
+                full_prompt, citations, usage = await build_prompt(message, summary, history)
     except Exception as e:
+        count_error("chat_stream", e)
+        timer.finish()
         raise HTTPException(status_code=500, detail=f"Error processing chat: {str(e)}")
+    
+    async def save_streamed(response_text: str):
+        with timer.active():
+            await save_exchange(message.conversation_id, message.message, response_text)
+    
+    async def cached_stream():
+        # The whole cached answer goes out as a single token
+        try:
+            await save_streamed(cached["response"])
+            yield format_sse("citations", {
+                "citations": cached["citations"],
+                "conversation_id": message.conversation_id
+            })
+            yield format_sse("token", {"token": cached["response"]})
+            yield format_sse("done", {
+                "response": cached["response"],
+                "conversation_id": message.conversation_id,
+                "cached": True
+            })
+        finally:
+            timer.finish()
+    
+    async def event_stream():
+        try:
+            yield format_sse("citations", {
+                "citations": citations,
+                "conversation_id": message.conversation_id
+            })
+            
+            tokens = []
+            # Time to the first token and the rest of generation are separate stages
+            timer.enter("llm_first_token")
+            LLM_IN_FLIGHT.inc()
+            try:
+                async for chunk in llm.astream(full_prompt):
+                    token = chunk.content if hasattr(chunk, 'content') else str(chunk)
+                    if token:
+                        if not tokens:
+                            timer.exit()
+                            timer.enter("llm")
+                        tokens.append(token)
+                        yield format_sse("token", {"token": token})
+            except Exception as e:
+                count_error("chat_stream", e)
+                yield format_sse("error", {"detail": f"Error processing chat: {str(e)}"})
+                return
+            finally:
+                LLM_IN_FLIGHT.dec()
+                timer.exit()
+            
+            # Save the complete answer only once generation has finished
+            response_text = "".join(tokens)
+            TOKENS.labels("completion").inc(count_tokens(response_text))
+            await save_streamed(response_text)
+            if cache_key:
+                answer_cache.put(*cache_key, {"response": response_text, "citations": citations})
+            yield format_sse("done", {
+                "response": response_text,
+                "conversation_id": message.conversation_id,
+                "prompt_usage": usage
+            })
+        finally:
+            timer.finish()
+    
+    return StreamingResponse(
+        cached_stream() if cached else event_stream(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
 
 @chat_router.delete("/conversation/{conversation_id}")
 async def clear_conversation(conversation_id: str):
     """Clear conversation history"""
-    if conversation_id in conversation_memories:
-        del conversation_memories[conversation_id]
+    if await run_db(get_conversation_store().delete, conversation_id):
         return {"status": "cleared", "conversation_id": conversation_id}
     else:
         raise HTTPException(status_code=404, detail="Conversation not found")
 
 @chat_router.get("/conversations")
-async def list_conversations():
-    """List all active conversations"""
-    return {
-        "conversations": list(conversation_memories.keys()),
-        "count": len(conversation_memories)
-    }
+def list_conversations():
+    """
+    List all active conversations.
+    The JSON body is streamed as ids are read from the store, a page at a time,
+    so the full list is never built in memory.
+    """
+    def generate():
+        count = 0
+        yield '{"conversations": ['
+        for conversation_id in get_conversation_store().iter_ids():
+            yield ("," if count else "") + json.dumps(conversation_id)
+            count += 1
+        yield f'], "count": {count}}}'
+    
+    return StreamingResponse(generate(), media_type="application/json")
+
+@chat_router.get("/conversation-store")
+async def conversation_store_stats():
+    """Size, memory use and limits of the conversation store"""
+    return await run_db(get_conversation_store().stats)
+
+
+@chat_router.get("/query-cache")
+async def query_cache_stats():
+    """Inspect the query embedding cache"""
+    return query_embedding_cache.stats()
+
+@chat_router.delete("/query-cache")
+async def clear_query_cache():
+    """Clear the query embedding cache"""
+    cleared = query_embedding_cache.clear()
+    return {"status": "cleared", "entries_cleared": cleared}
+
+@chat_router.get("/answer-cache")
+async def answer_cache_stats():
+    """Hit rate and size of the semantic answer cache"""
+    return {**answer_cache.stats(), "enabled": ANSWER_CACHE_ENABLED}
 
+@chat_router.delete("/answer-cache")
+async def clear_answer_cache():
+    """Clear the semantic answer cache"""
+    cleared = answer_cache.clear()
+    return {"status": "cleared", "entries_cleared": cleared}
@@ -0,0 +1,16 @@
+"""
+Telemetry plug-in for the ChromaDB client, kept apart so chromadb is only imported with the client
+"""
+from chromadb.telemetry.product import ProductTelemetryClient, ProductTelemetryEvent
+from overrides import override
+
+class NoOpProductTelemetry(ProductTelemetryClient):
+    """
+    Product telemetry that does nothing. Chroma's default client batches events in a
+    dict without a lock, even with telemetry disabled, and concurrent queries can fail
+    with a KeyError from it
+    """
+
+    @override
+    def capture(self, event: ProductTelemetryEvent) -> None:
+        pass
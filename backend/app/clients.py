@@ -0,0 +1,127 @@
+"""
+Process-wide OpenAI/Azure OpenAI clients sharing one keep-alive connection pool
+"""
+import threading
+from typing import TYPE_CHECKING, Dict, Optional
+from app.config import (
+    USE_AZURE,
+    AZURE_OPENAI_ENDPOINT,
+    OPENAI_API_KEY_TO_USE,
+    API_VERSION,
+    HTTP_MAX_CONNECTIONS,
+    HTTP_MAX_KEEPALIVE_CONNECTIONS,
+    HTTP_KEEPALIVE_EXPIRY,
+    HTTP_CONNECT_TIMEOUT,
+    HTTP_READ_TIMEOUT,
+    OPENAI_MAX_RETRIES
+)
+
+# httpx and openai are imported when the first client is built, which keeps startup fast
+if TYPE_CHECKING:
+    import httpx
+    import openai
+
+_lock = threading.Lock()
+_http_client: Optional["httpx.Client"] = None
+_async_http_client: Optional["httpx.AsyncClient"] = None
+_openai_clients: Dict[Optional[str], "openai.OpenAI"] = {}
+_async_openai_clients: Dict[Optional[str], "openai.AsyncOpenAI"] = {}
+
+def _pool_limits() -> "httpx.Limits":
+    import httpx
+    return httpx.Limits(
+        max_connections=HTTP_MAX_CONNECTIONS,
+        max_keepalive_connections=HTTP_MAX_KEEPALIVE_CONNECTIONS,
+        keepalive_expiry=HTTP_KEEPALIVE_EXPIRY
+    )
+
+def _timeout() -> "httpx.Timeout":
+    import httpx
+    return httpx.Timeout(HTTP_READ_TIMEOUT, connect=HTTP_CONNECT_TIMEOUT)
+
+def get_http_client() -> "httpx.Client":
+    """Get the shared synchronous HTTP client"""
+    global _http_client
+    if _http_client is None:
+        import httpx
+        with _lock:
+            if _http_client is None:
+                _http_client = httpx.Client(limits=_pool_limits(), timeout=_timeout())
+    return _http_client
+
+def get_async_http_client() -> "httpx.AsyncClient":
+    """Get the shared asynchronous HTTP client"""
+    global _async_http_client
+    if _async_http_client is None:
+        import httpx
+        with _lock:
+            if _async_http_client is None:
+                _async_http_client = httpx.AsyncClient(limits=_pool_limits(), timeout=_timeout())
+    return _async_http_client
+
+def get_openai_client(deployment: Optional[str] = None) -> "openai.OpenAI":
+    """
+    Get the shared OpenAI client (or Azure OpenAI client for the given deployment).
+    Azure clients are per deployment because the deployment is part of the URL,
+    but they all use the same connection pool.
+    """
+    key = deployment if USE_AZURE else None
+    if key not in _openai_clients:
+        import openai
+        http_client = get_http_client()
+        with _lock:
+            if key not in _openai_clients:
+                if USE_AZURE:
+                    _openai_clients[key] = openai.AzureOpenAI(
+                        azure_endpoint=AZURE_OPENAI_ENDPOINT,
+                        azure_deployment=deployment,
+                        api_key=OPENAI_API_KEY_TO_USE,
+                        api_version=API_VERSION,
+                        max_retries=OPENAI_MAX_RETRIES,
+                        http_client=http_client
+                    )
+                else:
+                    _openai_clients[key] = openai.OpenAI(
+                        api_key=OPENAI_API_KEY_TO_USE,
+                        max_retries=OPENAI_MAX_RETRIES,
+                        http_client=http_client
+                    )
+    return _openai_clients[key]
+
+def get_async_openai_client(deployment: Optional[str] = None) -> "openai.AsyncOpenAI":
+    """Async counterpart of get_openai_client()"""
+    key = deployment if USE_AZURE else None
+    if key not in _async_openai_clients:
+        import openai
+        http_client = get_async_http_client()
+        with _lock:
+            if key not in _async_openai_clients:
+                if USE_AZURE:
+                    _async_openai_clients[key] = openai.AsyncAzureOpenAI(
+                        azure_endpoint=AZURE_OPENAI_ENDPOINT,
+                        azure_deployment=deployment,
+                        api_key=OPENAI_API_KEY_TO_USE,
+                        api_version=API_VERSION,
+                        max_retries=OPENAI_MAX_RETRIES,
+                        http_client=http_client
+                    )
+                else:
+                    _async_openai_clients[key] = openai.AsyncOpenAI(
+                        api_key=OPENAI_API_KEY_TO_USE,
+                        max_retries=OPENAI_MAX_RETRIES,
+                        http_client=http_client
+                    )
+    return _async_openai_clients[key]
+
+async def close_clients():
+    """Close the shared connection pools (called on shutdown)"""
+    global _http_client, _async_http_client
+    with _lock:
+        _openai_clients.clear()
+        _async_openai_clients.clear()
+        http_client, _http_client = _http_client, None
+        async_http_client, _async_http_client = _async_http_client, None
+    if http_client is not None:
+        http_client.close()
+    if async_http_client is not None:
+        await async_http_client.aclose()
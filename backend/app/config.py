@@ -2,14 +2,10 @@
 Configuration settings
 """
 import os
-from dotenv import load_dotenv
-from pathlib import Path
+from dotenv import find_dotenv, load_dotenv
 
-# Load .env from parent directory (project root)
-env_path = Path(__file__).parent.parent.parent / '.env'
-load_dotenv(dotenv_path=env_path)
-# Also try loading from current directory
-load_dotenv()
+# Load the nearest .env above this file (backend/.env or the project root's), once per process
+load_dotenv(find_dotenv())
 
 # Azure OpenAI Configuration
 AZURE_OPENAI_ENDPOINT = os.getenv("AZURE_OPENAI_ENDPOINT", "").strip()
@@ -24,9 +20,98 @@ OPENAI_API_KEY_TO_USE = AZURE_OPENAI_API_KEY if USE_AZURE else OPENAI_API_KEY
 # ChromaDB Configuration
 CHROMA_DB_PATH = os.getenv("CHROMA_DB_PATH", "./chroma_db")
 COLLECTION_NAME = os.getenv("COLLECTION_NAME", "sicko_bot_documents")
+# "embedded": the collection lives in CHROMA_DB_PATH inside this process (a single worker only).
+# "http": a Chroma server (e.g. `chroma run --path ./chroma_db --port 8001`) owns the collection,
+# so several uvicorn workers can share it
+VECTOR_STORE_MODE = os.getenv("VECTOR_STORE_MODE", "embedded").lower()
+# A vector query answered while other threads or workers write can fail transiently; it is retried this often
+VECTOR_QUERY_RETRIES = int(os.getenv("VECTOR_QUERY_RETRIES", "3"))
+CHROMA_SERVER_HOST = os.getenv("CHROMA_SERVER_HOST", "localhost")
+CHROMA_SERVER_HTTP_PORT = os.getenv("CHROMA_SERVER_HTTP_PORT", "8001")
+CHROMA_SERVER_SSL_ENABLED = os.getenv("CHROMA_SERVER_SSL_ENABLED", "false").lower() == "true"
+# Registry of ingested files (filename -> chunk ids, hash, size), kept next to the collection
+FILE_REGISTRY_PATH = os.getenv("FILE_REGISTRY_PATH", os.path.join(CHROMA_DB_PATH, "file_registry.sqlite3"))
+# Threads used to run blocking ChromaDB calls off the event loop
+DB_EXECUTOR_WORKERS = int(os.getenv("DB_EXECUTOR_WORKERS", "8"))
 
 # Embedding Model
 EMBEDDING_MODEL = os.getenv("EMBEDDING_MODEL", "text-embedding-ada-002")
+# Where embeddings are computed: "openai" (OpenAI or Azure OpenAI, see above) or "local" (in-process, CPU only)
+EMBEDDING_PROVIDER = os.getenv("EMBEDDING_PROVIDER", "openai").lower()
+# Local model: "hashing" (built in, no download) or a sentence-transformers model name, e.g. "all-MiniLM-L6-v2"
+LOCAL_EMBEDDING_MODEL = os.getenv("LOCAL_EMBEDDING_MODEL", "hashing")
+# Vector size of the "hashing" model (sentence-transformers models have a fixed size)
+LOCAL_EMBEDDING_DIMENSION = int(os.getenv("LOCAL_EMBEDDING_DIMENSION", "384"))
+LOCAL_EMBEDDING_BATCH_SIZE = int(os.getenv("LOCAL_EMBEDDING_BATCH_SIZE", "64"))
+
+# Embedding cache (on-disk, content-addressed by chunk text + embedding model)
+EMBEDDING_CACHE_ENABLED = os.getenv("EMBEDDING_CACHE_ENABLED", "true").lower() == "true"
+EMBEDDING_CACHE_PATH = os.getenv("EMBEDDING_CACHE_PATH", os.path.join(CHROMA_DB_PATH, "embedding_cache.sqlite3"))
+EMBEDDING_CACHE_MAX_ENTRIES = int(os.getenv("EMBEDDING_CACHE_MAX_ENTRIES", "200000"))
+
+# Near-duplicate chunk filtering at ingest (MinHash/LSH). Chunks whose estimated similarity to a
+# stored chunk or an earlier chunk of the same file is at least NEAR_DUP_THRESHOLD aren't embedded or stored
+NEAR_DUP_ENABLED = os.getenv("NEAR_DUP_ENABLED", "true").lower() == "true"
+NEAR_DUP_THRESHOLD = float(os.getenv("NEAR_DUP_THRESHOLD", "0.9"))
+NEAR_DUP_INDEX_PATH = os.getenv("NEAR_DUP_INDEX_PATH", os.path.join(CHROMA_DB_PATH, "near_duplicates.sqlite3"))
+
+# Hybrid retrieval: a BM25 keyword index over chunk texts, fused with vector hits by reciprocal rank fusion
+KEYWORD_INDEX_ENABLED = os.getenv("KEYWORD_INDEX_ENABLED", "true").lower() == "true"
+KEYWORD_INDEX_PATH = os.getenv("KEYWORD_INDEX_PATH", os.path.join(CHROMA_DB_PATH, "keyword_index.sqlite3"))
+# Candidates taken from each ranking before fusion, and the RRF damping constant
+HYBRID_CANDIDATES = int(os.getenv("HYBRID_CANDIDATES", "20"))
+RRF_K = int(os.getenv("RRF_K", "60"))
+# Short identifier-like queries ("ERR-4021", "section 3.2.1") are answered from the keyword index alone
+KEYWORD_FAST_PATH = os.getenv("KEYWORD_FAST_PATH", "true").lower() == "true"
+# ...unless the best match's BM25 score is below this (the identifier is common in the corpus); then hybrid search runs
+KEYWORD_FAST_PATH_MIN_SCORE = float(os.getenv("KEYWORD_FAST_PATH_MIN_SCORE", "1.0"))
+# Chat context is picked from MMR_FETCH_K candidates by maximal marginal relevance
+# (MMR_LAMBDA: 1 = relevance only, 0 = diversity only)
+MMR_ENABLED = os.getenv("MMR_ENABLED", "true").lower() == "true"
+MMR_FETCH_K = int(os.getenv("MMR_FETCH_K", "20"))
+MMR_LAMBDA = float(os.getenv("MMR_LAMBDA", "0.7"))
+
+# Embedding scheduler used during ingestion. Set the limits from your deployment's quota (0 = unlimited).
+# They are shared by EMBED_QUOTA_WORKERS processes (default: uvicorn's WEB_CONCURRENCY, or 1), each taking an equal share
+EMBED_TPM_LIMIT = int(os.getenv("EMBED_TPM_LIMIT", "0"))
+EMBED_RPM_LIMIT = int(os.getenv("EMBED_RPM_LIMIT", "0"))
+EMBED_QUOTA_WORKERS = max(1, int(os.getenv("EMBED_QUOTA_WORKERS", os.getenv("WEB_CONCURRENCY", "1"))))
+EMBED_MAX_BATCH_TOKENS = int(os.getenv("EMBED_MAX_BATCH_TOKENS", "16000"))
+EMBED_MIN_BATCH_TOKENS = int(os.getenv("EMBED_MIN_BATCH_TOKENS", "1000"))
+EMBED_MAX_BATCH_SIZE = int(os.getenv("EMBED_MAX_BATCH_SIZE", "256"))
+EMBED_CONCURRENCY = int(os.getenv("EMBED_CONCURRENCY", "4"))
+EMBED_MAX_RETRIES = int(os.getenv("EMBED_MAX_RETRIES", "6"))
+EMBED_BACKOFF_BASE = float(os.getenv("EMBED_BACKOFF_BASE", "1"))
+EMBED_BACKOFF_MAX = float(os.getenv("EMBED_BACKOFF_MAX", "60"))
+
+# Query embedding cache (in-process, for repeated chat questions)
+QUERY_CACHE_TTL_SECONDS = float(os.getenv("QUERY_CACHE_TTL_SECONDS", "3600"))
+QUERY_CACHE_MAX_ENTRIES = int(os.getenv("QUERY_CACHE_MAX_ENTRIES", "2048"))
+
+# Semantic answer cache: first-turn questions whose embedding is at least ANSWER_CACHE_THRESHOLD
+# cosine-similar to an earlier one, asked against the same corpus version, reuse its answer
+ANSWER_CACHE_ENABLED = os.getenv("ANSWER_CACHE_ENABLED", "true").lower() == "true"
+ANSWER_CACHE_THRESHOLD = float(os.getenv("ANSWER_CACHE_THRESHOLD", "0.95"))
+ANSWER_CACHE_MAX_ENTRIES = int(os.getenv("ANSWER_CACHE_MAX_ENTRIES", "1000"))
+ANSWER_CACHE_TTL_SECONDS = float(os.getenv("ANSWER_CACHE_TTL_SECONDS", "86400"))
+
+# Conversation histories (SQLite, shared by all workers). Each keeps its last CONVERSATION_MAX_MESSAGES
+# messages; idle ones expire after CONVERSATION_TTL_SECONDS and the least recently active are evicted
+# beyond CONVERSATION_MAX_CONVERSATIONS or CONVERSATION_MAX_BYTES of stored text
+CONVERSATION_DB_PATH = os.getenv("CONVERSATION_DB_PATH", os.path.join(CHROMA_DB_PATH, "conversations.sqlite3"))
+CONVERSATION_MAX_MESSAGES = int(os.getenv("CONVERSATION_MAX_MESSAGES", "20"))
+CONVERSATION_MAX_CONVERSATIONS = int(os.getenv("CONVERSATION_MAX_CONVERSATIONS", "10000"))
+CONVERSATION_TTL_SECONDS = float(os.getenv("CONVERSATION_TTL_SECONDS", str(7 * 24 * 3600)))
+CONVERSATION_MAX_BYTES = int(os.getenv("CONVERSATION_MAX_BYTES", str(256 * 1024 * 1024)))
+
+# Prompt packing: prompts are filled up to PROMPT_TOKEN_BUDGET tokens, of which chat history (a rolling
+# summary plus up to PROMPT_HISTORY_MESSAGES recent messages) takes at most PROMPT_HISTORY_TOKENS
+PROMPT_TOKEN_BUDGET = int(os.getenv("PROMPT_TOKEN_BUDGET", "3000"))
+PROMPT_HISTORY_TOKENS = int(os.getenv("PROMPT_HISTORY_TOKENS", "800"))
+PROMPT_HISTORY_MESSAGES = int(os.getenv("PROMPT_HISTORY_MESSAGES", "6"))
+# Older messages are folded into a rolling summary of at most HISTORY_SUMMARY_TOKENS tokens
+HISTORY_SUMMARY_ENABLED = os.getenv("HISTORY_SUMMARY_ENABLED", "true").lower() == "true"
+HISTORY_SUMMARY_TOKENS = int(os.getenv("HISTORY_SUMMARY_TOKENS", "300"))
 
 # Chat Model
 CHAT_MODEL = os.getenv("CHAT_MODEL", "gpt-4")
@@ -34,5 +119,52 @@ CHAT_MODEL = os.getenv("CHAT_MODEL", "gpt-4")
 # Azure OpenAI Chat Model (if using Azure)
 AZURE_CHAT_MODEL = os.getenv("AZURE_CHAT_MODEL", "gpt-4")
 
-print(f"Configuration loaded - Using {'Azure OpenAI' if USE_AZURE else 'OpenAI'}")
+# Shared HTTP connection pool for the OpenAI/Azure OpenAI clients
+HTTP_MAX_CONNECTIONS = int(os.getenv("HTTP_MAX_CONNECTIONS", "100"))
+HTTP_MAX_KEEPALIVE_CONNECTIONS = int(os.getenv("HTTP_MAX_KEEPALIVE_CONNECTIONS", "20"))
+HTTP_KEEPALIVE_EXPIRY = float(os.getenv("HTTP_KEEPALIVE_EXPIRY", "60"))
+HTTP_CONNECT_TIMEOUT = float(os.getenv("HTTP_CONNECT_TIMEOUT", "5"))
+HTTP_READ_TIMEOUT = float(os.getenv("HTTP_READ_TIMEOUT", "60"))
+OPENAI_MAX_RETRIES = int(os.getenv("OPENAI_MAX_RETRIES", "2"))
+
+# Background ingestion
+INGEST_WORKERS = int(os.getenv("INGEST_WORKERS", "2"))
+INGEST_JOB_HISTORY = int(os.getenv("INGEST_JOB_HISTORY", "200"))
+# Job state is kept in SQLite so any worker can report on a job another worker runs
+JOB_DB_PATH = os.getenv("JOB_DB_PATH", os.path.join(CHROMA_DB_PATH, "jobs.sqlite3"))
+# Lock files that serialize writes to one file across worker processes
+FILE_LOCK_DIR = os.getenv("FILE_LOCK_DIR", os.path.join(CHROMA_DB_PATH, "locks"))
+INGEST_BATCH_SIZE = int(os.getenv("INGEST_BATCH_SIZE", "256"))
+# Chunks still hidden from search after this long were left behind by an interrupted ingest/update and are purged at startup
+STALE_HIDDEN_CHUNK_SECONDS = int(os.getenv("STALE_HIDDEN_CHUNK_SECONDS", "3600"))
+# Page text extraction is spread across processes for documents with at least PDF_PARALLEL_MIN_PAGES pages
+PDF_EXTRACT_WORKERS = int(os.getenv("PDF_EXTRACT_WORKERS", str(min(4, os.cpu_count() or 1))))
+PDF_PARALLEL_MIN_PAGES = int(os.getenv("PDF_PARALLEL_MIN_PAGES", "50"))
+PDF_PAGES_PER_TASK = int(os.getenv("PDF_PAGES_PER_TASK", "16"))
+# Uploads are spooled to disk here (defaults to the system temp dir) in blocks of UPLOAD_SPOOL_BLOCK_SIZE bytes
+UPLOAD_TMP_DIR = os.getenv("UPLOAD_TMP_DIR") or None
+UPLOAD_SPOOL_BLOCK_SIZE = int(os.getenv("UPLOAD_SPOOL_BLOCK_SIZE", str(1024 * 1024)))
+# What to do when an upload is byte-identical to a stored file: "alias" (store the name, share its chunks),
+# "reject" (409 Conflict) or "off" (ingest it again)
+DEDUP_POLICY = os.getenv("DEDUP_POLICY", "alias").lower()
+
+# Opt-in sampling profiles (pyinstrument) of single chat and upload requests. When enabled, a request
+# is profiled if it sends "X-Profile: 1" or is picked at random with probability PROFILE_SAMPLE_RATE.
+# The last PROFILE_MAX_CAPTURES captures are kept in PROFILE_DIR
+PROFILING_ENABLED = os.getenv("PROFILING_ENABLED", "false").lower() == "true"
+PROFILE_SAMPLE_RATE = float(os.getenv("PROFILE_SAMPLE_RATE", "0"))
+PROFILE_INTERVAL = float(os.getenv("PROFILE_INTERVAL", "0.001"))
+PROFILE_DIR = os.getenv("PROFILE_DIR", os.path.join(CHROMA_DB_PATH, "profiles"))
+PROFILE_MAX_CAPTURES = int(os.getenv("PROFILE_MAX_CAPTURES", "50"))
+# If set, the X-Profile header and the /api/admin endpoints require "X-Admin-Token: <ADMIN_TOKEN>";
+# if not, they are disabled
+ADMIN_TOKEN = os.getenv("ADMIN_TOKEN", "").strip()
+# Without ADMIN_TOKEN, allow admin features to clients connecting from a loopback address. Only safe
+# when no reverse proxy on this machine forwards remote requests to the app
+ADMIN_ALLOW_LOOPBACK = os.getenv("ADMIN_ALLOW_LOOPBACK", "false").lower() == "true"
 
+# Startup work (opening the vector store, building clients, loading indexes) runs in the background;
+# /ready reports when it is done. A failed attempt is retried after WARMUP_RETRY_SECONDS
+WARMUP_RETRY_SECONDS = float(os.getenv("WARMUP_RETRY_SECONDS", "5"))
+# Chat, upload and update requests arriving during warmup wait this long for it before answering 503
+WARMUP_REQUEST_WAIT_SECONDS = float(os.getenv("WARMUP_REQUEST_WAIT_SECONDS", "30"))
@@ -0,0 +1,287 @@
+"""
+Persistent, bounded store of chat conversation histories
+"""
+import os
+import sqlite3
+import threading
+import time
+from typing import Dict, Iterator, List, Optional, Tuple
+from app.config import (
+    CONVERSATION_DB_PATH,
+    CONVERSATION_MAX_MESSAGES,
+    CONVERSATION_MAX_CONVERSATIONS,
+    CONVERSATION_TTL_SECONDS,
+    CONVERSATION_MAX_BYTES
+)
+
+# Seconds between global eviction sweeps (per process)
+SWEEP_INTERVAL = 10.0
+
+class ConversationStore:
+    """
+    Conversation histories in SQLite (WAL mode), so every uvicorn worker sees the same
+    history and it survives restarts.
+
+    Each conversation keeps only its last `max_messages` messages (a ring buffer).
+    Across conversations, ones idle longer than `ttl_seconds` expire, and the least
+    recently active are evicted while there are more than `max_conversations` or their
+    stored text exceeds `max_bytes`.
+
+    A conversation can also carry a rolling summary of its older messages, covering
+    every message up to `summarized_through`.
+
+    Within a process all threads share one connection, so reads take the same lock as
+    write transactions and never see another thread's transaction half done.
+    """
+
+    def __init__(self, path: str, max_messages: int, max_conversations: int,
+                 ttl_seconds: float, max_bytes: int):
+        self.path = path
+        self.max_messages = max_messages
+        self.max_conversations = max_conversations
+        self.ttl_seconds = ttl_seconds
+        self.max_bytes = max_bytes
+        self.evictions = 0
+        self._last_sweep = 0.0
+        self._lock = threading.Lock()
+
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+
+        self._conn = sqlite3.connect(path, check_same_thread=False, timeout=30)
+        self._conn.row_factory = sqlite3.Row
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute(
+            """CREATE TABLE IF NOT EXISTS conversations (
+                conversation_id TEXT PRIMARY KEY,
+                created_at REAL NOT NULL,
+                last_active REAL NOT NULL,
+                message_count INTEGER NOT NULL,
+                bytes INTEGER NOT NULL
+            )"""
+        )
+        # Rolling summary of older messages (added after the first release)
+        columns = [row["name"] for row in self._conn.execute("PRAGMA table_info(conversations)")]
+        if "summary" not in columns:
+            self._conn.execute("ALTER TABLE conversations ADD COLUMN summary TEXT")
+        if "summarized_through" not in columns:
+            self._conn.execute("ALTER TABLE conversations ADD COLUMN summarized_through INTEGER NOT NULL DEFAULT 0")
+        self._conn.execute("CREATE INDEX IF NOT EXISTS idx_conversations_last_active ON conversations(last_active)")
+        self._conn.execute(
+            """CREATE TABLE IF NOT EXISTS messages (
+                conversation_id TEXT NOT NULL,
+                seq INTEGER NOT NULL,
+                role TEXT NOT NULL,
+                content TEXT NOT NULL,
+                created_at REAL NOT NULL,
+                PRIMARY KEY (conversation_id, seq)
+            ) WITHOUT ROWID"""
+        )
+        self._conn.commit()
+
+    def _expired_before(self) -> float:
+        return time.time() - self.ttl_seconds
+
+    def get_messages(self, conversation_id: str, limit: Optional[int] = None) -> List[Dict]:
+        """Stored messages of a conversation, oldest first (the last `limit` if given)"""
+        with self._lock:
+            rows = self._conn.execute(
+                """SELECT m.role, m.content FROM messages m
+                JOIN conversations c ON c.conversation_id = m.conversation_id
+                WHERE m.conversation_id = ? AND c.last_active >= ?
+                ORDER BY m.seq DESC LIMIT ?""",
+                (conversation_id, self._expired_before(), limit if limit is not None else -1)
+            ).fetchall()
+        return [{"role": row["role"], "content": row["content"]} for row in reversed(rows)]
+
+    # The two helpers below don't lock: callers hold self._lock across both, so the
+    # summary and the messages after it come from the same state
+    def _summary_row(self, conversation_id: str):
+        return self._conn.execute(
+            "SELECT summary, summarized_through FROM conversations WHERE conversation_id = ? AND last_active >= ?",
+            (conversation_id, self._expired_before())
+        ).fetchone()
+
+    def _messages_after(self, conversation_id: str, seq: int, limit: int) -> List[Dict]:
+        rows = self._conn.execute(
+            """SELECT seq, role, content FROM messages WHERE conversation_id = ? AND seq > ?
+            ORDER BY seq DESC LIMIT ?""",
+            (conversation_id, seq, limit)
+        ).fetchall()
+        return [{"seq": row["seq"], "role": row["role"], "content": row["content"]} for row in reversed(rows)]
+
+    def get_history(self, conversation_id: str, limit: int) -> Tuple[Optional[str], List[Dict]]:
+        """The rolling summary and up to `limit` of the latest messages it doesn't cover, oldest first"""
+        with self._lock:
+            row = self._summary_row(conversation_id)
+            if row is None:
+                return None, []
+            return row["summary"], self._messages_after(conversation_id, row["summarized_through"], limit)
+
+    def unsummarized(self, conversation_id: str, keep_recent: int) -> Tuple[Optional[str], List[Dict]]:
+        """The rolling summary and the messages it doesn't cover yet, except the latest `keep_recent`"""
+        with self._lock:
+            row = self._summary_row(conversation_id)
+            if row is None:
+                return None, []
+            messages = self._messages_after(conversation_id, row["summarized_through"], -1)
+        return row["summary"], messages[:max(0, len(messages) - keep_recent)]
+
+    def set_summary(self, conversation_id: str, summary: str, through_seq: int) -> bool:
+        """Store a rolling summary covering messages up to `through_seq`, unless a newer one is stored"""
+        with self._lock, self._conn:
+            updated = self._conn.execute(
+                """UPDATE conversations SET summary = ?, summarized_through = ?
+                WHERE conversation_id = ? AND summarized_through < ?""",
+                (summary, through_seq, conversation_id, through_seq)
+            ).rowcount > 0
+            if updated:
+                self._update_bytes(conversation_id)
+            return updated
+
+    def _update_bytes(self, conversation_id: str) -> None:
+        """Recount the stored text (messages and summary) of a conversation"""
+        self._conn.execute(
+            """UPDATE conversations SET bytes =
+                (SELECT COALESCE(SUM(LENGTH(CAST(content AS BLOB))), 0) FROM messages WHERE conversation_id = ?)
+                + COALESCE(LENGTH(CAST(summary AS BLOB)), 0)
+            WHERE conversation_id = ?""",
+            (conversation_id, conversation_id)
+        )
+
+    def append(self, conversation_id: str, messages: List[Dict]) -> None:
+        """Add messages ({"role", "content"}) to a conversation, trimming it to the last max_messages"""
+        now = time.time()
+        with self._lock, self._conn:
+            row = self._conn.execute(
+                "SELECT message_count, last_active FROM conversations WHERE conversation_id = ?",
+                (conversation_id,)
+            ).fetchone()
+            if row is not None and row["last_active"] < self._expired_before():
+                # Expired but not swept yet: start over
+                self._delete(conversation_id)
+                row = None
+            count = row["message_count"] if row else 0
+
+            self._conn.executemany(
+                "INSERT INTO messages (conversation_id, seq, role, content, created_at) VALUES (?, ?, ?, ?, ?)",
+                [
+                    (conversation_id, count + i, message["role"], message["content"], now)
+                    for i, message in enumerate(messages, 1)
+                ]
+            )
+            count += len(messages)
+            self._conn.execute(
+                "DELETE FROM messages WHERE conversation_id = ? AND seq <= ?",
+                (conversation_id, count - self.max_messages)
+            )
+            self._conn.execute(
+                """INSERT INTO conversations (conversation_id, created_at, last_active, message_count, bytes)
+                VALUES (?, ?, ?, ?, 0)
+                ON CONFLICT(conversation_id) DO UPDATE SET
+                    last_active = excluded.last_active,
+                    message_count = excluded.message_count""",
+                (conversation_id, now, now, count)
+            )
+            self._update_bytes(conversation_id)
+
+        if time.monotonic() - self._last_sweep > SWEEP_INTERVAL:
+            self.sweep()
+
+    def _delete(self, conversation_id: str) -> bool:
+        self._conn.execute("DELETE FROM messages WHERE conversation_id = ?", (conversation_id,))
+        return self._conn.execute(
+            "DELETE FROM conversations WHERE conversation_id = ?", (conversation_id,)
+        ).rowcount > 0
+
+    def delete(self, conversation_id: str) -> bool:
+        """Delete a conversation. Returns False if it didn't exist"""
+        with self._lock, self._conn:
+            return self._delete(conversation_id)
+
+    def sweep(self) -> int:
+        """Expire idle conversations and evict the least recently active beyond the limits"""
+        self._last_sweep = time.monotonic()
+        with self._lock, self._conn:
+            expired = [
+                row[0] for row in self._conn.execute(
+                    "SELECT conversation_id FROM conversations WHERE last_active < ?", (self._expired_before(),)
+                )
+            ]
+            count, total_bytes = self._conn.execute(
+                "SELECT COUNT(*), COALESCE(SUM(bytes), 0) FROM conversations WHERE last_active >= ?",
+                (self._expired_before(),)
+            ).fetchone()
+
+            evicted = []
+            if count > self.max_conversations or total_bytes > self.max_bytes:
+                rows = self._conn.execute(
+                    "SELECT conversation_id, bytes FROM conversations WHERE last_active >= ? ORDER BY last_active",
+                    (self._expired_before(),)
+                )
+                for conversation_id, size in rows:
+                    if count <= self.max_conversations and total_bytes <= self.max_bytes:
+                        break
+                    evicted.append(conversation_id)
+                    count -= 1
+                    total_bytes -= size
+
+            for conversation_id in expired + evicted:
+                self._delete(conversation_id)
+            self.evictions += len(expired) + len(evicted)
+        return len(expired) + len(evicted)
+
+    def iter_ids(self, page_size: int = 500) -> Iterator[str]:
+        """Ids of live conversations in id order, read a page at a time (locking per page, not while yielding)"""
+        after = ""
+        while True:
+            with self._lock:
+                rows = self._conn.execute(
+                    """SELECT conversation_id FROM conversations
+                    WHERE conversation_id > ? AND last_active >= ? ORDER BY conversation_id LIMIT ?""",
+                    (after, self._expired_before(), page_size)
+                ).fetchall()
+            if not rows:
+                return
+            for row in rows:
+                yield row["conversation_id"]
+            after = rows[-1]["conversation_id"]
+
+    def stats(self) -> Dict:
+        """Size, memory use and limits of the store"""
+        with self._lock:
+            count, messages, total_bytes = self._conn.execute(
+                """SELECT COUNT(*), COALESCE(SUM(MIN(message_count, ?)), 0), COALESCE(SUM(bytes), 0)
+                FROM conversations WHERE last_active >= ?""",
+                (self.max_messages, self._expired_before())
+            ).fetchone()
+        return {
+            "conversations": count,
+            "messages": messages,
+            "bytes": total_bytes,
+            "max_conversations": self.max_conversations,
+            "max_messages_per_conversation": self.max_messages,
+            "max_bytes": self.max_bytes,
+            "ttl_seconds": self.ttl_seconds,
+            "evictions": self.evictions
+        }
+
+_store: Optional[ConversationStore] = None
+_store_lock = threading.Lock()
+
+def get_conversation_store() -> ConversationStore:
+    """Get the process-wide conversation store"""
+    global _store
+    if _store is None:
+        with _store_lock:
+            if _store is None:
+                _store = ConversationStore(
+                    CONVERSATION_DB_PATH,
+                    CONVERSATION_MAX_MESSAGES,
+                    CONVERSATION_MAX_CONVERSATIONS,
+                    CONVERSATION_TTL_SECONDS,
+                    CONVERSATION_MAX_BYTES
+                )
+    return _store
@@ -1,52 +1,115 @@
 """
 ChromaDB database setup and management
 """
-import chromadb
-from chromadb.config import Settings
-from app.config import CHROMA_DB_PATH, COLLECTION_NAME
+import asyncio
+import contextvars
+import functools
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from app.profiling import profile_call
+from app.config import (
+    CHROMA_DB_PATH,
+    COLLECTION_NAME,
+    DB_EXECUTOR_WORKERS,
+    VECTOR_STORE_MODE,
+    CHROMA_SERVER_HOST,
+    CHROMA_SERVER_HTTP_PORT,
+    CHROMA_SERVER_SSL_ENABLED
+)
 import os
 
 # Initialize ChromaDB client
 client = None
 collection = None
+_init_lock = threading.Lock()
+
+# Bounded pool for blocking ChromaDB calls made from async code
+db_executor = ThreadPoolExecutor(max_workers=DB_EXECUTOR_WORKERS, thread_name_prefix="chroma")
+
+def _client_settings():
+    from chromadb.config import Settings
+    return Settings(
+        anonymized_telemetry=False,
+        chroma_product_telemetry_impl="app.chroma_telemetry.NoOpProductTelemetry"
+    )
+
+def create_client():
+    """Create the ChromaDB client for the configured VECTOR_STORE_MODE"""
+    # chromadb is slow to import, so it waits until the client is created
+    import chromadb
+    
+    if VECTOR_STORE_MODE == "http":
+        return chromadb.HttpClient(
+            host=CHROMA_SERVER_HOST,
+            port=CHROMA_SERVER_HTTP_PORT,
+            ssl=CHROMA_SERVER_SSL_ENABLED,
+            settings=_client_settings()
+        )
+    if VECTOR_STORE_MODE != "embedded":
+        raise Exception(f"Unknown VECTOR_STORE_MODE '{VECTOR_STORE_MODE}' (expected 'embedded' or 'http')")
+    if int(os.getenv("WEB_CONCURRENCY", "1")) > 1:
+        print("Warning: the embedded vector store is not safe with several workers; use VECTOR_STORE_MODE=http")
+    return chromadb.PersistentClient(
+        path=CHROMA_DB_PATH,
+        settings=_client_settings()
+    )
 
 def init_db():
     """Initialize ChromaDB client and collection"""
+    with _init_lock:
+        return _init_db()
+
+def _init_db():
     global client, collection
     
-    # Create directory if it doesn't exist
+    # Create directory if it doesn't exist (also holds the registry and indexes in http mode)
     os.makedirs(CHROMA_DB_PATH, exist_ok=True)
     
     # Initialize ChromaDB client
-    client = chromadb.PersistentClient(
-        path=CHROMA_DB_PATH,
-        settings=Settings(anonymized_telemetry=False)
-    )
+    try:
+        new_client = create_client()
+        new_client.heartbeat()
+    except Exception as e:
+        if VECTOR_STORE_MODE == "http":
+            raise Exception(f"Could not reach the Chroma server at {CHROMA_SERVER_HOST}:{CHROMA_SERVER_HTTP_PORT}: {e}")
+        raise
     
     # Get or create collection
     try:
-        collection = client.get_collection(name=COLLECTION_NAME)
+        new_collection = new_client.get_collection(name=COLLECTION_NAME)
         print(f"Loaded existing collection: {COLLECTION_NAME}")
     except:
-        collection = client.create_collection(
+        # Another worker may be creating it at the same moment
+        new_collection = new_client.get_or_create_collection(
             name=COLLECTION_NAME,
             metadata={"hnsw:space": "cosine"}
         )
         print(f"Created new collection: {COLLECTION_NAME}")
     
+    # Published together, so other threads never see a client without its collection
+    client, collection = new_client, new_collection
     return collection
 
 def get_collection():
     """Get the ChromaDB collection"""
-    global collection
     if collection is None:
-        init_db()
+        with _init_lock:
+            if collection is None:
+                _init_db()
     return collection
 
 def get_client():
     """Get the ChromaDB client"""
-    global client
     if client is None:
-        init_db()
+        with _init_lock:
+            if client is None:
+                _init_db()
     return client
 
+
+async def run_db(func, *args, **kwargs):
+    """Run a blocking ChromaDB call in the bounded database executor"""
+    loop = asyncio.get_running_loop()
+    # Carry the request id, stage timer and profile capture over to the worker thread
+    context = contextvars.copy_context()
+    return await loop.run_in_executor(db_executor, functools.partial(context.run, profile_call, func, *args, **kwargs))
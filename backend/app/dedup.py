@@ -0,0 +1,252 @@
+"""
+Near-duplicate chunk detection with MinHash signatures and LSH banding
+"""
+import hashlib
+import os
+import re
+import sqlite3
+import threading
+import zlib
+from typing import Dict, Iterable, List, Optional, Set, Tuple
+import numpy as np
+from app.config import NEAR_DUP_ENABLED, NEAR_DUP_THRESHOLD, NEAR_DUP_INDEX_PATH
+from app.database import get_collection
+
+# Words per shingle
+SHINGLE_SIZE = 5
+# Signature length, split into LSH_BANDS bands of NUM_PERM // LSH_BANDS rows.
+# 16 bands of 8 rows make chunks with similarity >= 0.8 candidates with high probability
+NUM_PERM = 128
+LSH_BANDS = 16
+ROWS_PER_BAND = NUM_PERM // LSH_BANDS
+# Most candidates verified per lookup
+MAX_CANDIDATES = 50
+# Bumped whenever shingling changes; stored signatures of another version are recomputed
+SIGNATURE_VERSION = 2
+# "Page 3", "page 3 of 10", "Page 3/10": the only numbers that don't count
+_PAGE_NUMBER = re.compile(r"\bpage\s+\d+(?:\s*(?:of|/)\s*\d+)?\b")
+
+_MERSENNE_PRIME = np.uint64((1 << 61) - 1)
+_MAX_HASH = np.uint64(0xFFFFFFFF)
+# Fixed seed: signatures are persisted, so the permutations must never change
+_rng = np.random.RandomState(1)
+_PERM_A = _rng.randint(1, 1 << 31, size=NUM_PERM, dtype=np.int64).astype(np.uint64)
+_PERM_B = _rng.randint(0, 1 << 31, size=NUM_PERM, dtype=np.int64).astype(np.uint64)
+
+def _normalize(text: str) -> List[str]:
+    """
+    Words of a chunk, case-folded, with page numbers masked. Other numbers (part numbers,
+    dosages, section numbers, table values) are kept: chunks that differ in them differ
+    """
+    return _PAGE_NUMBER.sub("page 0", text.casefold()).split()
+
+def shingles(text: str) -> Set[str]:
+    """Overlapping SHINGLE_SIZE-word shingles of a chunk (the whole text if it is shorter)"""
+    words = _normalize(text)
+    if len(words) <= SHINGLE_SIZE:
+        return {" ".join(words)}
+    return {" ".join(words[i:i + SHINGLE_SIZE]) for i in range(len(words) - SHINGLE_SIZE + 1)}
+
+def minhash_signature(text: str) -> np.ndarray:
+    """MinHash signature (NUM_PERM uint32 values) of a chunk's shingle set"""
+    hashes = np.fromiter(
+        (zlib.crc32(shingle.encode("utf-8")) for shingle in shingles(text)),
+        dtype=np.uint64
+    )
+    permuted = (_PERM_A[:, None] * hashes[None, :] + _PERM_B[:, None]) % _MERSENNE_PRIME
+    return (permuted & _MAX_HASH).min(axis=1).astype(np.uint32)
+
+def estimated_similarity(a: np.ndarray, b: np.ndarray) -> float:
+    """Estimated Jaccard similarity of the shingle sets behind two signatures"""
+    return float(np.mean(a == b))
+
+def _band_keys(signature: np.ndarray) -> List[Tuple[int, int]]:
+    """(band, bucket) pairs; chunks sharing any of them are LSH candidates"""
+    bands = signature.reshape(LSH_BANDS, ROWS_PER_BAND)
+    return [
+        (band, int.from_bytes(hashlib.blake2b(rows.tobytes(), digest_size=8).digest(), "big", signed=True))
+        for band, rows in enumerate(bands)
+    ]
+
+class NearDuplicateIndex:
+    """
+    Persistent MinHash signatures and LSH buckets of stored chunks, keyed by chunk id.
+    Backed by SQLite in WAL mode so several worker processes can share it.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self._lock = threading.Lock()
+
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+
+        self._conn = sqlite3.connect(path, check_same_thread=False, timeout=30)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute(
+            """CREATE TABLE IF NOT EXISTS signatures (
+                chunk_id TEXT PRIMARY KEY,
+                signature BLOB NOT NULL
+            )"""
+        )
+        self._conn.execute(
+            """CREATE TABLE IF NOT EXISTS lsh_buckets (
+                band INTEGER NOT NULL,
+                bucket INTEGER NOT NULL,
+                chunk_id TEXT NOT NULL
+            )"""
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS idx_lsh_buckets ON lsh_buckets(band, bucket)")
+        self._conn.execute("CREATE INDEX IF NOT EXISTS idx_lsh_buckets_chunk ON lsh_buckets(chunk_id)")
+        self._conn.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)")
+        self._conn.commit()
+
+    def rebuild_if_outdated(self, collection, page_size: int = 1000) -> None:
+        """Recompute every stored signature from the collection if they were made with other shingling"""
+        with self._lock:
+            row = self._conn.execute("SELECT value FROM meta WHERE key = 'signature_version'").fetchone()
+        if row and int(row[0]) == SIGNATURE_VERSION:
+            return
+
+        with self._lock, self._conn:
+            self._conn.execute("DELETE FROM signatures")
+            self._conn.execute("DELETE FROM lsh_buckets")
+        if collection.count() > 0:
+            offset = 0
+            while True:
+                page = collection.get(include=["documents"], limit=page_size, offset=offset)
+                if not page["ids"]:
+                    break
+                self.add((chunk_id, minhash_signature(document or "")) for chunk_id, document in zip(page["ids"], page["documents"]))
+                offset += len(page["ids"])
+            print(f"Near-duplicate index rebuilt with {offset} chunks")
+
+        with self._lock, self._conn:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO meta (key, value) VALUES ('signature_version', ?)", (str(SIGNATURE_VERSION),)
+            )
+
+    def find(self, signature: np.ndarray, exclude: Optional[Set[str]] = None) -> Optional[str]:
+        """Id of a stored chunk at least NEAR_DUP_THRESHOLD similar to `signature`, or None"""
+        keys = _band_keys(signature)
+        placeholders = ",".join("(?, ?)" for _ in keys)
+        with self._lock:
+            rows = self._conn.execute(
+                f"SELECT DISTINCT chunk_id FROM lsh_buckets WHERE (band, bucket) IN (VALUES {placeholders}) LIMIT ?",
+                [value for key in keys for value in key] + [MAX_CANDIDATES + len(exclude or ())]
+            ).fetchall()
+        candidates = [row[0] for row in rows if not exclude or row[0] not in exclude][:MAX_CANDIDATES]
+        if not candidates:
+            return None
+
+        with self._lock:
+            rows = self._conn.execute(
+                f"SELECT chunk_id, signature FROM signatures WHERE chunk_id IN ({','.join('?' * len(candidates))})",
+                candidates
+            ).fetchall()
+        for chunk_id, blob in rows:
+            if estimated_similarity(signature, np.frombuffer(blob, dtype=np.uint32)) >= NEAR_DUP_THRESHOLD:
+                return chunk_id
+        return None
+
+    def add(self, items: Iterable[Tuple[str, np.ndarray]]) -> None:
+        """Index the signatures of stored chunks"""
+        items = list(items)
+        with self._lock, self._conn:
+            self._conn.executemany(
+                "INSERT OR REPLACE INTO signatures (chunk_id, signature) VALUES (?, ?)",
+                [(chunk_id, signature.tobytes()) for chunk_id, signature in items]
+            )
+            self._conn.executemany(
+                "INSERT INTO lsh_buckets (band, bucket, chunk_id) VALUES (?, ?, ?)",
+                [(band, bucket, chunk_id) for chunk_id, signature in items for band, bucket in _band_keys(signature)]
+            )
+
+    def remove(self, chunk_ids: List[str]) -> None:
+        """Forget deleted chunks"""
+        with self._lock, self._conn:
+            self._conn.executemany("DELETE FROM signatures WHERE chunk_id = ?", [(i,) for i in chunk_ids])
+            self._conn.executemany("DELETE FROM lsh_buckets WHERE chunk_id = ?", [(i,) for i in chunk_ids])
+
+class NearDuplicateFilter:
+    """
+    Filter for one ingest: drops chunks that are near-duplicates of stored chunks or of
+    earlier chunks of the same file, and collects signatures of the kept ones so they
+    can be indexed once the file is committed. A chunk dropped for matching another
+    file's chunk is kept in `borrowed` (by the id of the stored chunk standing in for
+    it), so the file can reference that chunk and take it over if its owner goes away.
+    """
+
+    def __init__(self, index: Optional[NearDuplicateIndex], exclude: Optional[Set[str]] = None):
+        self.index = index
+        # Stored chunk ids not to match against (e.g. the version of the file being replaced)
+        self.exclude = exclude or set()
+        self.removed = 0
+        self.borrowed: Dict[str, Dict] = {}
+        self.signatures: Dict[str, np.ndarray] = {}
+        self._local_signatures: List[np.ndarray] = []
+        self._local_buckets: Dict[Tuple[int, int], List[int]] = {}
+
+    def _find_local(self, signature: np.ndarray) -> bool:
+        seen: Set[int] = set()
+        for key in _band_keys(signature):
+            for position in self._local_buckets.get(key, ()):
+                if position not in seen:
+                    seen.add(position)
+                    if estimated_similarity(signature, self._local_signatures[position]) >= NEAR_DUP_THRESHOLD:
+                        return True
+        return False
+
+    def remember(self, chunk_id: str, text: str, index: bool = True) -> None:
+        """Count a chunk as part of this file without checking it, e.g. one kept from the previous version"""
+        if self.index is None:
+            return
+        self._remember(chunk_id, minhash_signature(text), index)
+
+    def _remember(self, chunk_id: str, signature: np.ndarray, index: bool) -> None:
+        position = len(self._local_signatures)
+        self._local_signatures.append(signature)
+        for key in _band_keys(signature):
+            self._local_buckets.setdefault(key, []).append(position)
+        if index:
+            self.signatures[chunk_id] = signature
+
+    def admit(self, chunk: Dict) -> bool:
+        """False if the chunk is a near-duplicate and should be dropped"""
+        if self.index is None:
+            return True
+        signature = minhash_signature(chunk["text"])
+        if self._find_local(signature):
+            self.removed += 1
+            return False
+        match = self.index.find(signature, exclude=self.exclude)
+        if match:
+            self.removed += 1
+            self.borrowed.setdefault(match, chunk)
+            return False
+        self._remember(chunk["id"], signature, index=True)
+        return True
+
+    def commit(self, chunk_ids: Iterable[str]) -> None:
+        """Index signatures of the given chunks once they are stored"""
+        if self.index is None:
+            return
+        self.index.add((chunk_id, self.signatures[chunk_id]) for chunk_id in chunk_ids if chunk_id in self.signatures)
+
+_index: Optional[NearDuplicateIndex] = None
+_index_lock = threading.Lock()
+
+def get_near_duplicate_index() -> Optional[NearDuplicateIndex]:
+    """Get the near-duplicate index (brought up to the current signature version on first use), or None if disabled"""
+    global _index
+    if not NEAR_DUP_ENABLED:
+        return None
+    if _index is None:
+        with _index_lock:
+            if _index is None:
+                index = NearDuplicateIndex(NEAR_DUP_INDEX_PATH)
+                index.rebuild_if_outdated(get_collection())
+                _index = index
+    return _index
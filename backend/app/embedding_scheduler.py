@@ -0,0 +1,217 @@
+"""
+Rate-limit-aware, batched embedding scheduler for ingestion
+"""
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Dict, List, Optional
+from app.config import (
+    EMBED_TPM_LIMIT,
+    EMBED_RPM_LIMIT,
+    EMBED_QUOTA_WORKERS,
+    EMBED_MAX_BATCH_TOKENS,
+    EMBED_MIN_BATCH_TOKENS,
+    EMBED_MAX_BATCH_SIZE,
+    EMBED_CONCURRENCY,
+    EMBED_MAX_RETRIES,
+    EMBED_BACKOFF_BASE,
+    EMBED_BACKOFF_MAX
+)
+from app.tokens import count_tokens
+from app.metrics import TOKENS
+
+class TokenBucket:
+    """
+    Thread-safe token bucket refilled continuously at `rate_per_minute`.
+    The bucket holds at most `capacity`, which bounds bursts.
+    A rate of 0 disables limiting.
+    """
+
+    def __init__(self, rate_per_minute: float, capacity: Optional[float] = None):
+        self.rate = rate_per_minute / 60.0
+        self.capacity = capacity if capacity is not None else rate_per_minute
+        self._available = self.capacity
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        self._available = min(self.capacity, self._available + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def acquire(self, amount: float) -> float:
+        """Block until `amount` can be taken. Returns the time spent waiting"""
+        if self.rate <= 0:
+            return 0.0
+        # A single request larger than the bucket can never fit; let it through once the bucket is full
+        amount = min(amount, self.capacity)
+        waited = 0.0
+        while True:
+            with self._lock:
+                self._refill()
+                if self._available >= amount:
+                    self._available -= amount
+                    return waited
+                delay = (amount - self._available) / self.rate
+            time.sleep(delay)
+            waited += delay
+
+    def drain(self):
+        """Empty the bucket, e.g. after the server reports we are over quota"""
+        with self._lock:
+            self._refill()
+            self._available = 0.0
+
+def _is_rate_limit(error: Exception) -> bool:
+    import openai
+    return isinstance(error, openai.RateLimitError) or getattr(error, "status_code", None) == 429
+
+def _is_retryable(error: Exception) -> bool:
+    if _is_rate_limit(error):
+        return True
+    import openai
+    if isinstance(error, (openai.APITimeoutError, openai.APIConnectionError, openai.InternalServerError)):
+        return True
+    return getattr(error, "status_code", None) in (500, 502, 503, 504)
+
+def _retry_after(error: Exception) -> Optional[float]:
+    """Seconds the server asked us to wait, if it said"""
+    response = getattr(error, "response", None)
+    headers = getattr(response, "headers", None) or {}
+    for header in ("retry-after-ms", "retry-after"):
+        value = headers.get(header)
+        if value:
+            try:
+                seconds = float(value)
+                return seconds / 1000.0 if header == "retry-after-ms" else seconds
+            except ValueError:
+                pass
+    return None
+
+class EmbeddingScheduler:
+    """
+    Splits texts into token-sized batches and embeds them concurrently, staying under
+    the deployment's tokens-per-minute and requests-per-minute quotas.
+
+    Batch size adapts: it is halved when the service rate-limits us and grows back
+    gradually after successful calls. Rate-limited and transient failures are retried
+    with exponential backoff and full jitter, honouring Retry-After when present.
+
+    `embed_fn` must send each batch as one request and must not retry on its own,
+    otherwise the batches and retries here are not the ones the service sees.
+    The quotas are split evenly between the EMBED_QUOTA_WORKERS processes.
+    """
+
+    def __init__(self, embed_fn: Callable[[List[str]], List[List[float]]]):
+        self.embed_fn = embed_fn
+        self.tpm_limit = EMBED_TPM_LIMIT / EMBED_QUOTA_WORKERS
+        self.rpm_limit = EMBED_RPM_LIMIT / EMBED_QUOTA_WORKERS
+        # Allow bursts of ~10 seconds of quota, which is the window Azure OpenAI enforces on
+        self.tpm_bucket = TokenBucket(self.tpm_limit, self.tpm_limit / 6 if self.tpm_limit else None)
+        self.rpm_bucket = TokenBucket(self.rpm_limit, max(1.0, self.rpm_limit / 6) if self.rpm_limit else None)
+        self.batch_tokens = EMBED_MAX_BATCH_TOKENS
+        self._executor = ThreadPoolExecutor(max_workers=EMBED_CONCURRENCY, thread_name_prefix="embed")
+        self._lock = threading.Lock()
+        self._successes = 0
+        self.stats_counters = {
+            "requests": 0,
+            "texts": 0,
+            "tokens": 0,
+            "rate_limited": 0,
+            "retries": 0,
+            "throttled_seconds": 0.0
+        }
+
+    def _count(self, **increments):
+        with self._lock:
+            for key, value in increments.items():
+                self.stats_counters[key] += value
+
+    def _make_batches(self, token_counts: List[int]) -> List[List[int]]:
+        """Group text indices into batches under the current token target and size cap"""
+        batches = []
+        current: List[int] = []
+        current_tokens = 0
+        limit = self.batch_tokens
+        for i, tokens in enumerate(token_counts):
+            if current and (current_tokens + tokens > limit or len(current) >= EMBED_MAX_BATCH_SIZE):
+                batches.append(current)
+                current, current_tokens = [], 0
+            current.append(i)
+            current_tokens += tokens
+        if current:
+            batches.append(current)
+        return batches
+
+    def _on_success(self):
+        with self._lock:
+            self._successes += 1
+            if self._successes >= 4 and self.batch_tokens < EMBED_MAX_BATCH_TOKENS:
+                self.batch_tokens = min(EMBED_MAX_BATCH_TOKENS, int(self.batch_tokens * 1.5))
+                self._successes = 0
+
+    def _on_rate_limit(self):
+        with self._lock:
+            self._successes = 0
+            self.batch_tokens = max(EMBED_MIN_BATCH_TOKENS, self.batch_tokens // 2)
+        self.tpm_bucket.drain()
+        self.rpm_bucket.drain()
+
+    def _embed_batch(self, texts: List[str], tokens: int) -> List[List[float]]:
+        attempt = 0
+        while True:
+            waited = self.rpm_bucket.acquire(1) + self.tpm_bucket.acquire(tokens)
+            self._count(requests=1, throttled_seconds=waited)
+            try:
+                vectors = self.embed_fn(texts)
+                self._count(texts=len(texts), tokens=tokens)
+                TOKENS.labels("embedding").inc(tokens)
+                self._on_success()
+                return vectors
+            except Exception as e:
+                if not _is_retryable(e) or attempt >= EMBED_MAX_RETRIES:
+                    raise
+                if _is_rate_limit(e):
+                    self._count(rate_limited=1)
+                    self._on_rate_limit()
+                delay = _retry_after(e)
+                if delay is None:
+                    delay = random.uniform(0, min(EMBED_BACKOFF_MAX, EMBED_BACKOFF_BASE * (2 ** attempt)))
+                attempt += 1
+                self._count(retries=1)
+                time.sleep(delay)
+
+    def embed(self, texts: List[str]) -> List[List[float]]:
+        """Embed texts, returning vectors in input order"""
+        if not texts:
+            return []
+        token_counts = [count_tokens(text) for text in texts]
+        batches = self._make_batches(token_counts)
+        futures = [
+            self._executor.submit(
+                self._embed_batch,
+                [texts[i] for i in batch],
+                sum(token_counts[i] for i in batch)
+            )
+            for batch in batches
+        ]
+        vectors: List[Optional[List[float]]] = [None] * len(texts)
+        for batch, future in zip(batches, futures):
+            for i, vector in zip(batch, future.result()):
+                vectors[i] = vector
+        return vectors
+
+    def stats(self) -> Dict:
+        """Throughput and throttling counters"""
+        with self._lock:
+            return {
+                **self.stats_counters,
+                "batch_tokens": self.batch_tokens,
+                "tpm_limit": EMBED_TPM_LIMIT,
+                "rpm_limit": EMBED_RPM_LIMIT,
+                "quota_workers": EMBED_QUOTA_WORKERS,
+                "process_tpm_limit": self.tpm_limit,
+                "process_rpm_limit": self.rpm_limit,
+                "concurrency": EMBED_CONCURRENCY
+            }
@@ -1,21 +1,136 @@
 """
-Embedding generation using OpenAI/Azure OpenAI
+Embedding generation using OpenAI/Azure OpenAI or a local CPU model
 """
-from langchain_openai import AzureOpenAIEmbeddings, OpenAIEmbeddings
-from app.config import USE_AZURE, AZURE_OPENAI_ENDPOINT, OPENAI_API_KEY_TO_USE, API_VERSION, EMBEDDING_MODEL
+import threading
+from typing import List, Optional, Tuple
+from app.config import (
+    USE_AZURE,
+    AZURE_OPENAI_ENDPOINT,
+    OPENAI_API_KEY_TO_USE,
+    API_VERSION,
+    EMBEDDING_MODEL,
+    EMBEDDING_PROVIDER,
+    LOCAL_EMBEDDING_MODEL,
+    LOCAL_EMBEDDING_DIMENSION,
+    LOCAL_EMBEDDING_BATCH_SIZE
+)
+from app.cache import get_embedding_cache, embedding_cache_key
+from app.clients import get_openai_client, get_async_openai_client
+from app.embedding_scheduler import EmbeddingScheduler
 
-def get_embeddings():
-    """Get embeddings model"""
+# Vector sizes of the OpenAI embedding models, so startup can check the store without an API call
+OPENAI_EMBEDDING_DIMENSIONS = {
+    "text-embedding-ada-002": 1536,
+    "text-embedding-3-small": 1536,
+    "text-embedding-3-large": 3072
+}
+
+_embeddings = None
+_embeddings_lock = threading.Lock()
+_scheduler = None
+
+def embedding_model_id() -> str:
+    """Identifies the configured embedding model; embeddings from different models never mix"""
+    if EMBEDDING_PROVIDER == "local":
+        if LOCAL_EMBEDDING_MODEL == "hashing":
+            return f"local:hashing:{LOCAL_EMBEDDING_DIMENSION}"
+        return f"local:{LOCAL_EMBEDDING_MODEL}"
+    return EMBEDDING_MODEL
+
+def _create_embeddings():
+    """Build the configured embeddings model (OpenAI ones are wired to the shared, pooled clients)"""
+    # Model libraries are slow to import, so they wait until the model is built
+    if EMBEDDING_PROVIDER == "local":
+        from app.local_embeddings import create_local_embeddings
+        return create_local_embeddings(LOCAL_EMBEDDING_MODEL, LOCAL_EMBEDDING_DIMENSION, LOCAL_EMBEDDING_BATCH_SIZE)
+    if EMBEDDING_PROVIDER != "openai":
+        raise Exception(f"Unknown EMBEDDING_PROVIDER '{EMBEDDING_PROVIDER}' (expected 'openai' or 'local')")
+    from langchain_openai import AzureOpenAIEmbeddings, OpenAIEmbeddings
+    
     if USE_AZURE:
-        return AzureOpenAIEmbeddings(
+        embeddings = AzureOpenAIEmbeddings(
             azure_endpoint=AZURE_OPENAI_ENDPOINT,
             api_key=OPENAI_API_KEY_TO_USE,
             api_version=API_VERSION,
             model=EMBEDDING_MODEL
         )
     else:
-        return OpenAIEmbeddings(
+        embeddings = OpenAIEmbeddings(
             openai_api_key=OPENAI_API_KEY_TO_USE,
             model=EMBEDDING_MODEL
         )
+    deployment = EMBEDDING_MODEL if USE_AZURE else None
+    embeddings.client = get_openai_client(deployment).embeddings
+    embeddings.async_client = get_async_openai_client(deployment).embeddings
+    return embeddings
+
+def get_embeddings():
+    """Get embeddings model"""
+    global _embeddings
+    if _embeddings is None:
+        with _embeddings_lock:
+            if _embeddings is None:
+                _embeddings = _create_embeddings()
+    return _embeddings
+
+def get_embedding_dimension() -> int:
+    """Vector size of the configured embedding model"""
+    if EMBEDDING_PROVIDER == "openai" and EMBEDDING_MODEL in OPENAI_EMBEDDING_DIMENSIONS:
+        return OPENAI_EMBEDDING_DIMENSIONS[EMBEDDING_MODEL]
+    embeddings = get_embeddings()
+    dimension: Optional[int] = getattr(embeddings, "dimension", None)
+    return dimension if dimension else len(embeddings.embed_query("dimension check"))
+
+def _embed_uncached(texts: List[str]) -> List[List[float]]:
+    """Embed texts with the configured provider; API calls go through the rate-limit-aware scheduler"""
+    if EMBEDDING_PROVIDER == "local":
+        # In-process models batch internally and have no quota to respect
+        return get_embeddings().embed_documents(texts)
+    return get_embedding_scheduler().embed(texts)
+
+def _embed_request(texts: List[str]) -> List[List[float]]:
+    """
+    Embed one scheduled batch in exactly one API request. The client's own retries are
+    off and nothing re-batches the texts, so the scheduler sees every rate limit
+    """
+    deployment = EMBEDDING_MODEL if USE_AZURE else None
+    client = get_openai_client(deployment).with_options(max_retries=0)
+    response = client.embeddings.create(input=texts, model=EMBEDDING_MODEL)
+    return [item.embedding for item in sorted(response.data, key=lambda item: item.index)]
+
+def get_embedding_scheduler() -> EmbeddingScheduler:
+    """Get the process-wide embedding scheduler (shared so all ingests respect one quota)"""
+    global _scheduler
+    if _scheduler is None:
+        with _embeddings_lock:
+            if _scheduler is None:
+                _scheduler = EmbeddingScheduler(_embed_request)
+    return _scheduler
+
+def embed_documents_cached(texts: List[str]) -> Tuple[List[List[float]], int]:
+    """
+    Embed document texts, only calling the embedding model for texts not in the cache.
+    Returns the embeddings (in input order) and the number of cache hits.
+    """
+    cache = get_embedding_cache()
+    if cache is None:
+        return _embed_uncached(texts), 0
+
+    model_id = embedding_model_id()
+    keys = [embedding_cache_key(text, model_id) for text in texts]
+    cached = cache.get_many(keys)
+
+    # Embed each distinct missing text once, even if it repeats within the document
+    missing = {}
+    for key, text in zip(keys, texts):
+        if key not in cached and key not in missing:
+            missing[key] = text
+
+    if missing:
+        vectors = _embed_uncached(list(missing.values()))
+        fresh = dict(zip(missing.keys(), vectors))
+        cache.put_many(fresh)
+        cached.update(fresh)
 
+    hits = sum(1 for key in keys if key not in missing)
+    return [cached[key] for key in keys], hits
@@ -0,0 +1,515 @@
+"""
+Persistent registry of ingested files, kept in sync with the ChromaDB collection
+"""
+import json
+import os
+import socket
+import sqlite3
+import threading
+import time
+from typing import Dict, List, Optional, Set, Tuple
+from app.config import FILE_REGISTRY_PATH
+from app.database import get_collection
+
+# Fields returned by list/info; chunk ids are only needed internally
+SUMMARY_FIELDS = ("filename", "content_hash", "chunk_count", "byte_size", "ingested_at", "alias_of")
+
+# Summaries of aliases are read through the file they point to
+SUMMARY_QUERY = """SELECT f.filename, f.ingested_at, f.alias_of,
+    COALESCE(t.content_hash, f.content_hash) AS content_hash,
+    COALESCE(t.chunk_count, f.chunk_count) AS chunk_count,
+    COALESCE(t.byte_size, f.byte_size) AS byte_size
+    FROM files f LEFT JOIN files t ON t.filename = f.alias_of"""
+
+class FileRegistry:
+    """
+    One row per filename with its content hash, chunk ids, chunk count, byte size and
+    ingest time, so listing, info and delete don't have to scan the whole collection.
+    A row can instead be an alias of another file with identical content, sharing its chunks.
+    Backed by SQLite in WAL mode so several worker processes can share it. Within a process
+    all threads share one connection, so reads take the same lock as write transactions
+    and never see another thread's transaction half done.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self._lock = threading.Lock()
+
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+
+        self._conn = sqlite3.connect(path, check_same_thread=False, timeout=30)
+        self._conn.row_factory = sqlite3.Row
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            """CREATE TABLE IF NOT EXISTS files (
+                filename TEXT PRIMARY KEY,
+                content_hash TEXT,
+                chunk_ids TEXT NOT NULL,
+                chunk_count INTEGER NOT NULL,
+                byte_size INTEGER,
+                ingested_at REAL NOT NULL
+            )"""
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS idx_files_content_hash ON files(content_hash)")
+        self._conn.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)")
+        # Chunks that are in the collection but must not show up in search: chunks of a version
+        # that is still being written ('staged') and chunks of a replaced version ('retired')
+        self._conn.execute(
+            """CREATE TABLE IF NOT EXISTS hidden_chunks (
+                chunk_id TEXT PRIMARY KEY,
+                reason TEXT NOT NULL,
+                created_at REAL NOT NULL
+            )"""
+        )
+        # Content hash of each chunk, parallel to chunk_ids (added after the first release)
+        columns = [row["name"] for row in self._conn.execute("PRAGMA table_info(files)")]
+        if "chunk_hashes" not in columns:
+            self._conn.execute("ALTER TABLE files ADD COLUMN chunk_hashes TEXT")
+        # Filename whose chunks this entry shares, for duplicate uploads under another name
+        if "alias_of" not in columns:
+            self._conn.execute("ALTER TABLE files ADD COLUMN alias_of TEXT")
+        self._conn.execute("CREATE INDEX IF NOT EXISTS idx_files_alias_of ON files(alias_of)")
+        # Stored chunks of other files that stand in for near-duplicate chunks of `filename`,
+        # with where the dropped chunk was in `filename`, so the file can take them over
+        self._conn.execute(
+            """CREATE TABLE IF NOT EXISTS borrowed_chunks (
+                filename TEXT NOT NULL,
+                chunk_id TEXT NOT NULL,
+                chunk_index INTEGER,
+                page INTEGER,
+                page_end INTEGER,
+                created_at REAL NOT NULL,
+                PRIMARY KEY (filename, chunk_id)
+            )"""
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS idx_borrowed_chunks_chunk ON borrowed_chunks(chunk_id)")
+        # File whose write hid each chunk and the process that did it ("host:pid"), so a purge of
+        # leftovers can check that nobody is still writing that file
+        hidden_columns = [row["name"] for row in self._conn.execute("PRAGMA table_info(hidden_chunks)")]
+        if "filename" not in hidden_columns:
+            self._conn.execute("ALTER TABLE hidden_chunks ADD COLUMN filename TEXT")
+        if "owner" not in hidden_columns:
+            self._conn.execute("ALTER TABLE hidden_chunks ADD COLUMN owner TEXT")
+        # Which files hold each chunk id, mirroring files.chunk_ids, so a chunk id is looked up by key
+        # (added after the first release: built once from the files table)
+        self._conn.execute(
+            """CREATE TABLE IF NOT EXISTS chunk_owners (
+                chunk_id TEXT NOT NULL,
+                filename TEXT NOT NULL,
+                PRIMARY KEY (chunk_id, filename)
+            ) WITHOUT ROWID"""
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS idx_chunk_owners_filename ON chunk_owners(filename)")
+        if self._conn.execute("SELECT 1 FROM meta WHERE key = 'chunk_owners_built'").fetchone() is None:
+            self._build_chunk_owners()
+            self._conn.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('chunk_owners_built', '1')")
+        self._conn.commit()
+        self._owner = f"{socket.gethostname()}:{os.getpid()}"
+
+    @staticmethod
+    def _summary(row: sqlite3.Row) -> Dict:
+        return {field: row[field] for field in SUMMARY_FIELDS}
+
+    def _build_chunk_owners(self) -> None:
+        """Fill chunk_owners from files.chunk_ids (one scan, for rows written without it)"""
+        self._conn.execute(
+            """INSERT OR IGNORE INTO chunk_owners (chunk_id, filename)
+            SELECT j.value, files.filename FROM files, json_each(files.chunk_ids) AS j"""
+        )
+
+    def _add_owned(self, filename: str, chunk_ids: List[str]) -> None:
+        self._conn.executemany(
+            "INSERT OR IGNORE INTO chunk_owners (chunk_id, filename) VALUES (?, ?)",
+            [(chunk_id, filename) for chunk_id in chunk_ids]
+        )
+
+    def _write_file(self, filename: str, chunk_ids: List[str], chunk_hashes: List[Optional[str]],
+                    content_hash: Optional[str], byte_size: Optional[int]) -> None:
+        self._conn.execute(
+            """INSERT OR REPLACE INTO files
+            (filename, content_hash, chunk_ids, chunk_hashes, chunk_count, byte_size, ingested_at)
+            VALUES (?, ?, ?, ?, ?, ?, ?)""",
+            (filename, content_hash, json.dumps(chunk_ids), json.dumps(chunk_hashes),
+             len(chunk_ids), byte_size, time.time())
+        )
+        self._conn.execute("DELETE FROM chunk_owners WHERE filename = ?", (filename,))
+        self._add_owned(filename, chunk_ids)
+
+    def _delete_file(self, filename: str) -> None:
+        self._conn.execute("DELETE FROM files WHERE filename = ?", (filename,))
+        self._conn.execute("DELETE FROM chunk_owners WHERE filename = ?", (filename,))
+
+    def _bump_version(self) -> None:
+        self._conn.execute(
+            """INSERT INTO meta (key, value) VALUES ('corpus_version', '1')
+            ON CONFLICT(key) DO UPDATE SET value = CAST(value AS INTEGER) + 1"""
+        )
+
+    def corpus_version(self) -> int:
+        """Counter bumped by every change to the stored files or what search can see (upload, update, delete)"""
+        with self._lock:
+            row = self._conn.execute("SELECT value FROM meta WHERE key = 'corpus_version'").fetchone()
+        return int(row["value"]) if row else 0
+
+    def _unhide(self, chunk_ids: List[str]) -> None:
+        self._conn.executemany("DELETE FROM hidden_chunks WHERE chunk_id = ?", [(i,) for i in chunk_ids])
+
+    def _hide(self, chunk_ids: List[str], reason: str, filename: str) -> None:
+        now = time.time()
+        self._conn.executemany(
+            """INSERT OR REPLACE INTO hidden_chunks (chunk_id, reason, created_at, filename, owner)
+            VALUES (?, ?, ?, ?, ?)""",
+            [(i, reason, now, filename, self._owner) for i in chunk_ids]
+        )
+
+    def _borrow(self, filename: str, borrowed: Dict[str, Dict], own_ids: Set[str]) -> List[str]:
+        """
+        Record that `filename` relies on these stored chunks of other files (chunk id ->
+        chunk_index/page/page_end of the chunk it dropped). Returns the ids no file holds
+        any more (deleted since they were matched); those are not recorded.
+        """
+        wanted = [chunk_id for chunk_id in borrowed if chunk_id not in own_ids]
+        live: Set[str] = set()
+        for start in range(0, len(wanted), 500):
+            batch = wanted[start:start + 500]
+            rows = self._conn.execute(
+                f"SELECT DISTINCT chunk_id FROM chunk_owners WHERE chunk_id IN ({','.join('?' * len(batch))})",
+                batch
+            ).fetchall()
+            live.update(row[0] for row in rows)
+        now = time.time()
+        self._conn.executemany(
+            """INSERT OR REPLACE INTO borrowed_chunks (filename, chunk_id, chunk_index, page, page_end, created_at)
+            VALUES (?, ?, ?, ?, ?, ?)""",
+            [(filename, chunk_id, borrowed[chunk_id].get("chunk_index"), borrowed[chunk_id].get("page"),
+              borrowed[chunk_id].get("page_end"), now) for chunk_id in wanted if chunk_id in live]
+        )
+        return [chunk_id for chunk_id in wanted if chunk_id not in live]
+
+    def _hand_over_borrowed(self, filename: str, chunk_ids: List[str], hashes: Dict[str, Optional[str]]) -> Dict[str, Dict]:
+        """
+        Give chunks of `filename` that is dropping them to the oldest other file borrowing
+        each one, instead of letting them be deleted. Returns chunk id -> the metadata the
+        chunk now needs (its new file and its position there)
+        """
+        handed: Dict[str, Dict] = {}
+        for start in range(0, len(chunk_ids), 500):
+            batch = chunk_ids[start:start + 500]
+            rows = self._conn.execute(
+                f"""SELECT filename, chunk_id, chunk_index, page, page_end FROM borrowed_chunks
+                WHERE chunk_id IN ({','.join('?' * len(batch))}) AND filename != ? ORDER BY created_at""",
+                batch + [filename]
+            ).fetchall()
+            for row in rows:
+                if row["chunk_id"] not in handed:
+                    handed[row["chunk_id"]] = {
+                        "filename": row["filename"], "source": row["filename"], "chunk_index": row["chunk_index"],
+                        "page": row["page"], "page_end": row["page_end"]
+                    }
+        by_owner: Dict[str, List[str]] = {}
+        for chunk_id, metadata in handed.items():
+            by_owner.setdefault(metadata["filename"], []).append(chunk_id)
+        for owner, ids in by_owner.items():
+            row = self._conn.execute(
+                "SELECT chunk_ids, chunk_hashes FROM files WHERE filename = ?", (owner,)
+            ).fetchone()
+            owner_ids = json.loads(row["chunk_ids"])
+            owner_hashes = self._hashes_of(row, len(owner_ids))
+            self._conn.execute(
+                "UPDATE files SET chunk_ids = ?, chunk_hashes = ?, chunk_count = ? WHERE filename = ?",
+                (json.dumps(owner_ids + ids), json.dumps(owner_hashes + [hashes.get(i) for i in ids]),
+                 len(owner_ids) + len(ids), owner)
+            )
+            self._add_owned(owner, ids)
+            self._conn.executemany(
+                "DELETE FROM borrowed_chunks WHERE filename = ? AND chunk_id = ?", [(owner, i) for i in ids]
+            )
+        return handed
+
+    def add_chunks(self, filename: str, chunk_ids: List[str], content_hash: Optional[str],
+                   byte_size: Optional[int], chunk_hashes: Optional[List[str]] = None,
+                   borrowed: Optional[Dict[str, Dict]] = None) -> List[str]:
+        """
+        Record chunks written for a file and make them visible to search. Uploading an
+        existing filename again adds its chunks to the same entry, matching what is
+        stored in the collection. `borrowed` are stored chunks standing in for chunks of
+        this file dropped as near-duplicates (see _borrow). Returns the borrowed ids that
+        are gone, whose content the caller has to store itself.
+        """
+        chunk_hashes = list(chunk_hashes) if chunk_hashes is not None else [None] * len(chunk_ids)
+        with self._lock, self._conn:
+            # Write-lock first, so no other worker deletes a borrowed chunk between the check and the commit
+            self._conn.execute("BEGIN IMMEDIATE")
+            row = self._conn.execute(
+                "SELECT chunk_ids, chunk_hashes FROM files WHERE filename = ?", (filename,)
+            ).fetchone()
+            old_ids = json.loads(row["chunk_ids"]) if row else []
+            old_hashes = self._hashes_of(row, len(old_ids))
+            self._write_file(filename, old_ids + list(chunk_ids), old_hashes + chunk_hashes, content_hash, byte_size)
+            self._unhide(chunk_ids)
+            missing = self._borrow(filename, borrowed or {}, set(old_ids) | set(chunk_ids))
+            self._bump_version()
+        return missing
+
+    def replace_chunks(self, filename: str, chunk_ids: List[str], chunk_hashes: List[str],
+                       content_hash: Optional[str], byte_size: Optional[int], retired_ids: List[str],
+                       keep_for_aliases: bool = False,
+                       borrowed: Optional[Dict[str, Dict]] = None) -> Tuple[Optional[str], Dict[str, Dict], List[str]]:
+        """
+        Swap a file to a new version in one transaction: its new chunks become visible
+        and `retired_ids` (chunks only the old version used) are hidden until deleted.
+        Retired chunks other files borrow are handed to them instead (see _hand_over_borrowed).
+        With keep_for_aliases, a file that has aliases hands its old version to the oldest
+        alias instead (the other aliases then point to it), since the aliases were uploaded
+        as the old content; nothing is retired then.
+        Returns (alias that took the old version or None, handed-over chunks, borrowed ids that are gone)
+        """
+        with self._lock, self._conn:
+            self._conn.execute("BEGIN IMMEDIATE")
+            row = self._conn.execute(
+                "SELECT chunk_ids, chunk_hashes FROM files WHERE filename = ?", (filename,)
+            ).fetchone()
+            old_ids = json.loads(row["chunk_ids"]) if row else []
+            old_hashes = dict(zip(old_ids, self._hashes_of(row, len(old_ids))))
+            new_owner = self._hand_to_oldest_alias(filename) if keep_for_aliases else None
+            handed: Dict[str, Dict] = {}
+            if new_owner is None:
+                # The old version's references go with it
+                self._conn.execute("DELETE FROM borrowed_chunks WHERE filename = ?", (filename,))
+                handed = self._hand_over_borrowed(filename, retired_ids, old_hashes)
+            self._write_file(filename, list(chunk_ids), list(chunk_hashes), content_hash, byte_size)
+            self._unhide(chunk_ids)
+            if new_owner is None:
+                self._hide([i for i in retired_ids if i not in handed], "retired", filename)
+            missing = self._borrow(filename, borrowed or {}, set(chunk_ids))
+            self._bump_version()
+        return new_owner, handed, missing
+
+    def retire_file(self, filename: str) -> Optional[Tuple[List[str], Dict[str, Dict]]]:
+        """
+        Remove a file and hide its chunks in one transaction. Chunks other files borrow are
+        handed to them instead. Returns (ids of the hidden chunks, handed-over chunks), or None
+        """
+        with self._lock, self._conn:
+            row = self._conn.execute(
+                "SELECT chunk_ids, chunk_hashes FROM files WHERE filename = ?", (filename,)
+            ).fetchone()
+            if row is None:
+                return None
+            chunk_ids = json.loads(row["chunk_ids"])
+            hashes = dict(zip(chunk_ids, self._hashes_of(row, len(chunk_ids))))
+            self._conn.execute("DELETE FROM borrowed_chunks WHERE filename = ?", (filename,))
+            handed = self._hand_over_borrowed(filename, chunk_ids, hashes)
+            self._delete_file(filename)
+            retired = [chunk_id for chunk_id in chunk_ids if chunk_id not in handed]
+            self._hide(retired, "retired", filename)
+            self._bump_version()
+        return retired, handed
+
+    def stage_chunks(self, filename: str, chunk_ids: List[str]) -> None:
+        """Hide chunks of `filename` that are about to be written until their version is committed"""
+        with self._lock, self._conn:
+            self._hide(chunk_ids, "staged", filename)
+
+    def forget_hidden(self, chunk_ids: List[str]) -> None:
+        """Drop hidden markers once the chunks are gone from the collection"""
+        with self._lock, self._conn:
+            self._unhide(chunk_ids)
+
+    def hidden_count(self) -> int:
+        with self._lock:
+            return self._conn.execute("SELECT COUNT(*) FROM hidden_chunks").fetchone()[0]
+
+    def hidden_among(self, chunk_ids: List[str]) -> Set[str]:
+        """Which of the given chunk ids are hidden from search"""
+        if not chunk_ids:
+            return set()
+        placeholders = ",".join("?" * len(chunk_ids))
+        with self._lock:
+            rows = self._conn.execute(
+                f"SELECT chunk_id FROM hidden_chunks WHERE chunk_id IN ({placeholders})", list(chunk_ids)
+            ).fetchall()
+        return {row["chunk_id"] for row in rows}
+
+    def stale_hidden_files(self, older_than: float) -> List[Optional[str]]:
+        """Files with chunks hidden more than `older_than` seconds ago (None for chunks marked before files were recorded)"""
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT DISTINCT filename FROM hidden_chunks WHERE created_at < ?", (time.time() - older_than,)
+            ).fetchall()
+        return [row["filename"] for row in rows]
+
+    def stale_hidden(self, older_than: float, filename: Optional[str]) -> List[str]:
+        """Chunk ids of `filename` hidden more than `older_than` seconds ago (left behind by a crash)"""
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT chunk_id FROM hidden_chunks WHERE created_at < ? AND filename IS ?",
+                (time.time() - older_than, filename)
+            ).fetchall()
+        return [row["chunk_id"] for row in rows]
+
+    def get(self, filename: str) -> Optional[Dict]:
+        """Summary of one file, or None"""
+        with self._lock:
+            row = self._conn.execute(f"{SUMMARY_QUERY} WHERE f.filename = ?", (filename,)).fetchone()
+        return self._summary(row) if row else None
+
+    def find_by_hash(self, content_hash: str) -> Optional[str]:
+        """Name of a stored file (not an alias) with this content hash, or None"""
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT filename FROM files WHERE content_hash = ? AND alias_of IS NULL ORDER BY ingested_at LIMIT 1",
+                (content_hash,)
+            ).fetchone()
+        return row["filename"] if row else None
+
+    def has_aliases(self, filename: str) -> bool:
+        with self._lock:
+            row = self._conn.execute("SELECT 1 FROM files WHERE alias_of = ? LIMIT 1", (filename,)).fetchone()
+        return row is not None
+
+    def add_alias(self, filename: str, target: str) -> None:
+        """Register `filename` as another name for the stored file `target`"""
+        with self._lock, self._conn:
+            self._conn.execute(
+                """INSERT OR REPLACE INTO files (filename, content_hash, chunk_ids, chunk_count, byte_size, ingested_at, alias_of)
+                VALUES (?, NULL, '[]', 0, NULL, ?, ?)""",
+                (filename, time.time(), target)
+            )
+            self._conn.execute("DELETE FROM chunk_owners WHERE filename = ?", (filename,))
+            self._bump_version()
+
+    def alias_target(self, filename: str) -> Optional[str]:
+        """The file an alias points to, or None if `filename` isn't an alias"""
+        with self._lock:
+            row = self._conn.execute("SELECT alias_of FROM files WHERE filename = ?", (filename,)).fetchone()
+        return row["alias_of"] if row else None
+
+    def promote_alias(self, filename: str) -> Optional[Tuple[str, List[str]]]:
+        """
+        Remove a file that has aliases by handing its chunks to the oldest alias, which the
+        other aliases then point to. Returns (new owner, chunk ids), or None if it has no aliases
+        """
+        with self._lock, self._conn:
+            new_owner = self._hand_to_oldest_alias(filename)
+            if new_owner is None:
+                return None
+            self._delete_file(filename)
+            self._bump_version()
+            row = self._conn.execute("SELECT chunk_ids FROM files WHERE filename = ?", (new_owner,)).fetchone()
+        return new_owner, json.loads(row["chunk_ids"])
+
+    def _hand_to_oldest_alias(self, filename: str) -> Optional[str]:
+        """Give a file's chunks to its oldest alias and point the other aliases at it. Returns that alias, or None"""
+        alias = self._conn.execute(
+            "SELECT filename FROM files WHERE alias_of = ? ORDER BY ingested_at LIMIT 1", (filename,)
+        ).fetchone()
+        if alias is None:
+            return None
+        new_owner = alias["filename"]
+        self._conn.execute(
+            """UPDATE files SET alias_of = NULL,
+                (content_hash, chunk_ids, chunk_hashes, chunk_count, byte_size) =
+                (SELECT content_hash, chunk_ids, chunk_hashes, chunk_count, byte_size FROM files WHERE filename = ?)
+            WHERE filename = ?""",
+            (filename, new_owner)
+        )
+        self._conn.execute("DELETE FROM chunk_owners WHERE filename = ?", (new_owner,))
+        self._conn.execute(
+            "INSERT OR IGNORE INTO chunk_owners (chunk_id, filename) SELECT chunk_id, ? FROM chunk_owners WHERE filename = ?",
+            (new_owner, filename)
+        )
+        self._conn.execute("UPDATE files SET alias_of = ? WHERE alias_of = ?", (new_owner, filename))
+        self._conn.execute("UPDATE borrowed_chunks SET filename = ? WHERE filename = ?", (new_owner, filename))
+        return new_owner
+
+    def get_chunk_ids(self, filename: str) -> Optional[List[str]]:
+        """Chunk ids stored for a file, or None if the file isn't registered"""
+        with self._lock:
+            row = self._conn.execute("SELECT chunk_ids FROM files WHERE filename = ?", (filename,)).fetchone()
+        return json.loads(row["chunk_ids"]) if row else None
+
+    @staticmethod
+    def _hashes_of(row: Optional[sqlite3.Row], count: int) -> List[Optional[str]]:
+        hashes = json.loads(row["chunk_hashes"]) if row and row["chunk_hashes"] else None
+        return hashes if hashes is not None and len(hashes) == count else [None] * count
+
+    def get_chunks(self, filename: str) -> Optional[Tuple[List[str], List[Optional[str]]]]:
+        """Chunk ids and content hashes (None where unknown) of a file, or None if it isn't registered"""
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT chunk_ids, chunk_hashes FROM files WHERE filename = ?", (filename,)
+            ).fetchone()
+        if row is None:
+            return None
+        chunk_ids = json.loads(row["chunk_ids"])
+        return chunk_ids, self._hashes_of(row, len(chunk_ids))
+
+    def remove(self, filename: str) -> None:
+        with self._lock, self._conn:
+            self._delete_file(filename)
+            self._bump_version()
+
+    def list(self, offset: int = 0, limit: int = 100) -> Tuple[List[Dict], int]:
+        """A page of file summaries ordered by filename, and the total number of files"""
+        with self._lock:
+            rows = self._conn.execute(
+                f"{SUMMARY_QUERY} ORDER BY f.filename LIMIT ? OFFSET ?",
+                (limit, offset)
+            ).fetchall()
+            total = self._conn.execute("SELECT COUNT(*) FROM files").fetchone()[0]
+        return [self._summary(row) for row in rows], total
+
+    def count(self) -> int:
+        with self._lock:
+            return self._conn.execute("SELECT COUNT(*) FROM files").fetchone()[0]
+
+    def backfill_from_collection(self, collection, page_size: int = 5000) -> None:
+        """
+        Build the registry from an existing collection (one paginated scan, done once).
+        Content hash and byte size aren't recoverable from the collection and stay empty.
+        """
+        with self._lock:
+            done = self._conn.execute("SELECT value FROM meta WHERE key = 'backfilled'").fetchone()
+        if done:
+            return
+
+        if collection.count() > 0:
+            files: Dict[str, List[str]] = {}
+            offset = 0
+            while True:
+                page = collection.get(include=["metadatas"], limit=page_size, offset=offset)
+                if not page["ids"]:
+                    break
+                for chunk_id, metadata in zip(page["ids"], page["metadatas"]):
+                    files.setdefault((metadata or {}).get("filename", "unknown"), []).append(chunk_id)
+                offset += len(page["ids"])
+
+            now = time.time()
+            with self._lock, self._conn:
+                self._conn.executemany(
+                    """INSERT OR IGNORE INTO files (filename, content_hash, chunk_ids, chunk_count, byte_size, ingested_at)
+                    VALUES (?, NULL, ?, ?, NULL, ?)""",
+                    [(filename, json.dumps(ids), len(ids), now) for filename, ids in files.items()]
+                )
+                self._build_chunk_owners()
+            print(f"File registry backfilled with {len(files)} files")
+
+        with self._lock, self._conn:
+            self._conn.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('backfilled', '1')")
+
+_registry: Optional[FileRegistry] = None
+_registry_lock = threading.Lock()
+
+def get_file_registry() -> FileRegistry:
+    """Get the file registry, backfilling it from the collection on first use"""
+    global _registry
+    if _registry is None:
+        with _registry_lock:
+            if _registry is None:
+                registry = FileRegistry(FILE_REGISTRY_PATH)
+                registry.backfill_from_collection(get_collection())
+                _registry = registry
+    return _registry
@@ -1,59 +1,199 @@
 """
 File management endpoints for PDF files in ChromaDB
 """
-from fastapi import APIRouter, File, UploadFile, HTTPException
-from typing import List, Dict
-from app.vector_store import add_pdf_to_store, list_all_files, delete_file, update_file
+import hashlib
+import os
+import tempfile
+from fastapi import APIRouter, Depends, File, UploadFile, HTTPException, Query, Header, Response
+from fastapi.concurrency import run_in_threadpool
+from typing import List, Dict, Optional, Callable, Tuple
+from app.vector_store import (
+    add_pdf_to_store, list_files_page, get_file_summary, delete_file, update_file, find_duplicate, alias_file,
+    get_corpus_version, DuplicateContentError
+)
+from app.cache import get_embedding_cache
+from app.embeddings import get_embedding_scheduler
+from app.database import run_db
+from app.jobs import job_manager
+from app.warmup import require_ready
+from app.config import UPLOAD_TMP_DIR, UPLOAD_SPOOL_BLOCK_SIZE, DEDUP_POLICY
 
 files_router = APIRouter()
 
+async def spool_upload(file: UploadFile) -> Tuple[str, int, str]:
+    """
+    Copy an upload to a temporary file in fixed-size blocks, so the PDF is never
+    held in memory as a whole, hashing it on the way.
+    Returns (path, size in bytes, sha256); the caller removes the file.
+    """
+    fd, path = tempfile.mkstemp(suffix=".pdf", dir=UPLOAD_TMP_DIR)
+    size = 0
+    digest = hashlib.sha256()
+    try:
+        with os.fdopen(fd, "wb") as spool:
+            while True:
+                block = await file.read(UPLOAD_SPOOL_BLOCK_SIZE)
+                if not block:
+                    break
+                spool.write(block)
+                digest.update(block)
+                size += len(block)
+    except Exception:
+        os.remove(path)
+        raise
+    return path, size, digest.hexdigest()
+
+def remove_spooled(path: str):
+    """Remove a spooled upload, ignoring files that are already gone"""
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+
+def check_duplicate(filename: str, content_hash: str) -> Optional[Dict]:
+    """
+    Apply DEDUP_POLICY to an upload whose content is already stored.
+    Returns the outcome if the upload needs no ingestion, or None to ingest it.
+    Raises DuplicateContentError if the policy rejects it.
+    """
+    if DEDUP_POLICY == "off":
+        return None
+    existing = find_duplicate(content_hash)
+    if not existing:
+        return None
+    if existing == filename:
+        return {"filename": filename, "chunks_added": 0, "duplicate_of": existing, "status": "unchanged"}
+    if DEDUP_POLICY == "reject":
+        raise DuplicateContentError(f"Identical content is already stored as '{existing}'")
+    summary = get_file_summary(filename)
+    if summary and not summary["alias_of"]:
+        # The name holds a different document; aliasing it would drop that document's chunks
+        return None
+    return alias_file(filename, existing)
+
+def ingest_spooled(path: str, filename: str, source_hash: Optional[Tuple[str, int]] = None,
+                   progress: Optional[Callable] = None) -> Dict:
+    """Ingest a spooled upload and remove it afterwards (runs on an ingestion worker)"""
+    try:
+        # Identical content may have been ingested since the upload was accepted
+        if source_hash:
+            duplicate = check_duplicate(filename, source_hash[0])
+            if duplicate:
+                return duplicate
+        return add_pdf_to_store(path, filename, progress=progress, source_hash=source_hash)
+    finally:
+        remove_spooled(path)
+
+def corpus_etag(version: int) -> str:
+    return f'"corpus-{version}"'
+
+def etag_matches(if_none_match: Optional[str], etag: str) -> bool:
+    """Whether an If-None-Match header names this ETag (weak comparison, as for GET)"""
+    if not if_none_match:
+        return False
+    tags = [tag.strip() for tag in if_none_match.split(",")]
+    return "*" in tags or etag in tags or f"W/{etag}" in tags
+
 @files_router.get("/", response_model=List[Dict])
-async def list_files():
+async def list_files(response: Response, offset: int = Query(0, ge=0), limit: int = Query(100, ge=1, le=1000),
+                     if_none_match: Optional[str] = Header(None)):
     """
-    List all PDF files stored in ChromaDB
+    List PDF files stored in ChromaDB (paginated; the total is in the X-Total-Count header).
+    The ETag (and X-Corpus-Version) is the corpus version: send it back in If-None-Match
+    to get 304 Not Modified, without the list being read, while nothing has changed.
     """
     try:
-        files = list_all_files()
+        # Read the version before the list: if a change lands in between, the client
+        # gets the newer list under the older version and simply fetches it again
+        version = await run_db(get_corpus_version)
+        etag = corpus_etag(version)
+        headers = {"ETag": etag, "X-Corpus-Version": str(version), "Cache-Control": "no-cache"}
+        if etag_matches(if_none_match, etag):
+            return Response(status_code=304, headers=headers)
+        
+        files, total = await run_db(list_files_page, offset, limit)
+        response.headers.update(headers)
+        response.headers["X-Total-Count"] = str(total)
         return files
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Error listing files: {str(e)}")
 
-@files_router.post("/upload")
-async def upload_file(file: UploadFile = File(...)):
+@files_router.post("/upload", status_code=202, dependencies=[Depends(require_ready)])
+async def upload_file(response: Response, file: UploadFile = File(...)):
     """
-    Upload and ingest a PDF file into ChromaDB
+    Upload a PDF file and queue it for ingestion into ChromaDB.
+    Returns a job id right away; poll /api/files/jobs/{job_id} for progress.
+    Content that is already stored isn't ingested again (see DEDUP_POLICY); the
+    outcome is returned directly with status 200 and no job id.
     """
     try:
         # Validate file type
         if not file.filename.endswith('.pdf'):
             raise HTTPException(status_code=400, detail="Only PDF files are supported")
         
-        # Read file content
-        pdf_content = await file.read()
+        # Spool file content to disk
+        path, size, content_hash = await spool_upload(file)
         
-        if len(pdf_content) == 0:
+        if size == 0:
+            remove_spooled(path)
             raise HTTPException(status_code=400, detail="File is empty")
         
-        # Add to vector store
-        result = add_pdf_to_store(pdf_content, file.filename)
+        # Short-circuit uploads of content that is already stored
+        try:
+            duplicate = await run_db(check_duplicate, file.filename, content_hash)
+        except Exception:
+            remove_spooled(path)
+            raise
+        if duplicate:
+            remove_spooled(path)
+            response.status_code = 200
+            return {
+                "message": f"Identical content is already stored as '{duplicate['duplicate_of']}'",
+                "job_id": None,
+                **duplicate
+            }
+        
+        # Extract, chunk, embed and store in the background
+        job = job_manager.submit(file.filename, ingest_spooled, path, file.filename, (content_hash, size))
         
         return {
-            "message": "File uploaded and processed successfully",
-            **result
+            "message": "File accepted for processing",
+            "job_id": job.job_id,
+            "filename": file.filename,
+            "status": job.status
         }
         
     except HTTPException:
         raise
+    except DuplicateContentError as e:
+        raise HTTPException(status_code=409, detail=str(e))
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Error uploading file: {str(e)}")
 
-@files_router.delete("/{filename}")
+@files_router.get("/jobs")
+async def list_jobs():
+    """
+    List recent ingestion jobs, newest first
+    """
+    return await run_db(job_manager.list)
+
+@files_router.get("/jobs/{job_id}")
+async def get_job(job_id: str):
+    """
+    Get status and per-stage progress of an ingestion job
+    """
+    job = await run_db(job_manager.get, job_id)
+    if not job:
+        raise HTTPException(status_code=404, detail=f"Job '{job_id}' not found")
+    return job
+
+@files_router.delete("/{filename}", dependencies=[Depends(require_ready)])
 async def remove_file(filename: str):
     """
     Delete a PDF file from ChromaDB
     """
     try:
-        result = delete_file(filename)
+        result = await run_db(delete_file, filename)
         return {
             "message": "File deleted successfully",
             **result
@@ -63,24 +203,27 @@ async def remove_file(filename: str):
             raise HTTPException(status_code=404, detail=str(e))
         raise HTTPException(status_code=500, detail=f"Error deleting file: {str(e)}")
 
-@files_router.put("/{filename}")
+@files_router.put("/{filename}", dependencies=[Depends(require_ready)])
 async def update_pdf_file(filename: str, file: UploadFile = File(...)):
     """
-    Update a PDF file in ChromaDB (deletes old and adds new)
+    Update a PDF file in ChromaDB (only changed chunks are re-embedded; the new version replaces the old atomically)
     """
     try:
         # Validate file type
         if not file.filename.endswith('.pdf'):
             raise HTTPException(status_code=400, detail="Only PDF files are supported")
         
-        # Read file content
-        pdf_content = await file.read()
+        # Spool file content to disk
+        path, size, _ = await spool_upload(file)
         
-        if len(pdf_content) == 0:
-            raise HTTPException(status_code=400, detail="File is empty")
-        
-        # Update file
-        result = update_file(filename, pdf_content)
+        try:
+            if size == 0:
+                raise HTTPException(status_code=400, detail="File is empty")
+            
+            # Update file
+            result = await run_in_threadpool(update_file, filename, path)
+        finally:
+            remove_spooled(path)
         
         return {
             "message": "File updated successfully",
@@ -100,8 +243,7 @@ async def get_file_info(filename: str):
     Get information about a specific file
     """
     try:
-        files = list_all_files()
-        file_info = next((f for f in files if f["filename"] == filename), None)
+        file_info = await run_db(get_file_summary, filename)
         
         if not file_info:
             raise HTTPException(status_code=404, detail=f"File '{filename}' not found")
@@ -113,3 +255,20 @@ async def get_file_info(filename: str):
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Error getting file info: {str(e)}")
 
+
+@files_router.get("/embedding-cache/stats")
+async def embedding_cache_stats():
+    """
+    Get hit/miss counters for the ingestion embedding cache
+    """
+    cache = get_embedding_cache()
+    if cache is None:
+        return {"enabled": False}
+    return {"enabled": True, **cache.stats()}
+
+@files_router.get("/embedding-scheduler/stats")
+async def embedding_scheduler_stats():
+    """
+    Get throughput and throttling counters for the ingestion embedding scheduler
+    """
+    return get_embedding_scheduler().stats()
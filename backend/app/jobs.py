@@ -0,0 +1,233 @@
+"""
+Background ingestion jobs with per-stage progress
+"""
+import contextvars
+import json
+import os
+import sqlite3
+import threading
+import time
+import traceback
+import uuid
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Dict, List, Optional
+from app.config import INGEST_WORKERS, INGEST_JOB_HISTORY, JOB_DB_PATH
+from app.metrics import INGEST_IN_FLIGHT, count_error, log, request_id_var
+from app.profiling import profile_job
+from app.vector_store import DuplicateContentError
+
+# Progress of a running job is written to the job store at most this often (seconds)
+JOB_SAVE_INTERVAL = 0.5
+
+class IngestJob:
+    """State of one ingestion job"""
+
+    def __init__(self, filename: str):
+        self.job_id = uuid.uuid4().hex
+        self.filename = filename
+        # Id of the request that submitted the job, to find its log lines
+        self.request_id = request_id_var.get()
+        self.status = "queued"  # queued | running | completed | failed
+        self.stage = "queued"   # queued | extracting | finalizing | done
+        self.progress = {
+            "pages_total": 0,
+            "pages_extracted": 0,
+            "chunks_total": 0,
+            "chunks_embedded": 0,
+            "chunks_written": 0
+        }
+        self.result: Optional[Dict] = None
+        self.error: Optional[str] = None
+        self.created_at = time.time()
+        self.started_at: Optional[float] = None
+        self.finished_at: Optional[float] = None
+        self._saved_at = 0.0
+
+    def update(self, stage: Optional[str] = None, **counters):
+        """Progress callback passed down the ingestion pipeline"""
+        if stage is not None:
+            self.stage = stage
+        for key, value in counters.items():
+            if key in self.progress:
+                self.progress[key] = value
+
+    def to_dict(self) -> Dict:
+        return {
+            "job_id": self.job_id,
+            "filename": self.filename,
+            "request_id": self.request_id,
+            "status": self.status,
+            "stage": self.stage,
+            "progress": dict(self.progress),
+            "result": self.result,
+            "error": self.error,
+            "created_at": self.created_at,
+            "started_at": self.started_at,
+            "finished_at": self.finished_at
+        }
+
+class JobStore:
+    """
+    Job state in SQLite (WAL mode), so a job can be polled through any worker process,
+    not only the one running it. Keeps the newest `max_history` finished jobs.
+    """
+
+    def __init__(self, path: str, max_history: int):
+        self.max_history = max_history
+        self._lock = threading.Lock()
+
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+
+        self._conn = sqlite3.connect(path, check_same_thread=False, timeout=30)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute(
+            """CREATE TABLE IF NOT EXISTS jobs (
+                job_id TEXT PRIMARY KEY,
+                status TEXT NOT NULL,
+                created_at REAL NOT NULL,
+                data TEXT NOT NULL
+            )"""
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS idx_jobs_created_at ON jobs(created_at)")
+        self._conn.commit()
+
+    def save(self, job: Dict) -> None:
+        """Insert or update a job (as returned by IngestJob.to_dict)"""
+        with self._lock, self._conn:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO jobs (job_id, status, created_at, data) VALUES (?, ?, ?, ?)",
+                (job["job_id"], job["status"], job["created_at"], json.dumps(job))
+            )
+            if job["status"] in ("completed", "failed"):
+                self._conn.execute(
+                    """DELETE FROM jobs WHERE job_id IN (
+                        SELECT job_id FROM jobs WHERE status IN ('completed', 'failed')
+                        ORDER BY created_at DESC LIMIT -1 OFFSET ?
+                    )""",
+                    (self.max_history,)
+                )
+
+    def get(self, job_id: str) -> Optional[Dict]:
+        # The connection is shared by all threads: read under the same lock as writes
+        with self._lock:
+            row = self._conn.execute("SELECT data FROM jobs WHERE job_id = ?", (job_id,)).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def list(self) -> List[Dict]:
+        """Jobs of every worker, newest first"""
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT data FROM jobs ORDER BY created_at DESC LIMIT ?", (self.max_history,)
+            ).fetchall()
+        return [json.loads(row[0]) for row in rows]
+
+class JobManager:
+    """
+    Runs ingestion jobs on a bounded worker pool and keeps a bounded job history.
+    Job state is mirrored to a JobStore shared by all worker processes.
+    """
+
+    def __init__(self, max_workers: int, max_history: int):
+        self.max_history = max_history
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="ingest")
+        self._jobs: "OrderedDict[str, IngestJob]" = OrderedDict()
+        self._lock = threading.Lock()
+        self._store: Optional[JobStore] = None
+        self._store_lock = threading.Lock()
+
+    def _get_store(self) -> JobStore:
+        if self._store is None:
+            with self._store_lock:
+                if self._store is None:
+                    self._store = JobStore(JOB_DB_PATH, self.max_history)
+        return self._store
+
+    def _save(self, job: IngestJob, force: bool = True):
+        """Write a job to the shared store (progress updates at most every JOB_SAVE_INTERVAL)"""
+        now = time.monotonic()
+        if not force and now - job._saved_at < JOB_SAVE_INTERVAL:
+            return
+        job._saved_at = now
+        try:
+            self._get_store().save(job.to_dict())
+        except Exception as e:
+            log(f"Warning: could not save job {job.job_id}: {e}")
+
+    def submit(self, filename: str, func: Callable, *args, **kwargs) -> IngestJob:
+        """
+        Queue `func(*args, progress=job.update, **kwargs)` and return the job.
+        The function's return value becomes the job result.
+        """
+        job = IngestJob(filename)
+        with self._lock:
+            self._jobs[job.job_id] = job
+            self._prune()
+        self._save(job)
+        # The job logs under the id of the request that submitted it
+        self._executor.submit(contextvars.copy_context().run, self._run, job, func, args, kwargs)
+        return job
+
+    def _run(self, job: IngestJob, func: Callable, args, kwargs):
+        job.status = "running"
+        job.started_at = time.time()
+        self._save(job)
+        
+        def progress(**updates):
+            job.update(**updates)
+            self._save(job, force=False)
+        
+        INGEST_IN_FLIGHT.inc()
+        try:
+            with profile_job(job.filename):
+                job.result = func(*args, progress=progress, **kwargs)
+            job.stage = "done"
+            job.status = "completed"
+        except DuplicateContentError as e:
+            # Identical content was stored while the job was queued and DEDUP_POLICY rejects it:
+            # the job fails, but nothing went wrong
+            log(f"Ingestion of {job.filename} rejected: {e}")
+            job.error = str(e)
+            job.status = "failed"
+        except Exception as e:
+            log(f"Ingestion of {job.filename} failed:\n{traceback.format_exc()}")
+            count_error("ingest", e)
+            job.error = str(e)
+            job.status = "failed"
+        finally:
+            INGEST_IN_FLIGHT.dec()
+            job.finished_at = time.time()
+            self._save(job)
+
+    def _prune(self):
+        # Forget the oldest finished jobs beyond the history bound
+        excess = len(self._jobs) - self.max_history
+        if excess <= 0:
+            return
+        for job_id in list(self._jobs):
+            if excess <= 0:
+                break
+            if self._jobs[job_id].status in ("completed", "failed"):
+                del self._jobs[job_id]
+                excess -= 1
+
+    def get(self, job_id: str) -> Optional[Dict]:
+        """A job run by this process (freshest state) or by any other worker"""
+        job = self._jobs.get(job_id)
+        if job is not None:
+            return job.to_dict()
+        return self._get_store().get(job_id)
+
+    def list(self) -> List[Dict]:
+        """Recent jobs of all workers, newest first"""
+        with self._lock:
+            local = {job.job_id: job.to_dict() for job in self._jobs.values()}
+        return [local.get(job["job_id"], job) for job in self._get_store().list()]
+
+    def shutdown(self):
+        self._executor.shutdown(wait=False, cancel_futures=True)
+
+job_manager = JobManager(INGEST_WORKERS, INGEST_JOB_HISTORY)
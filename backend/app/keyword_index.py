@@ -0,0 +1,155 @@
+"""
+Inverted keyword index (SQLite FTS5, BM25 ranking) over stored chunk texts
+"""
+import os
+import re
+import sqlite3
+import threading
+from typing import List, Optional, Tuple
+from app.config import KEYWORD_INDEX_ENABLED, KEYWORD_INDEX_PATH
+from app.database import get_collection
+
+_WORD_PATTERN = re.compile(r"\w+")
+# Identifier-like tokens: a digit together with a letter or an inner separator, e.g.
+# part numbers, error codes, section numbers, versions ("ERR-4021", "A1234", "3.2.1").
+# Plain words, acronyms ("HIPAA") and bare numbers are not identifiers
+_IDENTIFIER_PATTERN = re.compile(r"^(?=.*\d)(?:(?=.*[A-Za-z])|(?=.*\w[-_./#:]\w))[\w\-_./#:]+$")
+# Words that may stand next to an identifier in a lookup ("section 3.2.1", "error ERR-4021")
+_LOOKUP_WORDS = frozenset({
+    "section", "sec", "clause", "article", "part", "chapter", "appendix", "table", "figure", "fig",
+    "item", "rule", "form", "error", "code", "id", "no", "number", "ref", "version", "model", "sku"
+})
+
+def build_match_query(query: str, require_all: bool = False) -> Optional[str]:
+    """
+    FTS5 query matching any word of `query`, or every word with require_all. A word like
+    "ERR-4021" or "3.2.1" is split by the tokenizer, so it becomes a phrase that matches
+    the parts in order.
+    """
+    phrases = []
+    for word in query.split():
+        tokens = _WORD_PATTERN.findall(word.casefold())
+        if tokens:
+            phrases.append('"' + " ".join(tokens) + '"')
+    return (" AND " if require_all else " OR ").join(dict.fromkeys(phrases)) or None
+
+def looks_like_lookup(query: str, max_words: int = 4) -> bool:
+    """
+    True for short queries that are an identifier lookup and nothing else, e.g. "ERR-4021"
+    or "section 3.2.1": every word is an identifier or a word like "section" or "error".
+    "GPT-4 limits", "What is HIPAA" or "USA policy" ask about something, so they aren't
+    """
+    words = [word.strip("?,;:!()\"'") for word in query.split()]
+    words = [word for word in words if word]
+    if not words or len(words) > max_words:
+        return False
+    identifiers = [word for word in words if _IDENTIFIER_PATTERN.match(word)]
+    return bool(identifiers) and all(
+        word in identifiers or word.casefold() in _LOOKUP_WORDS for word in words
+    )
+
+class KeywordIndex:
+    """
+    Full-text index of chunk texts keyed by chunk id, maintained as chunks are added
+    and deleted. Backed by SQLite in WAL mode so several worker processes can share it.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self._lock = threading.Lock()
+
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+
+        self._conn = sqlite3.connect(path, check_same_thread=False, timeout=30)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        # FTS5 rows are addressed by rowid; chunk_map ties them to chunk ids
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS chunk_map (rowid INTEGER PRIMARY KEY AUTOINCREMENT, chunk_id TEXT UNIQUE NOT NULL)"
+        )
+        self._conn.execute(
+            "CREATE VIRTUAL TABLE IF NOT EXISTS chunks_fts USING fts5(text, tokenize='unicode61 remove_diacritics 2')"
+        )
+        self._conn.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)")
+        self._conn.commit()
+
+    def add(self, items: List[Tuple[str, str]]) -> None:
+        """Index (chunk id, text) pairs"""
+        with self._lock, self._conn:
+            for chunk_id, text in items:
+                row = self._conn.execute("SELECT rowid FROM chunk_map WHERE chunk_id = ?", (chunk_id,)).fetchone()
+                if row:
+                    self._conn.execute("DELETE FROM chunks_fts WHERE rowid = ?", (row[0],))
+                    rowid = row[0]
+                else:
+                    rowid = self._conn.execute("INSERT INTO chunk_map (chunk_id) VALUES (?)", (chunk_id,)).lastrowid
+                self._conn.execute("INSERT INTO chunks_fts (rowid, text) VALUES (?, ?)", (rowid, text))
+
+    def remove(self, chunk_ids: List[str]) -> None:
+        """Drop deleted chunks from the index"""
+        with self._lock, self._conn:
+            for chunk_id in chunk_ids:
+                row = self._conn.execute("SELECT rowid FROM chunk_map WHERE chunk_id = ?", (chunk_id,)).fetchone()
+                if row:
+                    self._conn.execute("DELETE FROM chunks_fts WHERE rowid = ?", (row[0],))
+                    self._conn.execute("DELETE FROM chunk_map WHERE rowid = ?", (row[0],))
+
+    def search(self, query: str, limit: int = 20, require_all: bool = False) -> List[Tuple[str, float]]:
+        """
+        Best-matching chunk ids with their BM25 scores (higher is better). With require_all
+        only chunks containing every word of the query match.
+        """
+        match = build_match_query(query, require_all=require_all)
+        if not match:
+            return []
+        with self._lock:
+            rows = self._conn.execute(
+                """SELECT m.chunk_id, bm25(chunks_fts) AS score
+                FROM chunks_fts JOIN chunk_map m ON m.rowid = chunks_fts.rowid
+                WHERE chunks_fts MATCH ? ORDER BY score LIMIT ?""",
+                (match, limit)
+            ).fetchall()
+        # FTS5 reports BM25 as a negative number, lower meaning more relevant
+        return [(chunk_id, -score) for chunk_id, score in rows]
+
+    def count(self) -> int:
+        with self._lock:
+            return self._conn.execute("SELECT COUNT(*) FROM chunk_map").fetchone()[0]
+
+    def backfill_from_collection(self, collection, page_size: int = 1000) -> None:
+        """Index an existing collection (one paginated scan, done once)"""
+        with self._lock:
+            done = self._conn.execute("SELECT value FROM meta WHERE key = 'backfilled'").fetchone()
+        if done:
+            return
+
+        if collection.count() > 0:
+            offset = 0
+            while True:
+                page = collection.get(include=["documents"], limit=page_size, offset=offset)
+                if not page["ids"]:
+                    break
+                self.add([(chunk_id, document or "") for chunk_id, document in zip(page["ids"], page["documents"])])
+                offset += len(page["ids"])
+            print(f"Keyword index backfilled with {offset} chunks")
+
+        with self._lock, self._conn:
+            self._conn.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('backfilled', '1')")
+
+_index: Optional[KeywordIndex] = None
+_index_lock = threading.Lock()
+
+def get_keyword_index() -> Optional[KeywordIndex]:
+    """Get the keyword index (backfilled from the collection on first use), or None if disabled"""
+    global _index
+    if not KEYWORD_INDEX_ENABLED:
+        return None
+    if _index is None:
+        with _index_lock:
+            if _index is None:
+                index = KeywordIndex(KEYWORD_INDEX_PATH)
+                index.backfill_from_collection(get_collection())
+                _index = index
+    return _index
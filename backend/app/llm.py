@@ -1,7 +1,8 @@
 """
 LLM setup for Azure OpenAI or OpenAI
 """
-from langchain_openai import AzureChatOpenAI, ChatOpenAI
+import threading
+from typing import Dict
 from app.config import (
     USE_AZURE, 
     AZURE_OPENAI_ENDPOINT, 
@@ -10,11 +11,19 @@ from app.config import (
     CHAT_MODEL,
     AZURE_CHAT_MODEL
 )
+from app.clients import get_openai_client, get_async_openai_client
 
-def get_llm(temperature=0.7):
-    """Get LLM instance"""
+# One shared instance per temperature; they all use the pooled clients
+_llms: Dict[float, object] = {}
+_llms_lock = threading.Lock()
+
+def _create_llm(temperature: float):
+    """Build an LLM wired to the shared, pooled OpenAI clients"""
+    # langchain_openai is slow to import, so it waits until the first LLM is built
+    from langchain_openai import AzureChatOpenAI, ChatOpenAI
+    
     if USE_AZURE:
-        return AzureChatOpenAI(
+        llm = AzureChatOpenAI(
             azure_endpoint=AZURE_OPENAI_ENDPOINT,
             api_key=OPENAI_API_KEY_TO_USE,
             api_version=API_VERSION,
@@ -22,9 +31,20 @@ def get_llm(temperature=0.7):
             temperature=temperature
         )
     else:
-        return ChatOpenAI(
+        llm = ChatOpenAI(
             openai_api_key=OPENAI_API_KEY_TO_USE,
             model_name=CHAT_MODEL,
             temperature=temperature
         )
+    deployment = AZURE_CHAT_MODEL if USE_AZURE else None
+    llm.client = get_openai_client(deployment).chat.completions
+    llm.async_client = get_async_openai_client(deployment).chat.completions
+    return llm
 
+def get_llm(temperature=0.7):
+    """Get LLM instance"""
+    if temperature not in _llms:
+        with _llms_lock:
+            if temperature not in _llms:
+                _llms[temperature] = _create_llm(temperature)
+    return _llms[temperature]
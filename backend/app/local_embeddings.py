@@ -0,0 +1,100 @@
+"""
+Local, CPU-only embedding models that run in-process
+"""
+import re
+import zlib
+from typing import Dict, List
+import numpy as np
+from langchain_core.embeddings import Embeddings
+
+_TOKEN_PATTERN = re.compile(r"\w+")
+
+class HashingEmbeddings(Embeddings):
+    """
+    Dependency-free embedder: signed feature hashing of words and word bigrams into
+    `dimension` buckets, with sublinear term weighting and L2 normalization.
+    A batch is embedded as one sparse-to-dense numpy scatter, so it is fast enough to
+    sit on the chat path, and it needs no model download or network access.
+    Retrieval quality is lexical, well below a trained model.
+    """
+
+    def __init__(self, dimension: int = 384):
+        self.dimension = dimension
+        self._bucket_cache: Dict[str, int] = {}
+
+    def _bucket(self, token: str) -> int:
+        """Signed bucket of a token: index + 1, negated for a negative sign"""
+        bucket = self._bucket_cache.get(token)
+        if bucket is None:
+            hashed = zlib.crc32(token.encode("utf-8"))
+            bucket = (hashed % self.dimension + 1) * (1 if hashed & 0x80000000 else -1)
+            if len(self._bucket_cache) < 500000:
+                self._bucket_cache[token] = bucket
+        return bucket
+
+    def _embed(self, texts: List[str]) -> np.ndarray:
+        rows: List[int] = []
+        buckets: List[int] = []
+        for row, text in enumerate(texts):
+            words = _TOKEN_PATTERN.findall(text.casefold())
+            tokens = words + [f"{a} {b}" for a, b in zip(words, words[1:])]
+            rows.extend([row] * len(tokens))
+            buckets.extend(self._bucket(token) for token in tokens)
+
+        matrix = np.zeros((len(texts), self.dimension), dtype=np.float32)
+        if buckets:
+            signed = np.asarray(buckets, dtype=np.int64)
+            np.add.at(matrix, (np.asarray(rows), np.abs(signed) - 1), np.sign(signed).astype(np.float32))
+        matrix = np.sign(matrix) * np.log1p(np.abs(matrix))
+        norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+        return matrix / np.where(norms == 0, 1.0, norms)
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        return self._embed(texts).tolist() if texts else []
+
+    def embed_query(self, text: str) -> List[float]:
+        return self._embed([text])[0].tolist()
+
+    async def aembed_query(self, text: str) -> List[float]:
+        # Microseconds of numpy; not worth a thread hop
+        return self.embed_query(text)
+
+class SentenceTransformerEmbeddings(Embeddings):
+    """
+    A sentence-transformers model run on the CPU in batches. Needs the optional
+    `sentence-transformers` package; the model is downloaded once, then runs offline.
+    """
+
+    def __init__(self, model_name: str, batch_size: int = 64):
+        try:
+            from sentence_transformers import SentenceTransformer
+        except ImportError:
+            raise Exception(
+                f"Local embedding model '{model_name}' needs sentence-transformers "
+                "(pip install sentence-transformers), or set LOCAL_EMBEDDING_MODEL=hashing"
+            )
+        self.model_name = model_name
+        self.batch_size = batch_size
+        self._model = SentenceTransformer(model_name, device="cpu")
+        self.dimension = self._model.get_sentence_embedding_dimension()
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        if not texts:
+            return []
+        vectors = self._model.encode(
+            texts,
+            batch_size=self.batch_size,
+            normalize_embeddings=True,
+            convert_to_numpy=True,
+            show_progress_bar=False
+        )
+        return vectors.tolist()
+
+    def embed_query(self, text: str) -> List[float]:
+        return self.embed_documents([text])[0]
+
+def create_local_embeddings(model_name: str, dimension: int, batch_size: int) -> Embeddings:
+    """Build the local embedder named by LOCAL_EMBEDDING_MODEL ("hashing" or a sentence-transformers model)"""
+    if model_name == "hashing":
+        return HashingEmbeddings(dimension)
+    return SentenceTransformerEmbeddings(model_name, batch_size)
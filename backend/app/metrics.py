@@ -0,0 +1,206 @@
+"""
+Prometheus metrics, per-stage timing and request ids
+"""
+import contextvars
+import os
+import time
+import uuid
+from contextlib import contextmanager
+from typing import Dict, Iterable, Iterator, List, Optional
+from prometheus_client import (
+    CONTENT_TYPE_LATEST,
+    REGISTRY,
+    CollectorRegistry,
+    Counter,
+    Gauge,
+    Histogram,
+    generate_latest
+)
+
+# Stages range from sub-millisecond cache lookups to minutes-long embedding of large PDFs
+STAGE_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+
+STAGE_SECONDS = Histogram(
+    "sicko_stage_seconds",
+    "Time spent in each stage of an operation (chat, chat_stream, ingest, update)",
+    ["operation", "stage"],
+    buckets=STAGE_BUCKETS
+)
+HTTP_REQUESTS = Counter("sicko_http_requests_total", "HTTP requests", ["method", "route", "status"])
+HTTP_REQUEST_SECONDS = Histogram(
+    "sicko_http_request_seconds", "HTTP request duration, including streamed bodies", ["method", "route"],
+    buckets=STAGE_BUCKETS
+)
+HTTP_IN_FLIGHT = Gauge("sicko_http_requests_in_flight", "HTTP requests being served", multiprocess_mode="livesum")
+LLM_IN_FLIGHT = Gauge("sicko_llm_requests_in_flight", "Chat model calls in progress", multiprocess_mode="livesum")
+INGEST_IN_FLIGHT = Gauge("sicko_ingest_jobs_in_flight", "Ingestion jobs running", multiprocess_mode="livesum")
+TOKENS = Counter("sicko_tokens_total", "Tokens sent to or received from the model APIs", ["kind"])
+CACHE_LOOKUPS = Counter("sicko_cache_lookups_total", "Cache lookups by cache and outcome", ["cache", "result"])
+ERRORS = Counter("sicko_errors_total", "Failed operations", ["operation", "error"])
+
+request_id_var: contextvars.ContextVar[Optional[str]] = contextvars.ContextVar("request_id", default=None)
+_timer_var: contextvars.ContextVar[Optional["StageTimer"]] = contextvars.ContextVar("stage_timer", default=None)
+
+def log(message: str):
+    """Print a log line tagged with the current request id"""
+    request_id = request_id_var.get()
+    print(f"[{request_id}] {message}" if request_id else message)
+
+def count_cache(cache: str, hits: int, misses: int):
+    if hits:
+        CACHE_LOOKUPS.labels(cache, "hit").inc(hits)
+    if misses:
+        CACHE_LOOKUPS.labels(cache, "miss").inc(misses)
+
+def count_error(operation: str, error: Exception):
+    ERRORS.labels(operation, type(error).__name__).inc()
+
+class StageTimer:
+    """
+    Accumulates the time one operation spends in each stage and records the totals in
+    STAGE_SECONDS when it finishes. Stages nest: while an inner stage runs, the outer
+    one is paused, so the stage totals add up to the time between start() and finish().
+    Time not spent in a named stage counts as "other".
+    """
+
+    def __init__(self, operation: str):
+        self.operation = operation
+        self.totals: Dict[str, float] = {}
+        self._stack: List[str] = []
+        self._since = 0.0
+
+    def _switch(self, now: float):
+        if self._stack:
+            name = self._stack[-1]
+            self.totals[name] = self.totals.get(name, 0.0) + now - self._since
+        self._since = now
+
+    def enter(self, name: str):
+        self._switch(time.perf_counter())
+        self._stack.append(name)
+
+    def exit(self):
+        self._switch(time.perf_counter())
+        self._stack.pop()
+
+    def start(self) -> "StageTimer":
+        self.enter("other")
+        return self
+
+    def finish(self):
+        """Stop timing and record the stage totals (only the first call counts)"""
+        if not self._stack:
+            return
+        while self._stack:
+            self.exit()
+        for name, seconds in self.totals.items():
+            STAGE_SECONDS.labels(self.operation, name).observe(seconds)
+
+    @contextmanager
+    def stage(self, name: str):
+        self.enter(name)
+        try:
+            yield
+        finally:
+            self.exit()
+
+    @contextmanager
+    def active(self):
+        """Make this the timer that stage() reports to inside the block"""
+        token = _timer_var.set(self)
+        try:
+            yield self
+        finally:
+            _timer_var.reset(token)
+
+@contextmanager
+def timed_operation(operation: str):
+    """Time the stages of an operation run inside this block (in this context and ones copied from it)"""
+    timer = StageTimer(operation).start()
+    try:
+        with timer.active():
+            yield timer
+    finally:
+        timer.finish()
+
+@contextmanager
+def stage(name: str):
+    """Count the time spent in this block towards a stage of the current operation, if any"""
+    timer = _timer_var.get()
+    if timer is None:
+        yield
+        return
+    with timer.stage(name):
+        yield
+
+def timed_iter(iterable: Iterable, name: str) -> Iterator:
+    """Pass items through, counting the time spent producing them towards a stage"""
+    iterator = iter(iterable)
+    while True:
+        with stage(name):
+            try:
+                item = next(iterator)
+            except StopIteration:
+                return
+        yield item
+
+class RequestMetricsMiddleware:
+    """
+    ASGI middleware that gives every request an id (the incoming X-Request-ID header, or
+    a new one), returns it in the response headers, and records HTTP metrics
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        request_id = None
+        for name, value in scope.get("headers", []):
+            if name == b"x-request-id":
+                request_id = value.decode("latin-1")[:64]
+        request_id = request_id or uuid.uuid4().hex
+        token = request_id_var.set(request_id)
+        status = 500
+
+        async def send_with_id(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+                message["headers"] = list(message.get("headers", [])) + [(b"x-request-id", request_id.encode("latin-1"))]
+            await send(message)
+
+        started = time.perf_counter()
+        HTTP_IN_FLIGHT.inc()
+        try:
+            await self.app(scope, receive, send_with_id)
+        finally:
+            HTTP_IN_FLIGHT.dec()
+            elapsed = time.perf_counter() - started
+            # Label by route template, not raw path, to keep the number of series bounded
+            route = getattr(scope.get("route"), "path", "unmatched")
+            HTTP_REQUESTS.labels(scope["method"], route, str(status)).inc()
+            HTTP_REQUEST_SECONDS.labels(scope["method"], route).observe(elapsed)
+            # /ready answers 503 by design until warmup is done
+            if status >= 500 and route != "/ready":
+                log(f"{scope['method']} {scope['path']} returned {status} after {elapsed * 1000:.0f} ms")
+            request_id_var.reset(token)
+
+def render_metrics():
+    """Metrics in the Prometheus text format, and its content type"""
+    if os.getenv("PROMETHEUS_MULTIPROC_DIR"):
+        # Several workers: merge the values every process has written
+        from prometheus_client import multiprocess
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+        return generate_latest(registry), CONTENT_TYPE_LATEST
+    return generate_latest(REGISTRY), CONTENT_TYPE_LATEST
+
+def mark_process_dead():
+    """Drop this worker's in-flight gauges from the multiprocess totals when it exits"""
+    if os.getenv("PROMETHEUS_MULTIPROC_DIR"):
+        from prometheus_client import multiprocess
+        multiprocess.mark_process_dead(os.getpid())
@@ -0,0 +1,95 @@
+"""
+Diversification of retrieved chunks: maximal marginal relevance and merging of adjacent chunks
+"""
+from typing import Dict, List, Optional
+import numpy as np
+
+# Longest chunk overlap looked for when merging neighbours (the splitter overlaps by 200 characters)
+MAX_MERGE_OVERLAP = 400
+
+def mmr_select(query_embedding: List[float], embeddings: List[List[float]], k: int,
+               lambda_mult: float = 0.7, relevance: Optional[List[float]] = None) -> List[int]:
+    """
+    Indices of `k` candidates chosen by maximal marginal relevance: each step takes the
+    candidate maximizing lambda * relevance - (1 - lambda) * (max similarity to those
+    already chosen). Cosine similarities are computed as one matrix-vector product per step.
+    Relevance is cosine similarity to the query unless given (e.g. fused hybrid scores scaled to 0..1).
+    """
+    matrix = np.asarray(embeddings, dtype=np.float32)
+    if matrix.size == 0:
+        return []
+    matrix /= np.maximum(np.linalg.norm(matrix, axis=1, keepdims=True), 1e-12)
+    query = np.asarray(query_embedding, dtype=np.float32)
+    query /= max(float(np.linalg.norm(query)), 1e-12)
+
+    relevance = matrix @ query if relevance is None else np.asarray(relevance, dtype=np.float32)
+    redundancy = np.zeros(len(matrix), dtype=np.float32)
+    available = np.ones(len(matrix), dtype=bool)
+    selected: List[int] = []
+    for _ in range(min(k, len(matrix))):
+        scores = np.where(available, lambda_mult * relevance - (1 - lambda_mult) * redundancy, -np.inf)
+        best = int(np.argmax(scores))
+        selected.append(best)
+        available[best] = False
+        redundancy = np.maximum(redundancy, matrix @ matrix[best])
+    return selected
+
+def _join_overlapping(first: str, second: str) -> str:
+    """Concatenate two consecutive chunks, dropping the text they share"""
+    for length in range(min(len(first), len(second), MAX_MERGE_OVERLAP), 19, -1):
+        if first.endswith(second[:length]):
+            return first + second[length:]
+    return first + "\n" + second
+
+def merge_adjacent_chunks(hits: List[Dict]) -> List[Dict]:
+    """
+    Merge hits that are consecutive chunks of the same file into one passage, so the
+    prompt doesn't carry their shared overlap twice. Merged passages keep the rank of
+    their best member and span the pages of all of them.
+    """
+    by_file: Dict[str, List[int]] = {}
+    for position, hit in enumerate(hits):
+        metadata = hit.get("metadata") or {}
+        if metadata.get("chunk_index") is not None:
+            by_file.setdefault(metadata.get("filename"), []).append(position)
+
+    merged_into: Dict[int, int] = {}
+    passages: Dict[int, Dict] = {}
+    for positions in by_file.values():
+        positions.sort(key=lambda p: hits[p]["metadata"]["chunk_index"])
+        run: Optional[Dict] = None
+        for position in positions:
+            hit = hits[position]
+            index = hit["metadata"]["chunk_index"]
+            if run is not None and index == run["last_index"] + 1:
+                run["document"] = _join_overlapping(run["document"], hit.get("document") or "")
+                run["last_index"] = index
+                run["members"].append(position)
+                continue
+            run = {"document": hit.get("document") or "", "last_index": index, "members": [position]}
+            passages[position] = run
+    for head, passage in passages.items():
+        for member in passage["members"]:
+            merged_into[member] = head
+
+    result = []
+    emitted = set()
+    for position, hit in enumerate(hits):
+        head = merged_into.get(position, position)
+        if head in emitted:
+            continue
+        emitted.add(head)
+        passage = passages.get(head)
+        if passage is None or len(passage["members"]) == 1:
+            result.append(hit)
+            continue
+        members = [hits[member] for member in passage["members"]]
+        distances = [member["distance"] for member in members if member.get("distance") is not None]
+        metadata = dict(members[0]["metadata"])
+        metadata["page"] = min(m["metadata"].get("page") or 0 for m in members) or metadata.get("page")
+        metadata["page_end"] = max(m["metadata"].get("page_end") or 0 for m in members) or metadata.get("page_end")
+        metadata["merged_chunks"] = len(members)
+        merged = dict(hit, id=members[0]["id"], document=passage["document"], metadata=metadata)
+        merged["distance"] = min(distances) if distances else None
+        result.append(merged)
+    return result
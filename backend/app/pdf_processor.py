@@ -1,62 +1,246 @@
 """
 PDF processing and chunking
 """
-from pypdf import PdfReader
-from typing import List, Dict
+from typing import List, Dict, Optional, Callable, Tuple, Union, Iterator, Iterable
+import bisect
+import multiprocessing
+import threading
 import uuid
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import contextmanager
 from io import BytesIO
-from langchain.text_splitter import RecursiveCharacterTextSplitter
+from app.config import PDF_EXTRACT_WORKERS, PDF_PARALLEL_MIN_PAGES, PDF_PAGES_PER_TASK
+from app.metrics import timed_iter
 
-def extract_text_from_pdf(pdf_content: bytes) -> str:
-    """Extract text from PDF content"""
+# Raw PDF bytes, or the path of a PDF file on disk
+PdfSource = Union[bytes, str]
+
+# Chunks of text buffered at a time by the streaming chunker
+STREAM_WINDOW_CHUNKS = 32
+
+_process_pool: Optional[ProcessPoolExecutor] = None
+_process_pool_lock = threading.Lock()
+
+def _get_process_pool() -> ProcessPoolExecutor:
+    """Get the shared page-extraction process pool"""
+    global _process_pool
+    if _process_pool is None:
+        with _process_pool_lock:
+            if _process_pool is None:
+                # Ingestion runs on worker threads, so avoid plain fork where we can
+                methods = multiprocessing.get_all_start_methods()
+                context = multiprocessing.get_context("forkserver" if "forkserver" in methods else None)
+                _process_pool = ProcessPoolExecutor(max_workers=PDF_EXTRACT_WORKERS, mp_context=context)
+    return _process_pool
+
+def shutdown_process_pool():
+    """Stop the page-extraction worker processes"""
+    global _process_pool
+    with _process_pool_lock:
+        pool, _process_pool = _process_pool, None
+    if pool is not None:
+        pool.shutdown(wait=False, cancel_futures=True)
+
+@contextmanager
+def _open_pdf(pdf_source: PdfSource):
+    """
+    Open a PDF from raw bytes or from a file path. A path is read through an open file
+    handle, so objects are read from disk as they are needed (pypdf copies the whole
+    file into memory when given a path instead)
+    """
+    from pypdf import PdfReader
+    
+    if isinstance(pdf_source, (bytes, bytearray)):
+        yield PdfReader(BytesIO(pdf_source))
+        return
+    with open(pdf_source, "rb") as handle:
+        yield PdfReader(handle)
+
+def _extract_page_range(pdf_source: PdfSource, start: int, end: int) -> List[str]:
+    """Extract text of pages [start, end) (runs in a worker process)"""
+    with _open_pdf(pdf_source) as pdf_reader:
+        return [pdf_reader.pages[i].extract_text() for i in range(start, end)]
+
+def iter_pdf_pages(pdf_source: PdfSource, progress: Optional[Callable] = None) -> Iterator[Tuple[int, str]]:
+    """
+    Yield (page_number, text) pairs with 1-based page numbers, in page order.
+    Large documents are split into page ranges and extracted across a process pool,
+    with only a bounded number of ranges in flight at a time.
+    """
+    pending = deque()
     try:
-        # Convert bytes to BytesIO for PdfReader
-        pdf_file = BytesIO(pdf_content)
-        pdf_reader = PdfReader(pdf_file)
-        text = ""
-        for page in pdf_reader.pages:
-            text += page.extract_text() + "\n"
-        return text
+        with _open_pdf(pdf_source) as pdf_reader:
+            page_count = len(pdf_reader.pages)
+            if progress:
+                progress(stage="extracting", pages_total=page_count)
+            
+            if PDF_EXTRACT_WORKERS <= 1 or page_count < PDF_PARALLEL_MIN_PAGES:
+                for i, page in enumerate(pdf_reader.pages, 1):
+                    yield i, page.extract_text()
+                    if progress:
+                        progress(pages_extracted=i)
+                return
+        
+        if isinstance(pdf_source, (bytes, bytearray)):
+            # In-memory PDFs are pickled to the workers, so send them as few times as possible
+            pages_per_task = -(-page_count // (PDF_EXTRACT_WORKERS * 2))
+        else:
+            # Workers open the file themselves; small ranges keep memory flat
+            pages_per_task = PDF_PAGES_PER_TASK
+        ranges = [(start, min(start + pages_per_task, page_count)) for start in range(0, page_count, pages_per_task)]
+        
+        pool = _get_process_pool()
+        next_range = 0
+        while next_range < len(ranges) and len(pending) < PDF_EXTRACT_WORKERS * 2:
+            pending.append((ranges[next_range], pool.submit(_extract_page_range, pdf_source, *ranges[next_range])))
+            next_range += 1
+        
+        while pending:
+            (start, end), future = pending.popleft()
+            texts = future.result()
+            if next_range < len(ranges):
+                pending.append((ranges[next_range], pool.submit(_extract_page_range, pdf_source, *ranges[next_range])))
+                next_range += 1
+            for offset, page_text in enumerate(texts):
+                yield start + offset + 1, page_text
+            if progress:
+                progress(pages_extracted=end)
     except Exception as e:
         raise Exception(f"Error extracting text from PDF: {str(e)}")
+    finally:
+        for _, future in pending:
+            future.cancel()
+
+def extract_pages_from_pdf(pdf_source: PdfSource, progress: Optional[Callable] = None) -> List[Tuple[int, str]]:
+    """Extract text from a PDF page by page. Returns (page_number, text) pairs in page order"""
+    return list(iter_pdf_pages(pdf_source, progress=progress))
 
-def chunk_text(text: str, chunk_size: int = 1000, chunk_overlap: int = 200) -> List[Dict]:
-    """Split text into chunks with metadata"""
-    text_splitter = RecursiveCharacterTextSplitter(
+def extract_text_from_pdf(pdf_source: PdfSource, progress: Optional[Callable] = None) -> str:
+    """Extract text from PDF content"""
+    return "".join(page_text + "\n" for _, page_text in iter_pdf_pages(pdf_source, progress=progress))
+
+def _text_splitter(chunk_size: int, chunk_overlap: int):
+    # langchain is slow to import, so it waits until the first document is chunked
+    from langchain.text_splitter import RecursiveCharacterTextSplitter
+    
+    return RecursiveCharacterTextSplitter(
         chunk_size=chunk_size,
         chunk_overlap=chunk_overlap,
         length_function=len,
     )
+
+def warm_pdf_processing():
+    """Import the PDF parser and text splitter ahead of the first upload"""
+    import pypdf
+    _text_splitter(1000, 200)
+
+def chunk_text(text: str, chunk_size: int = 1000, chunk_overlap: int = 200,
+               page_starts: Optional[List[int]] = None) -> List[Dict]:
+    """
+    Split text into chunks with metadata.
+    If `page_starts` (offset of each page in `text`) is given, chunks also get
+    the first and last page they cover.
+    """
+    text_splitter = _text_splitter(chunk_size, chunk_overlap)
     
     chunks = text_splitter.split_text(text)
     
     # Create chunks with unique IDs
     chunk_docs = []
+    offset = -1
     for i, chunk in enumerate(chunks):
-        chunk_docs.append({
+        chunk_doc = {
             "id": str(uuid.uuid4()),
             "text": chunk,
             "chunk_index": i,
             "total_chunks": len(chunks)
-        })
+        }
+        if page_starts:
+            # Chunks come out in order, so search forward from the previous one
+            offset = text.find(chunk, offset + 1)
+            chunk_doc["page"] = bisect.bisect_right(page_starts, offset)
+            chunk_doc["page_end"] = bisect.bisect_right(page_starts, offset + len(chunk) - 1)
+        chunk_docs.append(chunk_doc)
     
     return chunk_docs
 
-def process_pdf(pdf_content: bytes, filename: str) -> List[Dict]:
-    """Process PDF file and return chunks"""
-    # Extract text
-    text = extract_text_from_pdf(pdf_content)
+def iter_chunks(pages: Iterable[Tuple[int, str]], chunk_size: int = 1000, chunk_overlap: int = 200) -> Iterator[Dict]:
+    """
+    Chunk a stream of (page_number, text) pages with bounded memory.
+    Text is buffered until it holds about STREAM_WINDOW_CHUNKS chunks; everything
+    but the last chunk of the window is emitted, and the next window starts where
+    that last chunk did. Chunks carry their page span but no total_chunks, since
+    the total is only known at the end.
+    """
+    text_splitter = _text_splitter(chunk_size, chunk_overlap)
+    window_size = chunk_size * STREAM_WINDOW_CHUNKS
     
-    if not text.strip():
-        raise Exception("No text could be extracted from the PDF")
+    buffer = ""
+    page_starts: List[int] = []   # offset of each buffered page in `buffer`
+    page_numbers: List[int] = []
+    chunk_index = 0
     
-    # Chunk text
-    chunks = chunk_text(text)
+    def split_buffer(final: bool):
+        nonlocal buffer, page_starts, page_numbers, chunk_index
+        chunks = text_splitter.split_text(buffer)
+        keep = len(chunks) if final else len(chunks) - 1
+        
+        offset = -1
+        offsets = []
+        for chunk in chunks:
+            offset = max(buffer.find(chunk, offset + 1), offset + 1)
+            offsets.append(offset)
+        
+        emitted = []
+        for chunk, offset in zip(chunks[:keep], offsets[:keep]):
+            emitted.append({
+                "id": str(uuid.uuid4()),
+                "text": chunk,
+                "chunk_index": chunk_index,
+                "page": page_numbers[bisect.bisect_right(page_starts, offset) - 1],
+                "page_end": page_numbers[bisect.bisect_right(page_starts, offset + len(chunk) - 1) - 1]
+            })
+            chunk_index += 1
+        
+        if not final and keep > 0:
+            # Carry the unfinished tail (starting at the last chunk) into the next window
+            cut = offsets[keep]
+            first = bisect.bisect_right(page_starts, cut) - 1
+            page_numbers = page_numbers[first:]
+            page_starts = [0] + [start - cut for start in page_starts[first + 1:]]
+            buffer = buffer[cut:]
+        return emitted
     
-    # Add filename metadata to each chunk
-    for chunk in chunks:
+    for page_number, page_text in pages:
+        page_starts.append(len(buffer))
+        page_numbers.append(page_number)
+        buffer += page_text + "\n"
+        if len(buffer) >= window_size:
+            yield from split_buffer(final=False)
+    
+    if buffer.strip():
+        yield from split_buffer(final=True)
+
+def iter_pdf_chunks(pdf_source: PdfSource, filename: str, progress: Optional[Callable] = None) -> Iterator[Dict]:
+    """Stream chunks (with filename and page metadata) from a PDF as its pages are extracted"""
+    pages = timed_iter(iter_pdf_pages(pdf_source, progress=progress), "extract")
+    for chunk in timed_iter(iter_chunks(pages), "chunk"):
         chunk["filename"] = filename
         chunk["source"] = filename
+        yield chunk
+
+def process_pdf(pdf_source: PdfSource, filename: str, progress: Optional[Callable] = None) -> List[Dict]:
+    """
+    Process PDF file and return chunks.
+    `progress`, if given, is called with keyword updates (stage, pages_total, pages_extracted, ...)
+    """
+    chunks = list(iter_pdf_chunks(pdf_source, filename, progress=progress))
+    
+    if not chunks:
+        raise Exception("No text could be extracted from the PDF")
+    
+    for chunk in chunks:
+        chunk["total_chunks"] = len(chunks)
     
     return chunks
-
@@ -0,0 +1,255 @@
+"""
+Opt-in sampling profiles of single requests, kept in a bounded on-disk ring
+"""
+import asyncio
+import contextvars
+import hmac
+import ipaddress
+import json
+import os
+import random
+import re
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+from functools import reduce
+from typing import Dict, List, Optional
+from app.config import (
+    PROFILING_ENABLED,
+    PROFILE_SAMPLE_RATE,
+    PROFILE_INTERVAL,
+    PROFILE_DIR,
+    PROFILE_MAX_CAPTURES,
+    ADMIN_TOKEN,
+    ADMIN_ALLOW_LOOPBACK
+)
+from app.metrics import log, request_id_var
+
+# Requests that can be profiled
+PROFILED_ROUTES = {("POST", "/api/chat/"), ("POST", "/api/chat/stream"), ("POST", "/api/files/upload")}
+
+PROFILE_ID_PATTERN = re.compile(r"^\d{8}-\d{9}-[0-9a-f]{8}$")
+
+_capture_var: contextvars.ContextVar[Optional["Capture"]] = contextvars.ContextVar("profile_capture", default=None)
+_ring_lock = threading.Lock()
+
+def is_loopback(client_host: Optional[str]) -> bool:
+    """Whether a peer address is a loopback address (127.0.0.0/8, ::1, or IPv4-mapped 127.x)"""
+    try:
+        address = ipaddress.ip_address(client_host or "")
+    except ValueError:
+        return False
+    mapped = getattr(address, "ipv4_mapped", None)
+    return (mapped or address).is_loopback
+
+def check_admin_token(token: Optional[str], client_host: Optional[str] = None) -> bool:
+    """
+    Whether a request may use admin features: it carries ADMIN_TOKEN, or, if no token is
+    configured and ADMIN_ALLOW_LOOPBACK is on, it comes from a loopback address.
+    Everyone else is denied.
+    """
+    if not ADMIN_TOKEN:
+        return ADMIN_ALLOW_LOOPBACK and is_loopback(client_host)
+    return token is not None and hmac.compare_digest(token.encode("utf-8"), ADMIN_TOKEN.encode("utf-8"))
+
+def should_profile(headers: Dict[str, str], client_host: Optional[str] = None) -> bool:
+    """Whether to profile a request: asked for with X-Profile (by an admin), or sampled"""
+    if headers.get("x-profile", "").lower() in ("1", "true"):
+        return check_admin_token(headers.get("x-admin-token"), client_host)
+    return PROFILE_SAMPLE_RATE > 0 and random.random() < PROFILE_SAMPLE_RATE
+
+class Capture:
+    """
+    One profile: the event loop's samples for a request plus those of the database
+    threads it waited on, or the samples of the ingestion job it started
+    """
+
+    def __init__(self, kind: str, method: str, path: str):
+        self.started_at = time.time()
+        # Sortable by start time, to the millisecond
+        stamp = time.strftime("%Y%m%d-%H%M%S", time.localtime(self.started_at))
+        self.profile_id = f"{stamp}{int(self.started_at * 1000) % 1000:03d}-{uuid.uuid4().hex[:8]}"
+        self.kind = kind
+        self.method = method
+        self.path = path
+        self.request_id = request_id_var.get()
+        self.open = True
+        self._sessions = []
+        self._lock = threading.Lock()
+
+    def add(self, session):
+        with self._lock:
+            if self.open and session is not None:
+                self._sessions.append(session)
+
+    def save(self, duration: float, status: Optional[int] = None):
+        """Write the combined profile and its description to the ring, dropping the oldest beyond the bound"""
+        from pyinstrument.session import Session
+
+        with self._lock:
+            self.open = False
+            sessions = self._sessions
+        if not sessions:
+            return
+        session = reduce(Session.combine, sessions)
+
+        os.makedirs(PROFILE_DIR, exist_ok=True)
+        session.save(os.path.join(PROFILE_DIR, f"{self.profile_id}.pyisession"))
+        meta = {
+            "profile_id": self.profile_id,
+            "kind": self.kind,
+            "method": self.method,
+            "path": self.path,
+            "request_id": self.request_id,
+            "status": status,
+            "started_at": self.started_at,
+            "duration": duration,
+            "sessions": len(sessions),
+            "samples": session.sample_count
+        }
+        # The description is written last, so a listed capture always has its profile
+        meta_path = os.path.join(PROFILE_DIR, f"{self.profile_id}.json")
+        with open(meta_path + ".tmp", "w") as meta_file:
+            json.dump(meta, meta_file)
+        os.replace(meta_path + ".tmp", meta_path)
+        _prune()
+
+def _prune():
+    # Profile ids start with a timestamp, so name order is age order
+    with _ring_lock:
+        names = sorted(name[:-5] for name in os.listdir(PROFILE_DIR) if name.endswith(".json"))
+        for profile_id in names[:max(0, len(names) - PROFILE_MAX_CAPTURES)]:
+            for suffix in (".json", ".pyisession"):
+                try:
+                    os.remove(os.path.join(PROFILE_DIR, profile_id + suffix))
+                except FileNotFoundError:
+                    pass  # another worker pruned it first
+
+def profile_call(func, *args, **kwargs):
+    """Call func, sampling this thread into the current request's profile if it is being profiled"""
+    capture = _capture_var.get()
+    if capture is None or not capture.open:
+        return func(*args, **kwargs)
+    from pyinstrument import Profiler
+
+    profiler = Profiler(interval=PROFILE_INTERVAL, async_mode="disabled")
+    profiler.start()
+    try:
+        return func(*args, **kwargs)
+    finally:
+        profiler.stop()
+        capture.add(profiler.last_session)
+
+@contextmanager
+def profile_job(filename: str):
+    """Profile an ingestion job into a capture of its own if the request that started it was profiled"""
+    if _capture_var.get() is None:
+        yield
+        return
+    from pyinstrument import Profiler
+
+    capture = Capture("ingest", "JOB", filename)
+    token = _capture_var.set(capture)
+    profiler = Profiler(interval=PROFILE_INTERVAL, async_mode="disabled")
+    started = time.perf_counter()
+    profiler.start()
+    try:
+        yield
+    finally:
+        profiler.stop()
+        _capture_var.reset(token)
+        capture.add(profiler.last_session)
+        try:
+            capture.save(time.perf_counter() - started)
+        except Exception as e:
+            log(f"Warning: could not save profile {capture.profile_id}: {e}")
+
+class ProfilingMiddleware:
+    """
+    ASGI middleware that records a sampling profile of requests picked by should_profile()
+    and names the capture in an X-Profile-ID response header
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if (
+            not PROFILING_ENABLED
+            or scope["type"] != "http"
+            or (scope["method"], scope["path"]) not in PROFILED_ROUTES
+            or not should_profile(
+                {name.decode("latin-1"): value.decode("latin-1") for name, value in scope["headers"]},
+                (scope.get("client") or (None,))[0]
+            )
+        ):
+            await self.app(scope, receive, send)
+            return
+        from pyinstrument import Profiler
+
+        capture = Capture("request", scope["method"], scope["path"])
+        status = None
+
+        async def send_with_id(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+                message["headers"] = list(message.get("headers", [])) + [(b"x-profile-id", capture.profile_id.encode("latin-1"))]
+            await send(message)
+
+        token = _capture_var.set(capture)
+        # "enabled" follows this request's task across awaits and leaves out other requests
+        profiler = Profiler(interval=PROFILE_INTERVAL, async_mode="enabled")
+        started = time.perf_counter()
+        profiler.start()
+        try:
+            await self.app(scope, receive, send_with_id)
+        finally:
+            profiler.stop()
+            _capture_var.reset(token)
+            capture.add(profiler.last_session)
+            duration = time.perf_counter() - started
+            try:
+                # Combining and writing the profile is done off the event loop
+                await asyncio.get_running_loop().run_in_executor(None, capture.save, duration, status)
+            except Exception as e:
+                log(f"Warning: could not save profile {capture.profile_id}: {e}")
+
+def list_captures() -> List[Dict]:
+    """Descriptions of the stored captures, newest first"""
+    if not os.path.isdir(PROFILE_DIR):
+        return []
+    captures = []
+    for name in sorted(os.listdir(PROFILE_DIR), reverse=True):
+        if not name.endswith(".json"):
+            continue
+        try:
+            with open(os.path.join(PROFILE_DIR, name)) as meta_file:
+                captures.append(json.load(meta_file))
+        except (FileNotFoundError, json.JSONDecodeError):
+            pass  # pruned or being written by another worker
+    return captures
+
+def capture_path(profile_id: str) -> Optional[str]:
+    """Path of a stored profile, or None if there is no such capture"""
+    if not PROFILE_ID_PATTERN.match(profile_id):
+        return None
+    path = os.path.join(PROFILE_DIR, f"{profile_id}.pyisession")
+    return path if os.path.exists(path) else None
+
+def render_capture(profile_id: str, format: str) -> Optional[str]:
+    """A stored profile rendered as "html" (interactive) or "text" (call tree), or None if there is no such capture"""
+    from pyinstrument.renderers import ConsoleRenderer, HTMLRenderer
+    from pyinstrument.session import Session
+
+    path = capture_path(profile_id)
+    if path is None:
+        return None
+    try:
+        session = Session.load(path)
+    except FileNotFoundError:
+        return None
+    if format == "html":
+        return HTMLRenderer().render(session)
+    return ConsoleRenderer(unicode=True, color=False).render(session)
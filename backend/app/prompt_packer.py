@@ -0,0 +1,177 @@
+"""
+Token-budgeted prompt packing and rolling summaries of conversation history
+"""
+import asyncio
+from typing import Dict, List, Optional, Set, Tuple
+from app.tokens import count_tokens, truncate_to_tokens
+from app.metrics import timed_operation, stage, count_error, log, LLM_IN_FLIGHT, TOKENS
+from app.config import (
+    PROMPT_TOKEN_BUDGET,
+    PROMPT_HISTORY_TOKENS,
+    PROMPT_HISTORY_MESSAGES,
+    HISTORY_SUMMARY_ENABLED,
+    HISTORY_SUMMARY_TOKENS
+)
+
+# A passage cut down to fewer tokens than this isn't worth including
+MIN_PASSAGE_TOKENS = 50
+
+# Summarize once this many messages have aged out of the recent window
+SUMMARY_BATCH_MESSAGES = 4
+
+SUMMARY_PROMPT = """Summarize the conversation below for an assistant that will continue it.
+Keep the facts, names, numbers and open questions that later answers may depend on.
+Use at most {max_words} words.
+
+Summary so far:
+{summary}
+
+New messages:
+{messages}
+
+Updated summary:"""
+
+def format_messages(messages: List[Dict]) -> List[str]:
+    return [f"{'Human' if msg['role'] == 'user' else 'Assistant'}: {msg['content']}" for msg in messages]
+
+def pack_history(summary: Optional[str], messages: List[Dict], budget: int) -> Tuple[str, Dict]:
+    """
+    Chat history text within `budget` tokens: the rolling summary first, then as many
+    of the latest messages as fit. Returns the text and its token counts
+    """
+    parts: List[str] = []
+    used = 0
+    summary_tokens = 0
+    if summary:
+        summary_text = truncate_to_tokens(f"Summary of earlier conversation: {summary}", budget)
+        summary_tokens = count_tokens(summary_text)
+        used += summary_tokens
+    
+    included = 0
+    for line in reversed(format_messages(messages)):
+        tokens = count_tokens(line)
+        if used + tokens > budget:
+            break
+        parts.insert(0, line)
+        used += tokens
+        included += 1
+    if summary_tokens:
+        parts.insert(0, summary_text)
+    
+    return "\n".join(parts), {
+        "summary_tokens": summary_tokens,
+        "history_tokens": used - summary_tokens,
+        "history_messages": included,
+        "history_messages_dropped": len(messages) - included
+    }
+
+def pack_context(results: List[Dict], budget: int) -> Tuple[str, List[Dict], Dict]:
+    """
+    Context text within `budget` tokens, filled with passages in relevance order. The
+    first passage that doesn't fit is truncated if enough room is left, and packing stops
+    there. Returns the text, the results it includes and its token counts
+    """
+    parts: List[str] = []
+    included: List[Dict] = []
+    used = 0
+    truncated = 0
+    for result in results:
+        doc_text = result.get("document", "")
+        source = result.get("metadata", {}).get("filename", "Unknown")
+        part = f"[Source {len(parts) + 1}: {source}]\n{doc_text}\n"
+        tokens = count_tokens(part)
+        if used + tokens > budget:
+            room = budget - used - count_tokens(f"[Source {len(parts) + 1}: {source}]\n")
+            if room >= MIN_PASSAGE_TOKENS:
+                part = f"[Source {len(parts) + 1}: {source}]\n{truncate_to_tokens(doc_text, room)}\n"
+                parts.append(part)
+                included.append(result)
+                used += count_tokens(part)
+                truncated += 1
+            break
+        parts.append(part)
+        included.append(result)
+        used += tokens
+    
+    return "\n\n".join(parts), included, {
+        "context_tokens": used,
+        "passages": len(included),
+        "passages_truncated": truncated,
+        "passages_dropped": len(results) - len(included)
+    }
+
+def pack_prompt(template: str, question: str, results: List[Dict], summary: Optional[str],
+                history: List[Dict]) -> Tuple[str, List[Dict], Dict]:
+    """
+    Fill `template` (with {context}, {chat_history} and {question}) within PROMPT_TOKEN_BUDGET.
+    The template and question always go in; history gets up to PROMPT_HISTORY_TOKENS and
+    context the rest. Returns the prompt, the results used as context and token counts
+    """
+    fixed_tokens = count_tokens(template.format(context="", chat_history="", question=question))
+    history_text, history_usage = pack_history(
+        summary, history, min(PROMPT_HISTORY_TOKENS, max(0, PROMPT_TOKEN_BUDGET - fixed_tokens))
+    )
+    context_budget = max(0, PROMPT_TOKEN_BUDGET - fixed_tokens - count_tokens(history_text))
+    context_text, included, context_usage = pack_context(results, context_budget)
+    
+    prompt = template.format(context=context_text, chat_history=history_text, question=question)
+    return prompt, included, {
+        "prompt_tokens": count_tokens(prompt),
+        "budget": PROMPT_TOKEN_BUDGET,
+        "question_tokens": count_tokens(question),
+        **history_usage,
+        **context_usage
+    }
+
+_refreshing: Set[str] = set()
+_refresh_tasks: Set[asyncio.Task] = set()
+
+async def refresh_summary(conversation_id: str) -> bool:
+    """
+    Fold messages that have aged out of the recent window into the conversation's rolling
+    summary. Does nothing until SUMMARY_BATCH_MESSAGES of them have built up. Returns
+    whether the summary changed
+    """
+    # Imported here so packing doesn't pull in the LLM client
+    from app.llm import get_llm
+    from app.conversations import get_conversation_store
+    from app.database import run_db
+    
+    store = get_conversation_store()
+    summary, messages = await run_db(store.unsummarized, conversation_id, PROMPT_HISTORY_MESSAGES)
+    if len(messages) < SUMMARY_BATCH_MESSAGES:
+        return False
+    
+    prompt = SUMMARY_PROMPT.format(
+        max_words=int(HISTORY_SUMMARY_TOKENS * 0.75),
+        summary=summary or "(none)",
+        messages="\n".join(format_messages(messages))
+    )
+    with stage("llm"), LLM_IN_FLIGHT.track_inprogress():
+        response = await get_llm().ainvoke(prompt)
+    text = response.content if hasattr(response, 'content') else str(response)
+    TOKENS.labels("prompt").inc(count_tokens(prompt))
+    TOKENS.labels("completion").inc(count_tokens(text))
+    text = truncate_to_tokens(text.strip(), HISTORY_SUMMARY_TOKENS)
+    return await run_db(store.set_summary, conversation_id, text, messages[-1]["seq"])
+
+async def _refresh_summary_safely(conversation_id: str):
+    try:
+        # Logged under the id of the request whose exchange triggered the refresh
+        with timed_operation("summary"):
+            await refresh_summary(conversation_id)
+    except Exception as e:
+        count_error("summary", e)
+        log(f"Warning: could not summarize conversation {conversation_id}: {e}")
+    finally:
+        _refreshing.discard(conversation_id)
+
+def schedule_summary_refresh(conversation_id: str):
+    """Refresh a conversation's rolling summary in the background, off the response path"""
+    if not HISTORY_SUMMARY_ENABLED or conversation_id in _refreshing:
+        return
+    _refreshing.add(conversation_id)
+    task = asyncio.create_task(_refresh_summary_safely(conversation_id))
+    # Keep a reference until it finishes, or the task may be garbage collected
+    _refresh_tasks.add(task)
+    task.add_done_callback(_refresh_tasks.discard)
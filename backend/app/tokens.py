@@ -0,0 +1,42 @@
+"""
+Token counting for budgeting embedding and LLM requests
+"""
+import threading
+from app.config import EMBEDDING_MODEL
+
+_encoding = None
+_encoding_failed = False
+_encoding_lock = threading.Lock()
+
+def _get_encoding():
+    """Load the tiktoken encoding once; None if tiktoken or its encoding files are unavailable"""
+    global _encoding, _encoding_failed
+    if _encoding is None and not _encoding_failed:
+        with _encoding_lock:
+            if _encoding is None and not _encoding_failed:
+                try:
+                    import tiktoken
+                    try:
+                        _encoding = tiktoken.encoding_for_model(EMBEDDING_MODEL)
+                    except KeyError:
+                        _encoding = tiktoken.get_encoding("cl100k_base")
+                except Exception:
+                    _encoding_failed = True
+    return _encoding
+
+def count_tokens(text: str) -> int:
+    """Count tokens in text, estimating ~4 characters per token when tiktoken can't be used"""
+    encoding = _get_encoding()
+    if encoding is not None:
+        return len(encoding.encode(text, disallowed_special=()))
+    return len(text) // 4 + 1
+
+def truncate_to_tokens(text: str, max_tokens: int) -> str:
+    """Cut text down to at most `max_tokens` tokens"""
+    if max_tokens <= 0:
+        return ""
+    encoding = _get_encoding()
+    if encoding is not None:
+        tokens = encoding.encode(text, disallowed_special=())
+        return text if len(tokens) <= max_tokens else encoding.decode(tokens[:max_tokens])
+    return text[:max_tokens * 4]
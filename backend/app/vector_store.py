@@ -1,135 +1,799 @@
 """
 Vector store operations using ChromaDB
 """
-from typing import List, Dict, Optional
-from app.database import get_collection
-from app.embeddings import get_embeddings
-from app.pdf_processor import process_pdf
+from typing import List, Dict, Optional, Callable, Tuple
+from collections import deque
+from app.database import get_collection, run_db
+from app.file_registry import get_file_registry
+from app.embeddings import get_embeddings, embed_documents_cached, get_embedding_dimension, embedding_model_id
+from app.pdf_processor import iter_pdf_chunks, PdfSource
+from app.cache import query_embedding_cache
+from app.dedup import NearDuplicateFilter, get_near_duplicate_index
+from app.keyword_index import get_keyword_index, looks_like_lookup
+from app.mmr import mmr_select, merge_adjacent_chunks
+from app.metrics import timed_operation, stage, log, TOKENS
+from app.tokens import count_tokens
+from app.config import (
+    INGEST_BATCH_SIZE,
+    HYBRID_CANDIDATES,
+    RRF_K,
+    KEYWORD_FAST_PATH,
+    KEYWORD_FAST_PATH_MIN_SCORE,
+    MMR_ENABLED,
+    MMR_FETCH_K,
+    MMR_LAMBDA,
+    FILE_LOCK_DIR,
+    VECTOR_QUERY_RETRIES,
+    EMBEDDING_PROVIDER
+)
+from contextlib import contextmanager
 import hashlib
+import os
+import threading
+import time
 
-def add_pdf_to_store(pdf_content: bytes, filename: str) -> Dict:
-    """Add PDF file to ChromaDB"""
-    collection = get_collection()
-    embeddings_model = get_embeddings()
-    
-    # Process PDF
-    chunks = process_pdf(pdf_content, filename)
-    
-    if not chunks:
-        raise Exception("No chunks created from PDF")
-    
-    # Generate embeddings
+try:
+    import fcntl
+except ImportError:  # Windows: writes are only serialized within one process
+    fcntl = None
+
+# Most extra results fetched per query to make up for hidden (staged/retired) chunks
+MAX_HIDDEN_OVERFETCH = 200
+
+_file_locks: Dict[str, threading.Lock] = {}
+_file_locks_guard = threading.Lock()
+
+@contextmanager
+def _file_lock(filename: str, blocking: bool = True):
+    """
+    Serialize writes (add/update/delete) to one file across threads and worker processes.
+    With blocking=False, yields False right away instead of waiting when someone else holds it
+    """
+    with _file_locks_guard:
+        lock = _file_locks.setdefault(filename, threading.Lock())
+    if not lock.acquire(blocking):
+        yield False
+        return
+    try:
+        if fcntl is None:
+            yield True
+            return
+        os.makedirs(FILE_LOCK_DIR, exist_ok=True)
+        path = os.path.join(FILE_LOCK_DIR, hashlib.sha1(filename.encode("utf-8")).hexdigest() + ".lock")
+        with open(path, "a") as handle:
+            try:
+                fcntl.flock(handle, fcntl.LOCK_EX if blocking else fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                yield False
+                return
+            try:
+                yield True
+            finally:
+                fcntl.flock(handle, fcntl.LOCK_UN)
+    finally:
+        lock.release()
+
+def chunk_content_hash(text: str) -> str:
+    """Content hash of a chunk, used to diff file versions"""
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+def _write_chunk_batch(collection, chunks: List[Dict]) -> int:
+    """
+    Embed a batch of chunks and add it to the collection. Chunks that already carry
+    an "embedding" aren't embedded again. Returns the number of embedding cache hits
+    """
     texts = [chunk["text"] for chunk in chunks]
-    embeddings = embeddings_model.embed_documents(texts)
-    
-    # Prepare data for ChromaDB
-    ids = [chunk["id"] for chunk in chunks]
-    metadatas = [
-        {
-            "filename": chunk["filename"],
-            "source": chunk["source"],
-            "chunk_index": chunk["chunk_index"],
-            "total_chunks": chunk["total_chunks"]
-        }
+    
+    # Generate embeddings (chunks seen before are served from the embedding cache)
+    to_embed = [chunk["text"] for chunk in chunks if chunk.get("embedding") is None]
+    with stage("embed"):
+        new_embeddings, cache_hits = embed_documents_cached(to_embed)
+    new_embeddings = iter(new_embeddings)
+    embeddings = [
+        chunk["embedding"] if chunk.get("embedding") is not None else next(new_embeddings)
         for chunk in chunks
     ]
     
-    # Add to collection
-    collection.add(
-        ids=ids,
-        embeddings=embeddings,
-        documents=texts,
-        metadatas=metadatas
-    )
+    with stage("write"):
+        collection.add(
+            ids=[chunk["id"] for chunk in chunks],
+            embeddings=embeddings,
+            documents=texts,
+            metadatas=[
+                {
+                    "filename": chunk["filename"],
+                    "source": chunk["source"],
+                    "chunk_index": chunk["chunk_index"],
+                    "page": chunk["page"],
+                    "page_end": chunk["page_end"]
+                }
+                for chunk in chunks
+            ]
+        )
+        keyword_index = get_keyword_index()
+        if keyword_index is not None:
+            keyword_index.add([(chunk["id"], chunk["text"]) for chunk in chunks])
+    return cache_hits
+
+def _stage_chunk_batch(collection, registry, filename: str, chunks: List[Dict]) -> int:
+    """Write a batch of chunks hidden from search until their file version is committed"""
+    registry.stage_chunks(filename, [chunk["id"] for chunk in chunks])
+    return _write_chunk_batch(collection, chunks)
+
+def _delete_chunks(collection, registry, chunk_ids: List[str]):
+    """Delete chunks from the collection, its side indexes and the hidden markers"""
+    near_duplicate_index = get_near_duplicate_index()
+    keyword_index = get_keyword_index()
+    for start in range(0, len(chunk_ids), INGEST_BATCH_SIZE):
+        batch_ids = chunk_ids[start:start + INGEST_BATCH_SIZE]
+        collection.delete(ids=batch_ids)
+        if keyword_index is not None:
+            keyword_index.remove(batch_ids)
+        registry.forget_hidden(batch_ids)
+        if near_duplicate_index is not None:
+            near_duplicate_index.remove(batch_ids)
+
+def _set_total_chunks(collection, chunk_ids: List[str], total: int):
+    """The chunk count is only known at the end; metadata updates merge into the existing records"""
+    for start in range(0, len(chunk_ids), INGEST_BATCH_SIZE):
+        batch_ids = chunk_ids[start:start + INGEST_BATCH_SIZE]
+        collection.update(ids=batch_ids, metadatas=[{"total_chunks": total}] * len(batch_ids))
+
+def hash_pdf_source(pdf_source: PdfSource) -> Tuple[str, int]:
+    """SHA-256 and size in bytes of a PDF given as bytes or a file path"""
+    digest = hashlib.sha256()
+    if isinstance(pdf_source, (bytes, bytearray)):
+        digest.update(pdf_source)
+        return digest.hexdigest(), len(pdf_source)
     
+    size = 0
+    with open(pdf_source, "rb") as pdf_file:
+        for block in iter(lambda: pdf_file.read(1024 * 1024), b""):
+            digest.update(block)
+            size += len(block)
+    return digest.hexdigest(), size
+
+def _borrowed_positions(near_duplicates: NearDuplicateFilter) -> Dict[str, Dict]:
+    """Where each chunk dropped for matching another file's chunk was, keyed by the stored chunk's id"""
     return {
-        "filename": filename,
-        "chunks_added": len(chunks),
-        "status": "success"
+        chunk_id: {"chunk_index": chunk["chunk_index"], "page": chunk["page"], "page_end": chunk["page_end"]}
+        for chunk_id, chunk in near_duplicates.borrowed.items()
     }
 
-def search_similar_documents(query: str, n_results: int = 5) -> List[Dict]:
-    """Search for similar documents in ChromaDB"""
+def _store_missing_borrowed(collection, registry, filename: str, near_duplicates: NearDuplicateFilter,
+                            missing: List[str], content_hash: str, byte_size: int):
+    """
+    Store a file's own copies of chunks it dropped for matching another file's chunk that
+    was deleted before the file was committed
+    """
+    chunks = [near_duplicates.borrowed[chunk_id] for chunk_id in missing]
+    try:
+        for start in range(0, len(chunks), INGEST_BATCH_SIZE):
+            batch = chunks[start:start + INGEST_BATCH_SIZE]
+            _stage_chunk_batch(collection, registry, filename, batch)
+            for chunk in batch:
+                near_duplicates.remember(chunk["id"], chunk["text"])
+            registry.add_chunks(filename, [chunk["id"] for chunk in batch], content_hash, byte_size,
+                                chunk_hashes=[chunk_content_hash(chunk["text"]) for chunk in batch])
+            near_duplicates.commit(chunk["id"] for chunk in batch)
+    except Exception as e:
+        log(f"Warning: could not store {len(chunks)} chunks of '{filename}' whose stored duplicates were deleted: {e}")
+
+def _hand_over_chunks(collection, handed: Dict[str, Dict]):
+    """Cite chunks taken over by the files that borrowed them under those files' names and positions"""
+    by_target: Dict[Tuple, List[str]] = {}
+    for chunk_id, metadata in handed.items():
+        by_target.setdefault(tuple(sorted(metadata.items())), []).append(chunk_id)
+    for target, chunk_ids in by_target.items():
+        collection.update(ids=chunk_ids, metadatas=[dict(target)] * len(chunk_ids))
+
+@timed_operation("ingest")
+def add_pdf_to_store(pdf_source: PdfSource, filename: str, progress: Optional[Callable] = None,
+                     source_hash: Optional[Tuple[str, int]] = None) -> Dict:
+    """
+    Add PDF file to ChromaDB.
+    The file is streamed page -> chunk -> embed -> write in batches of INGEST_BATCH_SIZE
+    chunks, so memory use doesn't grow with document size. Pass a file path rather than
+    bytes: the PDF is then read from disk as pages are parsed, in this process and in the
+    page-extraction workers, instead of being held in memory. Chunks stay hidden from search until the
+    whole file is written. Near-duplicates of stored chunks or of earlier chunks of the
+    file (boilerplate, repeated disclaimers) are dropped before embedding; the file keeps
+    a reference to another file's chunk it relies on, and takes that chunk over if the
+    other file is deleted or updated.
+    `progress`, if given, is called with keyword updates (pages_extracted, chunks_embedded, ...)
+    `source_hash` is (sha256, size) as from hash_pdf_source, if the caller already has it
+    """
     collection = get_collection()
-    embeddings_model = get_embeddings()
+    registry = get_file_registry()
     
-    # Generate query embedding
-    query_embedding = embeddings_model.embed_query(query)
+    ids_written: List[str] = []
+    chunk_hashes: List[str] = []
+    cache_hits = 0
+    batch: List[Dict] = []
+    near_duplicates = NearDuplicateFilter(get_near_duplicate_index())
+    with _file_lock(filename):
+        try:
+            for chunk in iter_pdf_chunks(pdf_source, filename, progress=progress):
+                if not near_duplicates.admit(chunk):
+                    continue
+                batch.append(chunk)
+                if len(batch) >= INGEST_BATCH_SIZE:
+                    cache_hits += _stage_chunk_batch(collection, registry, filename, batch)
+                    ids_written.extend(chunk["id"] for chunk in batch)
+                    chunk_hashes.extend(chunk_content_hash(chunk["text"]) for chunk in batch)
+                    batch = []
+                    if progress:
+                        progress(chunks_embedded=len(ids_written), chunks_written=len(ids_written))
+            if batch:
+                cache_hits += _stage_chunk_batch(collection, registry, filename, batch)
+                ids_written.extend(chunk["id"] for chunk in batch)
+                chunk_hashes.extend(chunk_content_hash(chunk["text"]) for chunk in batch)
+            
+            # A file made up entirely of content that is already stored is still registered
+            if not ids_written and not near_duplicates.removed:
+                raise Exception("No text could be extracted from the PDF")
+            
+            total = len(ids_written)
+            if progress:
+                progress(stage="finalizing", chunks_total=total, chunks_embedded=total, chunks_written=total)
+            with stage("write"):
+                _set_total_chunks(collection, ids_written, total)
+                
+                # Record the file in the registry (which also makes its chunks searchable)
+                content_hash, byte_size = source_hash or hash_pdf_source(pdf_source)
+                missing = registry.add_chunks(
+                    filename, ids_written, content_hash, byte_size, chunk_hashes=chunk_hashes,
+                    borrowed=_borrowed_positions(near_duplicates)
+                )
+        except Exception:
+            # Don't leave a partially ingested file behind
+            _delete_chunks(collection, registry, ids_written)
+            raise
+        near_duplicates.commit(ids_written)
+        if missing:
+            _store_missing_borrowed(collection, registry, filename, near_duplicates, missing, content_hash, byte_size)
     
-    # Search in ChromaDB
-    results = collection.query(
-        query_embeddings=[query_embedding],
-        n_results=n_results,
-        include=["documents", "metadatas", "distances"]
-    )
-    
-    # Format results
+    return {
+        "filename": filename,
+        "chunks_added": len(ids_written) + len(missing),
+        "near_duplicates_removed": near_duplicates.removed - len(missing),
+        "embeddings_from_cache": cache_hits,
+        "status": "success"
+    }
+
+def embed_query_cached(query: str) -> List[float]:
+    """Embedding of a query, served from the query cache when it was asked recently"""
+    query_embedding = query_embedding_cache.get(query)
+    if query_embedding is None:
+        with stage("embed_query"):
+            query_embedding = get_embeddings().embed_query(query)
+        if EMBEDDING_PROVIDER != "local":
+            TOKENS.labels("embedding").inc(count_tokens(query))
+        query_embedding_cache.put(query, query_embedding)
+    return query_embedding
+
+async def aembed_query_cached(query: str) -> List[float]:
+    """Async version of embed_query_cached"""
+    query_embedding = query_embedding_cache.get(query)
+    if query_embedding is None:
+        with stage("embed_query"):
+            query_embedding = await get_embeddings().aembed_query(query)
+        if EMBEDDING_PROVIDER != "local":
+            TOKENS.labels("embedding").inc(count_tokens(query))
+        query_embedding_cache.put(query, query_embedding)
+    return query_embedding
+
+def get_corpus_version() -> int:
+    """Version of the stored corpus; changes with every upload, update and delete"""
+    return get_file_registry().corpus_version()
+
+def _format_query_results(results: Dict) -> List[Dict]:
+    """
+    Flatten a single-query ChromaDB result into a list of hits. A chunk deleted while the
+    query ran can come back without its record; it is left out
+    """
     formatted_results = []
     if results["ids"] and len(results["ids"][0]) > 0:
         for i in range(len(results["ids"][0])):
+            if results["metadatas"][0][i] is None or results["documents"][0][i] is None:
+                continue
             formatted_results.append({
                 "id": results["ids"][0][i],
                 "document": results["documents"][0][i],
                 "metadata": results["metadatas"][0][i],
                 "distance": results["distances"][0][i] if results["distances"] else None
             })
+            if results.get("embeddings"):
+                formatted_results[-1]["embedding"] = results["embeddings"][0][i]
     
     return formatted_results
 
-def list_all_files() -> List[Dict]:
-    """List all unique files in ChromaDB"""
+def _query_visible(collection, query_embedding: List[float], n_results: int,
+                   include_embeddings: bool = False) -> List[Dict]:
+    """
+    Nearest chunks to an embedding, leaving out chunks hidden from search (those of a
+    file version still being written, or of a replaced version not yet deleted)
+    """
+    registry = get_file_registry()
+    hidden = registry.hidden_count()
+    
+    include = ["documents", "metadatas", "distances"]
+    if include_embeddings:
+        include.append("embeddings")
+    for attempt in range(VECTOR_QUERY_RETRIES + 1):
+        try:
+            with stage("vector_query"):
+                results = collection.query(
+                    query_embeddings=[query_embedding],
+                    n_results=n_results + min(hidden, MAX_HIDDEN_OVERFETCH),
+                    include=include
+                )
+            break
+        except Exception as e:
+            # Chroma can fail a query that runs while chunks are added or deleted (e.g. an
+            # IndexError from its vector index); the same query succeeds once the write is through
+            if attempt == VECTOR_QUERY_RETRIES:
+                raise
+            log(f"Vector query failed (attempt {attempt + 1} of {VECTOR_QUERY_RETRIES + 1}), retrying: {e}")
+            time.sleep(0.05 * 2 ** attempt)
+    hits = _format_query_results(results)
+    
+    if hidden:
+        hidden_ids = registry.hidden_among([hit["id"] for hit in hits])
+        hits = [hit for hit in hits if hit["id"] not in hidden_ids]
+    return hits[:n_results]
+
+def reciprocal_rank_fusion(rankings: List[List[str]], k: int = RRF_K) -> List[Tuple[str, float]]:
+    """Fuse several rankings of ids: each id scores the sum of 1 / (k + rank) over the rankings it is in"""
+    scores: Dict[str, float] = {}
+    for ranking in rankings:
+        for rank, chunk_id in enumerate(ranking, 1):
+            scores[chunk_id] = scores.get(chunk_id, 0.0) + 1.0 / (k + rank)
+    return sorted(scores.items(), key=lambda item: item[1], reverse=True)
+
+def _keyword_ranking(query: str, limit: int, require_all: bool = False) -> List[Tuple[str, float]]:
+    """Keyword-index matches (id, BM25 score), leaving out chunks hidden from search"""
+    keyword_index = get_keyword_index()
+    if keyword_index is None:
+        return []
+    registry = get_file_registry()
+    hidden = registry.hidden_count()
+    with stage("keyword_query"):
+        ranked = keyword_index.search(query, limit + min(hidden, MAX_HIDDEN_OVERFETCH), require_all=require_all)
+    if hidden:
+        hidden_ids = registry.hidden_among([chunk_id for chunk_id, _ in ranked])
+        ranked = [item for item in ranked if item[0] not in hidden_ids]
+    return ranked[:limit]
+
+def _fetch_hits(collection, chunk_ids: List[str], include_embeddings: bool = False) -> Dict[str, Dict]:
+    """Documents and metadata of chunks by id, shaped like query hits (without a distance)"""
+    if not chunk_ids:
+        return {}
+    include = ["documents", "metadatas", "embeddings"] if include_embeddings else ["documents", "metadatas"]
+    with stage("fetch"):
+        page = collection.get(ids=chunk_ids, include=include)
+    hits = {
+        chunk_id: {"id": chunk_id, "document": document, "metadata": metadata, "distance": None}
+        for chunk_id, document, metadata in zip(page["ids"], page["documents"], page["metadatas"])
+        if document is not None and metadata is not None
+    }
+    if include_embeddings:
+        for chunk_id, embedding in zip(page["ids"], page["embeddings"]):
+            if chunk_id in hits:
+                hits[chunk_id]["embedding"] = embedding
+    return hits
+
+def _keyword_lookup(collection, query: str, n_results: int) -> List[Dict]:
+    """
+    Hits from the keyword index alone for an identifier lookup, best first: chunks holding
+    every identifier of the query. Empty (so the caller runs hybrid search) when nothing
+    matches or the best match scores below KEYWORD_FAST_PATH_MIN_SCORE, i.e. the identifier
+    is too common in the corpus for BM25 to tell the chunks apart.
+    """
+    ranked = _keyword_ranking(query, n_results, require_all=True)
+    if not ranked or ranked[0][1] < KEYWORD_FAST_PATH_MIN_SCORE:
+        return []
+    hits = _fetch_hits(collection, [chunk_id for chunk_id, _ in ranked])
+    return [dict(hits[chunk_id], score=score) for chunk_id, score in ranked if chunk_id in hits]
+
+def _hybrid_search(collection, query: str, query_embedding: List[float], n_results: int,
+                   include_embeddings: bool = False) -> List[Dict]:
+    """Vector hits fused with keyword-index hits by reciprocal rank fusion"""
+    candidates = max(n_results, HYBRID_CANDIDATES)
+    vector_hits = _query_visible(collection, query_embedding, candidates, include_embeddings=include_embeddings)
+    keyword_ranked = _keyword_ranking(query, candidates)
+    if not keyword_ranked:
+        return vector_hits[:n_results]
+    
+    fused = reciprocal_rank_fusion([
+        [hit["id"] for hit in vector_hits],
+        [chunk_id for chunk_id, _ in keyword_ranked]
+    ])[:n_results]
+    
+    hits = {hit["id"]: hit for hit in vector_hits}
+    hits.update(_fetch_hits(
+        collection,
+        [chunk_id for chunk_id, _ in fused if chunk_id not in hits],
+        include_embeddings=include_embeddings
+    ))
+    return [dict(hits[chunk_id], score=score) for chunk_id, score in fused if chunk_id in hits]
+
+def search_similar_documents(query: str, n_results: int = 5) -> List[Dict]:
+    """
+    Search for documents relevant to a query: dense vector search fused with keyword
+    search. Identifier lookups are served from the keyword index when it has a clear match
+    """
     collection = get_collection()
     
-    # Get all data
-    all_data = collection.get()
-    
-    # Extract unique filenames
-    unique_files = {}
-    if all_data["metadatas"]:
-        for i, metadata in enumerate(all_data["metadatas"]):
-            filename = metadata.get("filename", "unknown")
-            if filename not in unique_files:
-                unique_files[filename] = {
-                    "filename": filename,
-                    "chunk_count": 0,
-                    "ids": []
-                }
-            unique_files[filename]["chunk_count"] += 1
-            unique_files[filename]["ids"].append(all_data["ids"][i])
+    if KEYWORD_FAST_PATH and looks_like_lookup(query):
+        hits = _keyword_lookup(collection, query, n_results)
+        if hits:
+            return hits
     
-    return list(unique_files.values())
+    # Generate query embedding (repeated questions are served from the query cache)
+    query_embedding = embed_query_cached(query)
+    
+    # Search in ChromaDB and the keyword index
+    return _hybrid_search(collection, query, query_embedding, n_results)
 
-def delete_file(filename: str) -> Dict:
-    """Delete all chunks associated with a filename"""
+async def asearch_similar_documents(query: str, n_results: int = 5) -> List[Dict]:
+    """Async version of search_similar_documents that never blocks the event loop"""
+    collection = get_collection()
+    
+    if KEYWORD_FAST_PATH and looks_like_lookup(query):
+        hits = await run_db(_keyword_lookup, collection, query, n_results)
+        if hits:
+            return hits
+    
+    query_embedding = await aembed_query_cached(query)
+    
+    return await run_db(_hybrid_search, collection, query, query_embedding, n_results)
+
+def _diversify(hits: List[Dict], query_embedding: Optional[List[float]], n_results: int) -> List[Dict]:
+    """Pick n_results of the candidates by MMR (when embeddings are at hand), then merge neighbouring chunks"""
+    if query_embedding is not None and len(hits) > n_results and all(hit.get("embedding") is not None for hit in hits):
+        # Relevance follows the fused ranking, so keyword matches aren't judged by embedding alone
+        scores = [hit.get("score") for hit in hits]
+        relevance = [score / scores[0] for score in scores] if all(scores) else None
+        selected = mmr_select(query_embedding, [hit["embedding"] for hit in hits], n_results, MMR_LAMBDA, relevance)
+        hits = [hits[i] for i in selected]
+    else:
+        hits = hits[:n_results]
+    for hit in hits:
+        hit.pop("embedding", None)
+    return merge_adjacent_chunks(hits)
+
+def _retrieve(collection, query: str, query_embedding: List[float], n_results: int) -> List[Dict]:
+    if not MMR_ENABLED:
+        return merge_adjacent_chunks(_hybrid_search(collection, query, query_embedding, n_results))
+    candidates = _hybrid_search(collection, query, query_embedding, max(n_results, MMR_FETCH_K), include_embeddings=True)
+    return _diversify(candidates, query_embedding, n_results)
+
+def retrieve_context(query: str, n_results: int = 5) -> List[Dict]:
+    """
+    Passages to put in a prompt: over-fetched hybrid search results diversified by
+    maximal marginal relevance, with adjacent chunks of a file merged into one passage
+    """
+    collection = get_collection()
+    
+    if KEYWORD_FAST_PATH and looks_like_lookup(query):
+        hits = _keyword_lookup(collection, query, n_results)
+        if hits:
+            return merge_adjacent_chunks(hits)
+    
+    query_embedding = embed_query_cached(query)
+    
+    return _retrieve(collection, query, query_embedding, n_results)
+
+async def aretrieve_context(query: str, n_results: int = 5) -> List[Dict]:
+    """Async version of retrieve_context that never blocks the event loop"""
     collection = get_collection()
     
-    # Get all data
-    all_data = collection.get()
+    if KEYWORD_FAST_PATH and looks_like_lookup(query):
+        hits = await run_db(_keyword_lookup, collection, query, n_results)
+        if hits:
+            return merge_adjacent_chunks(hits)
     
-    # Find IDs to delete
-    ids_to_delete = []
-    if all_data["metadatas"]:
-        for i, metadata in enumerate(all_data["metadatas"]):
-            if metadata.get("filename") == filename:
-                ids_to_delete.append(all_data["ids"][i])
+    query_embedding = await aembed_query_cached(query)
     
-    if not ids_to_delete:
-        raise Exception(f"File '{filename}' not found in database")
+    return await run_db(_retrieve, collection, query, query_embedding, n_results)
+
+def list_files_page(offset: int = 0, limit: int = 100) -> Tuple[List[Dict], int]:
+    """A page of file summaries (without chunk ids) and the total number of files"""
+    return get_file_registry().list(offset=offset, limit=limit)
+
+def list_all_files() -> List[Dict]:
+    """List all unique files in ChromaDB"""
+    registry = get_file_registry()
+    files, _ = registry.list(offset=0, limit=max(registry.count(), 1))
+    return files
+
+def get_file_summary(filename: str) -> Optional[Dict]:
+    """Summary of a single file, or None if it isn't stored"""
+    return get_file_registry().get(filename)
+
+class DuplicateContentError(Exception):
+    """An upload's content is already stored under another name and DEDUP_POLICY rejects it"""
+
+def find_duplicate(content_hash: str) -> Optional[str]:
+    """Name of a stored file with exactly this content, or None"""
+    return get_file_registry().find_by_hash(content_hash)
+
+def alias_file(filename: str, target: str) -> Dict:
+    """Store `filename` as another name for the identical file `target`, without ingesting it again"""
+    # The target's lock too, so an update of the target sees the alias before or not at all
+    # (always alias before target, never the other way round, so this can't deadlock)
+    with _file_lock(filename), _file_lock(target):
+        get_file_registry().add_alias(filename, target)
+    return {
+        "filename": filename,
+        "chunks_added": 0,
+        "duplicate_of": target,
+        "status": "aliased"
+    }
+
+def _relabel_chunks(collection, chunk_ids: List[str], filename: str):
+    """Cite chunks as coming from `filename`, after they were handed to it"""
+    for start in range(0, len(chunk_ids), INGEST_BATCH_SIZE):
+        batch_ids = chunk_ids[start:start + INGEST_BATCH_SIZE]
+        collection.update(
+            ids=batch_ids,
+            metadatas=[{"filename": filename, "source": filename}] * len(batch_ids)
+        )
+
+def delete_file(filename: str) -> Dict:
+    """Delete all chunks associated with a filename"""
+    collection = get_collection()
+    registry = get_file_registry()
     
-    # Delete from collection
-    collection.delete(ids=ids_to_delete)
+    with _file_lock(filename):
+        # An alias only removes its name; the chunks belong to the file it points to
+        if registry.alias_target(filename):
+            registry.remove(filename)
+            return {"filename": filename, "chunks_deleted": 0, "status": "deleted"}
+        
+        # A file with aliases hands its chunks to one of them instead of deleting them
+        promoted = registry.promote_alias(filename)
+        if promoted:
+            new_owner, chunk_ids = promoted
+            _relabel_chunks(collection, chunk_ids, new_owner)
+            return {"filename": filename, "chunks_deleted": 0, "chunks_moved_to": new_owner, "status": "deleted"}
+        
+        # Remove the file from the registry and hide its chunks from search in one step;
+        # chunks other files rely on for their near-duplicates go to those files instead
+        retired = registry.retire_file(filename)
+        
+        if retired is None:
+            raise Exception(f"File '{filename}' not found in database")
+        ids_to_delete, handed = retired
+        
+        _hand_over_chunks(collection, handed)
+        _delete_chunks(collection, registry, ids_to_delete)
     
     return {
         "filename": filename,
         "chunks_deleted": len(ids_to_delete),
+        "chunks_handed_over": len(handed),
         "status": "deleted"
     }
 
-def update_file(filename: str, pdf_content: bytes) -> Dict:
-    """Update a file by deleting old chunks and adding new ones"""
-    # Delete existing file
-    delete_file(filename)
+def _load_stored_chunks(collection, chunk_ids: List[str], chunk_hashes: List[Optional[str]]) -> Dict[str, Dict]:
+    """
+    Content hash and page span of a file's stored chunks, keyed by id.
+    Hashes missing from the registry (files ingested before it kept them) are
+    computed from the stored documents.
+    """
+    stored: Dict[str, Dict] = {}
+    for start in range(0, len(chunk_ids), INGEST_BATCH_SIZE):
+        batch_ids = chunk_ids[start:start + INGEST_BATCH_SIZE]
+        batch_hashes = chunk_hashes[start:start + INGEST_BATCH_SIZE]
+        need_documents = any(chunk_hash is None for chunk_hash in batch_hashes)
+        page = collection.get(
+            ids=batch_ids,
+            include=["metadatas", "documents"] if need_documents else ["metadatas"]
+        )
+        known = dict(zip(batch_ids, batch_hashes))
+        documents = page.get("documents") or [None] * len(page["ids"])
+        for chunk_id, metadata, document in zip(page["ids"], page["metadatas"], documents):
+            metadata = metadata or {}
+            stored[chunk_id] = {
+                "hash": known.get(chunk_id) or chunk_content_hash(document or ""),
+                "page": metadata.get("page"),
+                "page_end": metadata.get("page_end")
+            }
+    return stored
+
+@timed_operation("update")
+def update_file(filename: str, pdf_source: PdfSource, progress: Optional[Callable] = None) -> Dict:
+    """
+    Update a file to a new version by diffing chunk content hashes against the stored version.
+    Only chunks with new content are embedded and inserted and only chunks that are gone are
+    deleted. Unchanged chunks keep their records; ones that moved to other pages are rewritten
+    with their existing embedding. New chunks stay hidden until the registry swaps to the new
+    version in a single transaction, so searches see either the old or the new version.
+    Aliases were uploaded as the old content, so a file with aliases hands its old version
+    to the oldest alias and gets all-new records (still reusing the stored embeddings).
+    """
+    collection = get_collection()
+    registry = get_file_registry()
     
-    # Add new file
-    return add_pdf_to_store(pdf_content, filename)
+    with _file_lock(filename):
+        current = registry.get_chunks(filename)
+        if current is None:
+            raise Exception(f"File '{filename}' not found in database")
+        old_ids, old_hashes = current
+        stored = _load_stored_chunks(collection, old_ids, old_hashes)
+        # The old records stay with the aliases, so none can be kept in place
+        keep_for_aliases = registry.has_aliases(filename)
+        
+        # Old chunk ids by content hash, in document order (a text can repeat within a file)
+        reusable: Dict[str, deque] = {}
+        for chunk_id in old_ids:
+            if chunk_id in stored:
+                reusable.setdefault(stored[chunk_id]["hash"], deque()).append(chunk_id)
+        
+        new_ids: List[str] = []
+        new_hashes: List[str] = []
+        kept: List[Tuple[str, int]] = []   # (id, new chunk_index) of records left in place
+        ids_written: List[str] = []
+        moved: List[str] = []   # old ids whose content moved to another page (rewritten)
+        cache_hits = 0
+        batch: List[Dict] = []
+        # The version being replaced doesn't count as stored content
+        near_duplicates = NearDuplicateFilter(get_near_duplicate_index(), exclude=set(old_ids))
+        
+        def flush():
+            nonlocal batch, cache_hits
+            # Moved chunks take the embedding of the record they replace
+            reuse_ids = [chunk["reuse_id"] for chunk in batch if "reuse_id" in chunk]
+            if reuse_ids:
+                page = collection.get(ids=reuse_ids, include=["embeddings"])
+                embeddings = dict(zip(page["ids"], page["embeddings"]))
+                for chunk in batch:
+                    if "reuse_id" in chunk:
+                        chunk["embedding"] = embeddings.get(chunk["reuse_id"])
+            cache_hits += _stage_chunk_batch(collection, registry, filename, batch)
+            ids_written.extend(chunk["id"] for chunk in batch)
+            batch = []
+            if progress:
+                progress(chunks_embedded=len(ids_written), chunks_written=len(ids_written))
+        
+        try:
+            for chunk in iter_pdf_chunks(pdf_source, filename, progress=progress):
+                content_hash = chunk_content_hash(chunk["text"])
+                candidates = reusable.get(content_hash)
+                if candidates:
+                    old_id = candidates.popleft()
+                    old = stored[old_id]
+                    if not keep_for_aliases and (old["page"], old["page_end"]) == (chunk["page"], chunk["page_end"]):
+                        new_ids.append(old_id)
+                        new_hashes.append(content_hash)
+                        kept.append((old_id, chunk["chunk_index"]))
+                        near_duplicates.remember(old_id, chunk["text"], index=False)
+                        continue
+                    chunk["reuse_id"] = old_id
+                    moved.append(old_id)
+                    near_duplicates.remember(chunk["id"], chunk["text"])
+                elif not near_duplicates.admit(chunk):
+                    continue
+                
+                new_ids.append(chunk["id"])
+                new_hashes.append(content_hash)
+                batch.append(chunk)
+                if len(batch) >= INGEST_BATCH_SIZE:
+                    flush()
+            if batch:
+                flush()
+            
+            if not new_ids and not near_duplicates.removed:
+                raise Exception("No text could be extracted from the PDF")
+            
+            total = len(new_ids)
+            if progress:
+                progress(stage="finalizing", chunks_total=total, chunks_embedded=total, chunks_written=total)
+            with stage("write"):
+                _set_total_chunks(collection, ids_written, total)
+                
+                # Swap: new chunks become visible and chunks only the old version used are hidden
+                kept_ids = {chunk_id for chunk_id, _ in kept}
+                retired = [chunk_id for chunk_id in old_ids if chunk_id not in kept_ids]
+                content_hash, byte_size = hash_pdf_source(pdf_source)
+                old_version_owner, handed, missing = registry.replace_chunks(
+                    filename, new_ids, new_hashes, content_hash, byte_size, retired, keep_for_aliases=keep_for_aliases,
+                    borrowed=_borrowed_positions(near_duplicates)
+                )
+        except Exception:
+            # The old version is still current; drop whatever was staged for the new one
+            _delete_chunks(collection, registry, ids_written)
+            raise
+        
+        near_duplicates.commit(ids_written)
+        with stage("write"):
+            if old_version_owner:
+                _relabel_chunks(collection, retired, old_version_owner)
+            else:
+                # Old chunks other files rely on for their near-duplicates go to those files
+                _hand_over_chunks(collection, handed)
+                _delete_chunks(collection, registry, [chunk_id for chunk_id in retired if chunk_id not in handed])
+            
+            # Positions of unchanged chunks may have shifted
+            for start in range(0, len(kept), INGEST_BATCH_SIZE):
+                batch_kept = kept[start:start + INGEST_BATCH_SIZE]
+                collection.update(
+                    ids=[chunk_id for chunk_id, _ in batch_kept],
+                    metadatas=[{"chunk_index": index, "total_chunks": total} for _, index in batch_kept]
+                )
+        if missing:
+            _store_missing_borrowed(collection, registry, filename, near_duplicates, missing, content_hash, byte_size)
+    
+    return {
+        "filename": filename,
+        "chunks_added": len(ids_written) - len(moved) + len(missing),
+        "chunks_unchanged": len(kept) + len(moved),
+        "chunks_removed": 0 if old_version_owner else len(set(retired) - set(moved) - set(handed)),
+        "chunks_handed_over": len(handed),
+        "old_version_kept_by": old_version_owner,
+        "near_duplicates_removed": near_duplicates.removed - len(missing),
+        "embeddings_from_cache": cache_hits,
+        "status": "success"
+    }
+
+class EmbeddingDimensionMismatch(Exception):
+    """The configured embedding model doesn't produce vectors of the size already stored"""
 
+def check_embedding_dimension():
+    """
+    Make sure the configured embedding model produces vectors of the size already stored.
+    Switching models (e.g. to a local one) needs a fresh store or a re-ingest.
+    """
+    collection = get_collection()
+    if collection.count() == 0:
+        return
+    sample = collection.get(limit=1, include=["embeddings"])
+    if not sample["embeddings"]:
+        return
+    stored = len(sample["embeddings"][0])
+    expected = get_embedding_dimension()
+    if stored != expected:
+        raise EmbeddingDimensionMismatch(
+            f"Embedding dimension mismatch: the store holds {stored}-dimensional vectors but "
+            f"'{embedding_model_id()}' produces {expected}. Use a separate CHROMA_DB_PATH or "
+            f"COLLECTION_NAME for this model, or re-ingest the documents"
+        )
+
+def warm_search_indexes():
+    """Run one query against the vector and keyword indexes, so the first real query doesn't load them"""
+    collection = get_collection()
+    sample = collection.get(limit=1, include=["embeddings"])
+    if sample["embeddings"]:
+        _query_visible(collection, sample["embeddings"][0], 1)
+    keyword_index = get_keyword_index()
+    if keyword_index is not None:
+        keyword_index.search("warm up", 1)
+
+def purge_stale_hidden_chunks(older_than: float) -> int:
+    """
+    Delete chunks left hidden for longer than `older_than` seconds, i.e. staged by an
+    ingest or retired by an update/delete that was interrupted. Returns how many were removed.
+    A file's chunks are only purged while its write lock is free: every add/update/delete
+    holds that lock until its chunks are committed or cleaned up, and the OS drops it when
+    the process dies, so a file that is still locked is being written by a live worker.
+    """
+    collection = get_collection()
+    registry = get_file_registry()
+    purged = 0
+    for filename in registry.stale_hidden_files(older_than):
+        if filename is None:
+            # Hidden before the owning file was recorded; only their age is known
+            stale = registry.stale_hidden(older_than, None)
+            _delete_chunks(collection, registry, stale)
+            purged += len(stale)
+            continue
+        with _file_lock(filename, blocking=False) as acquired:
+            if not acquired:
+                log(f"Not purging hidden chunks of '{filename}': it is still being written")
+                continue
+            stale = registry.stale_hidden(older_than, filename)
+            _delete_chunks(collection, registry, stale)
+            purged += len(stale)
+    return purged
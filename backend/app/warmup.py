@@ -0,0 +1,118 @@
+"""
+Background warmup of the vector store, side indexes and API clients, and the readiness state it drives
+"""
+import asyncio
+import threading
+import time
+from typing import Dict, Optional
+from fastapi import HTTPException
+from app.config import STALE_HIDDEN_CHUNK_SECONDS, WARMUP_RETRY_SECONDS, WARMUP_REQUEST_WAIT_SECONDS
+
+_state = {
+    "ready": False,
+    "stage": "not started",
+    "attempts": 0,
+    "error": None,
+    # Set when warmup hit an error retrying can't fix (e.g. the wrong embedding model for the store)
+    "fatal": False,
+    "started_at": None,
+    "ready_at": None
+}
+_thread: Optional[threading.Thread] = None
+_lock = threading.Lock()
+
+def _set_stage(stage: str):
+    _state["stage"] = stage
+
+def warm_up():
+    """Open everything the first chat or upload would otherwise wait for"""
+    # Heavy modules are imported here, off the import path of the app
+    from app.database import init_db
+    from app.file_registry import get_file_registry
+    from app.keyword_index import get_keyword_index
+    from app.dedup import get_near_duplicate_index
+    from app.conversations import get_conversation_store
+    from app.jobs import job_manager
+    from app.llm import get_llm
+    from app.embeddings import get_embeddings
+    from app.pdf_processor import warm_pdf_processing
+    from app.tokens import count_tokens
+    from app.vector_store import purge_stale_hidden_chunks, check_embedding_dimension, warm_search_indexes
+    
+    _set_stage("vector store")
+    init_db()
+    get_file_registry()
+    get_keyword_index()
+    # Re-signs stored chunks if the signature version changed
+    get_near_duplicate_index()
+    get_conversation_store()
+    job_manager.list()
+    check_embedding_dimension()
+    purged = purge_stale_hidden_chunks(STALE_HIDDEN_CHUNK_SECONDS)
+    if purged:
+        print(f"Removed {purged} chunks left over from interrupted ingests")
+    print("Database initialized")
+    
+    # Build the pooled LLM/embedding clients up front so the first request doesn't pay for it
+    _set_stage("api clients")
+    get_llm()
+    get_embeddings()
+    print("API clients initialized")
+    
+    _set_stage("indexes")
+    warm_search_indexes()
+    count_tokens("warm up")
+    warm_pdf_processing()
+
+def _run():
+    _state["started_at"] = time.time()
+    from app.vector_store import EmbeddingDimensionMismatch
+    while True:
+        _state["attempts"] += 1
+        try:
+            warm_up()
+        except EmbeddingDimensionMismatch as e:
+            # Stored vectors can't be searched with this model; serving would only return wrong
+            # results and mix vector sizes, so stay unready until the configuration is fixed
+            _state.update(stage="failed", error=str(e), fatal=True)
+            print(f"Warmup failed, not retrying: {e}")
+            return
+        except Exception as e:
+            _state["error"] = f"{_state['stage']}: {e}"
+            print(f"Warmup failed at {_state['stage']} (retrying in {WARMUP_RETRY_SECONDS:g}s): {e}")
+            time.sleep(WARMUP_RETRY_SECONDS)
+            continue
+        _state.update(ready=True, stage="ready", error=None, ready_at=time.time())
+        print(f"Ready after {_state['ready_at'] - _state['started_at']:.1f}s")
+        return
+
+def start_warmup():
+    """Start warming up in a background thread (once per process)"""
+    global _thread
+    with _lock:
+        if _thread is None:
+            _thread = threading.Thread(target=_run, name="warmup", daemon=True)
+            _thread.start()
+
+def readiness() -> Dict:
+    """Whether warmup has finished, and where it is if not"""
+    return dict(_state)
+
+async def require_ready():
+    """
+    Hold requests that read or write the vector store until warmup has succeeded (each worker
+    warms up on its own), up to WARMUP_REQUEST_WAIT_SECONDS; then, or right away if warmup
+    failed for good, reject them with 503
+    """
+    deadline = time.monotonic() + WARMUP_REQUEST_WAIT_SECONDS
+    while not _state["ready"] and not _state["fatal"] and time.monotonic() < deadline:
+        await asyncio.sleep(0.05)
+    if _state["ready"]:
+        return
+    if _state["fatal"]:
+        raise HTTPException(status_code=503, detail=f"The vector store is unavailable: {_state['error']}")
+    raise HTTPException(
+        status_code=503,
+        detail=f"Still starting up ({_state['stage']}), try again shortly",
+        headers={"Retry-After": str(max(1, round(WARMUP_RETRY_SECONDS)))}
+    )
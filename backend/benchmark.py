@@ -0,0 +1,378 @@
+"""
+Offline benchmark for ingestion, retrieval and chat latency.
+
+Runs the real ingestion, retrieval and chat code in-process against a throwaway
+store. The LLM and the embedding API are replaced by deterministic stand-ins with
+configurable latency, so no network access or API key is needed. Documents are the
+PDFs in sample_pdfs/ plus synthetic large PDFs.
+
+    python benchmark.py                   # run and compare with benchmark_baseline.json
+    python benchmark.py --save-baseline   # run and store the results as the new baseline
+
+Throughputs (*_per_s) should go up and latencies (*_ms) down; a metric more than
+--tolerance percent worse than the baseline is reported as a regression. Each of
+--runs runs uses a fresh interpreter and store, and every metric keeps its best
+value across them, which keeps scheduling noise from looking like a regression.
+"""
+import argparse
+import asyncio
+import json
+import os
+import platform
+import random
+import shutil
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from typing import Dict, List
+
+BACKEND_DIR = os.path.dirname(os.path.abspath(__file__))
+SAMPLE_PDF_DIR = os.path.join(os.path.dirname(BACKEND_DIR), "sample_pdfs")
+DEFAULT_BASELINE = os.path.join(BACKEND_DIR, "benchmark_baseline.json")
+
+def percentiles(samples: List[float], prefix: str) -> Dict[str, float]:
+    """p50/p95/p99 of samples in seconds, as milliseconds"""
+    ordered = sorted(samples)
+    def at(fraction: float) -> float:
+        return round(ordered[min(len(ordered) - 1, int(fraction * len(ordered)))] * 1000, 2)
+    return {f"{prefix}.p50_ms": at(0.50), f"{prefix}.p95_ms": at(0.95), f"{prefix}.p99_ms": at(0.99)}
+
+def synthetic_pdf(pages: int, seed: int) -> bytes:
+    """A PDF of `pages` pages of seeded pseudo-words"""
+    from pdf_fixtures import make_pdf
+    rng = random.Random(seed)
+    vocabulary = ["".join(rng.choice("abcdefghijklmnopqrstuvwxyz") for _ in range(rng.randint(3, 10))) for _ in range(5000)]
+    return make_pdf([
+        [" ".join(rng.choice(vocabulary) for _ in range(12)) for _ in range(45)]
+        for _ in range(pages)
+    ])
+
+def make_fakes(embed_latency: float, llm_latency: float, dimension: int):
+    """Deterministic stand-ins for the embedding API and the chat model"""
+    from langchain_core.language_models.chat_models import BaseChatModel
+    from langchain_core.messages import AIMessage
+    from langchain_core.outputs import ChatGeneration, ChatResult
+    from app.local_embeddings import HashingEmbeddings
+
+    class FakeEmbeddings(HashingEmbeddings):
+        """Hashing embeddings that take `embed_latency` seconds per call, like an API round trip"""
+
+        def embed_documents(self, texts):
+            time.sleep(embed_latency)
+            return super().embed_documents(texts)
+
+        def embed_query(self, text):
+            time.sleep(embed_latency)
+            return super().embed_query(text)
+
+        async def aembed_query(self, text):
+            await asyncio.sleep(embed_latency)
+            return HashingEmbeddings.embed_query(self, text)
+
+    class FakeChatModel(BaseChatModel):
+        """Answers after `latency` seconds with a reply derived from the prompt length"""
+        latency: float = 0.0
+
+        @property
+        def _llm_type(self) -> str:
+            return "benchmark-fake"
+
+        def _reply(self, messages) -> ChatResult:
+            length = sum(len(str(message.content)) for message in messages)
+            text = f"Benchmark answer for a {length}-character prompt [Source 1]."
+            return ChatResult(generations=[ChatGeneration(message=AIMessage(content=text))])
+
+        def _generate(self, messages, stop=None, run_manager=None, **kwargs):
+            time.sleep(self.latency)
+            return self._reply(messages)
+
+        async def _agenerate(self, messages, stop=None, run_manager=None, **kwargs):
+            await asyncio.sleep(self.latency)
+            return self._reply(messages)
+
+    return FakeEmbeddings(dimension), (lambda temperature=0.7: FakeChatModel(latency=llm_latency))
+
+def bench_chunking(text: str, rounds: int = 7) -> Dict[str, float]:
+    from app.pdf_processor import chunk_text
+    # Best of several rounds: the least disturbed by whatever else the machine is doing
+    best = float("inf")
+    for _ in range(rounds):
+        started = time.perf_counter()
+        chunk_text(text)
+        best = min(best, time.perf_counter() - started)
+    return {"chunk_text.mb_per_s": round(len(text.encode("utf-8")) / best / 1e6, 2)}
+
+def warm_up(workdir: str):
+    """Ingest and delete a throwaway document, so timings don't include one-off startup costs"""
+    from app.config import PDF_PARALLEL_MIN_PAGES
+    from app.vector_store import add_pdf_to_store, delete_file
+    path = os.path.join(workdir, "warm-up.pdf")
+    with open(path, "wb") as f:
+        f.write(synthetic_pdf(PDF_PARALLEL_MIN_PAGES, seed=0))
+    add_pdf_to_store(path, "warm-up.pdf")
+    delete_file("warm-up.pdf")
+
+def bench_ingestion(documents: Dict[str, str]) -> Dict[str, float]:
+    from pypdf import PdfReader
+    from app.vector_store import add_pdf_to_store
+    results: Dict[str, float] = {}
+    total_pages = total_chunks = total_seconds = 0.0
+    for name, path in documents.items():
+        pages = len(PdfReader(path).pages)
+        started = time.perf_counter()
+        stored = add_pdf_to_store(path, name)
+        elapsed = time.perf_counter() - started
+        chunks = stored["chunks_added"]
+        results[f"ingest.{name}.pages_per_s"] = round(pages / elapsed, 1)
+        results[f"ingest.{name}.chunks_per_s"] = round(chunks / elapsed, 1)
+        total_pages += pages
+        total_chunks += chunks
+        total_seconds += elapsed
+        print(f"  ingested {name}: {pages} pages, {chunks} chunks in {elapsed:.2f}s")
+    results["ingest.total.pages_per_s"] = round(total_pages / total_seconds, 1)
+    results["ingest.total.chunks_per_s"] = round(total_chunks / total_seconds, 1)
+    return results
+
+def make_queries(count: int, seed: int) -> List[str]:
+    """Questions made of word windows from the stored chunks"""
+    from app.database import get_collection
+    rng = random.Random(seed)
+    documents = get_collection().get(limit=2000, include=["documents"])["documents"]
+    queries = []
+    while len(queries) < count:
+        words = rng.choice(documents).split()
+        if len(words) < 8:
+            continue
+        start = rng.randrange(len(words) - 6)
+        queries.append(" ".join(words[start:start + rng.randint(3, 6)]))
+    return queries
+
+def bench_retrieval(queries: List[str], passes_count: int = 3) -> Dict[str, float]:
+    from app.vector_store import embed_query_cached, search_similar_documents, retrieve_context
+    # Embed every query up front, so the timings cover retrieval and not the stand-in's latency
+    for query in queries:
+        embed_query_cached(query)
+    results: Dict[str, float] = {}
+    for name, search in (("search", search_similar_documents), ("context", retrieve_context)):
+        # Median of each percentile over several passes, to damp one-off stalls
+        passes = []
+        for _ in range(passes_count):
+            samples = []
+            for query in queries:
+                started = time.perf_counter()
+                search(query, n_results=5)
+                samples.append(time.perf_counter() - started)
+            passes.append(percentiles(samples, f"retrieval.{name}"))
+        results.update({key: statistics.median(p[key] for p in passes) for key in passes[0]})
+    return results
+
+def bench_chat(queries: List[str], concurrency: int) -> Dict[str, float]:
+    import httpx
+    import uvicorn
+    from main import app
+
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        port = sock.getsockname()[1]
+    server = uvicorn.Server(uvicorn.Config(app, host="127.0.0.1", port=port, log_level="warning"))
+    thread = threading.Thread(target=server.run, daemon=True)
+    thread.start()
+    while not server.started:
+        time.sleep(0.05)
+    # Don't let the background warmup overlap the timed requests
+    while httpx.get(f"http://127.0.0.1:{port}/ready").status_code != 200:
+        time.sleep(0.05)
+
+    async def run() -> Dict[str, float]:
+        samples: List[float] = []
+        semaphore = asyncio.Semaphore(concurrency)
+        limits = httpx.Limits(max_connections=concurrency)
+        async with httpx.AsyncClient(base_url=f"http://127.0.0.1:{port}", timeout=120, limits=limits) as client:
+            async def ask(i: int, query: str, record: bool):
+                async with semaphore:
+                    started = time.perf_counter()
+                    response = await client.post("/api/chat/", json={"message": query, "conversation_id": f"bench-{i}"})
+                    if response.status_code != 200:
+                        raise Exception(f"/api/chat/ returned {response.status_code}: {response.text}")
+                    if record:
+                        samples.append(time.perf_counter() - started)
+
+            await asyncio.gather(*(ask(-i - 1, query, False) for i, query in enumerate(queries[:concurrency])))
+            started = time.perf_counter()
+            await asyncio.gather(*(ask(i, query, True) for i, query in enumerate(queries)))
+            elapsed = time.perf_counter() - started
+        return {**percentiles(samples, "chat"), "chat.requests_per_s": round(len(samples) / elapsed, 1)}
+
+    try:
+        return asyncio.run(run())
+    finally:
+        server.should_exit = True
+        thread.join()
+
+def compare(results: Dict[str, float], baseline: Dict, tolerance: float) -> List[str]:
+    """Print current results next to the baseline and return the regressed metrics"""
+    if baseline.get("config") != results["config"]:
+        print(f"Note: baseline was recorded with {baseline.get('config')}")
+    if baseline.get("machine") != results["machine"]:
+        print(f"Note: baseline was recorded on {baseline.get('machine')}, this is {results['machine']}; timings may not be comparable")
+    regressions = []
+    print(f"\n{'metric':<44}{'baseline':>12}{'current':>12}{'change':>10}")
+    for metric, value in results["metrics"].items():
+        old = baseline.get("metrics", {}).get(metric)
+        if old is None:
+            print(f"{metric:<44}{'-':>12}{value:>12}")
+            continue
+        change = (value - old) / old * 100 if old else 0.0
+        worse = -change if metric.endswith("_per_s") else change
+        flag = "  REGRESSION" if worse > tolerance else ""
+        if flag:
+            regressions.append(metric)
+        print(f"{metric:<44}{old:>12}{value:>12}{change:>+9.1f}%{flag}")
+    return regressions
+
+def machine_description() -> str:
+    return f"{platform.machine()}, {os.cpu_count()} CPUs, {platform.system()} {platform.release()}, Python {platform.python_version()}"
+
+def best_of(runs: List[Dict]) -> Dict:
+    """Results of several runs merged, keeping each metric's best value (highest throughput, lowest latency)"""
+    metrics: Dict[str, float] = {}
+    for run in runs:
+        for metric, value in run["metrics"].items():
+            pick = max if metric.endswith("_per_s") else min
+            metrics[metric] = pick(metrics[metric], value) if metric in metrics else value
+    return {"config": runs[0]["config"], "metrics": metrics}
+
+def run_repeatedly(runs: int) -> Dict:
+    """Run the benchmark `runs` times, each in a fresh interpreter, and merge the results with best_of"""
+    results = []
+    with tempfile.TemporaryDirectory(prefix="sicko-bench-runs-") as workdir:
+        for run in range(runs):
+            print(f"Run {run + 1} of {runs}")
+            output = os.path.join(workdir, f"run-{run}.json")
+            # The same options, minus the ones that only apply to the merged result
+            options = [option for option in sys.argv[1:] if option != "--save-baseline"]
+            subprocess.run(
+                [sys.executable, os.path.abspath(__file__), *options, "--runs", "1", "--output", output, "--baseline", ""],
+                cwd=BACKEND_DIR, check=True
+            )
+            with open(output) as f:
+                results.append(json.load(f))
+    return best_of(results)
+
+def main():
+    parser = argparse.ArgumentParser(description="Offline benchmark for ingestion, retrieval and chat latency")
+    parser.add_argument("--embed-latency", type=float, default=0.02, help="seconds per stand-in embedding call")
+    parser.add_argument("--llm-latency", type=float, default=0.2, help="seconds per stand-in chat completion")
+    parser.add_argument("--synthetic-pages", type=int, nargs="*", default=[100, 400], help="page counts of synthetic PDFs")
+    parser.add_argument("--queries", type=int, default=300, help="retrieval queries to time")
+    parser.add_argument("--chat-requests", type=int, default=200)
+    parser.add_argument("--concurrency", type=int, default=16, help="concurrent /api/chat/ requests")
+    parser.add_argument("--baseline", default=DEFAULT_BASELINE)
+    parser.add_argument("--save-baseline", action="store_true", help="store these results as the baseline")
+    parser.add_argument("--tolerance", type=float, default=15.0, help="percent worse than baseline that counts as a regression")
+    parser.add_argument("--output", help="also write the results as JSON to this path")
+    parser.add_argument("--runs", type=int, default=3, help="runs to take each metric's best value from")
+    args = parser.parse_args()
+
+    if args.runs > 1:
+        results = run_repeatedly(args.runs)
+        results["config"]["runs"] = args.runs
+    else:
+        results = run_once(args)
+    results["machine"] = machine_description()
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+
+    regressions = []
+    if args.save_baseline:
+        with open(args.baseline, "w") as f:
+            json.dump(results, f, indent=2)
+        print(json.dumps(results["metrics"], indent=2))
+        print(f"Baseline saved to {args.baseline}")
+    elif not args.baseline:
+        print(json.dumps(results["metrics"], indent=2))
+    elif os.path.exists(args.baseline):
+        with open(args.baseline) as f:
+            regressions = compare(results, json.load(f), args.tolerance)
+    else:
+        print(json.dumps(results["metrics"], indent=2))
+        print(f"No baseline at {args.baseline}; run with --save-baseline to store one")
+
+    if regressions:
+        print(f"\n{len(regressions)} metric(s) regressed by more than {args.tolerance}%")
+        sys.exit(1)
+
+def run_once(args) -> Dict:
+    """One benchmark run in this process, against a throwaway store"""
+    workdir = tempfile.mkdtemp(prefix="sicko-bench-")
+    # Configure before the app reads its settings: a throwaway store, no caches that would hide work
+    os.environ.update({
+        "CHROMA_DB_PATH": os.path.join(workdir, "store"),
+        "VECTOR_STORE_MODE": "embedded",
+        "EMBEDDING_PROVIDER": "openai",
+        "EMBEDDING_CACHE_ENABLED": "false",
+        "ANSWER_CACHE_ENABLED": "false",
+        "OPENAI_API_KEY": "sk-benchmark",
+        "AZURE_OPENAI_ENDPOINT": "",
+        "AZURE_OPENAI_API_KEY": "",
+        "EMBED_TPM_LIMIT": "0",
+        "EMBED_RPM_LIMIT": "0",
+        "UPLOAD_TMP_DIR": workdir
+    })
+    sys.path.insert(0, BACKEND_DIR)
+    import app.embeddings
+    import app.llm
+    from app.embeddings import get_embedding_dimension
+    from app.pdf_processor import extract_text_from_pdf, shutdown_process_pool
+
+    embeddings, create_llm = make_fakes(args.embed_latency, args.llm_latency, get_embedding_dimension())
+    app.embeddings._create_embeddings = lambda: embeddings
+    # Ingestion batches skip langchain and go to the API client directly
+    app.embeddings._embed_request = embeddings.embed_documents
+    app.llm._create_llm = create_llm
+
+    documents = {}
+    for name in sorted(os.listdir(SAMPLE_PDF_DIR)):
+        if name.endswith(".pdf"):
+            documents[name] = os.path.join(SAMPLE_PDF_DIR, name)
+    for pages in args.synthetic_pages:
+        path = os.path.join(workdir, f"synthetic-{pages}.pdf")
+        with open(path, "wb") as f:
+            f.write(synthetic_pdf(pages, seed=pages))
+        documents[f"synthetic-{pages}.pdf"] = path
+
+    try:
+        metrics: Dict[str, float] = {}
+        print("Chunking...")
+        metrics.update(bench_chunking(extract_text_from_pdf(documents[max(documents, key=lambda n: os.path.getsize(documents[n]))])))
+        print("Ingestion...")
+        warm_up(workdir)
+        metrics.update(bench_ingestion(documents))
+        print("Retrieval...")
+        metrics.update(bench_retrieval(make_queries(args.queries, seed=1)))
+        print("Chat...")
+        metrics.update(bench_chat(make_queries(args.chat_requests, seed=2), args.concurrency))
+    finally:
+        shutdown_process_pool()
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    return {
+        "config": {
+            "embed_latency": args.embed_latency,
+            "llm_latency": args.llm_latency,
+            "synthetic_pages": args.synthetic_pages,
+            "queries": args.queries,
+            "chat_requests": args.chat_requests,
+            "concurrency": args.concurrency,
+            "runs": args.runs
+        },
+        "metrics": metrics
+    }
+
+if __name__ == "__main__":
+    main()
@@ -1,21 +1,20 @@
 """
 FastAPI Backend for Chatbot with PDF Ingestion and ChromaDB
 """
-from fastapi import FastAPI, File, UploadFile, HTTPException, Depends
+from fastapi import FastAPI
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import JSONResponse
-from pydantic import BaseModel
-from typing import List, Optional, Dict, Any
-import os
-from dotenv import load_dotenv
-import uvicorn
+from fastapi.responses import JSONResponse, Response
 
 from app.chat import chat_router
 from app.files import files_router
-from app.database import init_db
-
-# Load environment variables
-load_dotenv()
+from app.admin import admin_router
+from app.clients import close_clients
+from app.jobs import job_manager
+from app.pdf_processor import shutdown_process_pool
+from app.metrics import RequestMetricsMiddleware, render_metrics, mark_process_dead
+from app.profiling import ProfilingMiddleware
+from app.warmup import start_warmup, readiness
+from app.config import USE_AZURE
 
 app = FastAPI(
     title="Sicko Bot API",
@@ -30,17 +29,35 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=["X-Request-ID", "X-Profile-ID", "ETag", "X-Corpus-Version", "X-Total-Count"],
 )
 
+# Opt-in profiling of single requests (see PROFILING_ENABLED)
+app.add_middleware(ProfilingMiddleware)
+# Request ids (X-Request-ID) and HTTP metrics; added last so it wraps everything else
+app.add_middleware(RequestMetricsMiddleware)
+
 # Include routers
 app.include_router(chat_router, prefix="/api/chat", tags=["Chat"])
 app.include_router(files_router, prefix="/api/files", tags=["Files"])
+app.include_router(admin_router, prefix="/api/admin", tags=["Admin"])
 
 @app.on_event("startup")
 async def startup_event():
-    """Initialize database on startup"""
-    init_db()
-    print("Database initialized")
+    """
+    Start warming up the database, indexes and shared API clients in the background.
+    The server takes requests right away; /ready says when the first query will be fast
+    """
+    print(f"Using {'Azure OpenAI' if USE_AZURE else 'OpenAI'}")
+    start_warmup()
+
+@app.on_event("shutdown")
+async def shutdown_event():
+    """Stop ingestion workers and close pooled connections on shutdown"""
+    job_manager.shutdown()
+    shutdown_process_pool()
+    await close_clients()
+    mark_process_dead()
 
 @app.get("/")
 async def root():
@@ -50,15 +67,31 @@ async def root():
         "version": "1.0.0",
         "endpoints": {
             "chat": "/api/chat",
-            "files": "/api/files"
+            "files": "/api/files",
+            "admin": "/api/admin"
         }
     }
 
 @app.get("/health")
 async def health_check():
-    """Health check endpoint"""
+    """Liveness check: the process is up and serving"""
     return {"status": "healthy"}
 
+@app.get("/ready")
+async def readiness_check():
+    """Readiness check: 200 once warmup has finished, 503 (with its progress) until then"""
+    state = readiness()
+    if not state["ready"]:
+        return JSONResponse(status_code=503, content=state)
+    return state
+
+@app.get("/metrics")
+async def metrics():
+    """Prometheus metrics"""
+    body, content_type = render_metrics()
+    return Response(content=body, media_type=content_type)
+
 if __name__ == "__main__":
+    import uvicorn
     uvicorn.run(app, host="0.0.0.0", port=8000)
 
@@ -0,0 +1,70 @@
+"""
+Synthetic PDFs for the tests and the benchmark, built without any PDF library
+"""
+from typing import List
+
+def make_pdf(pages: List[List[str]]) -> bytes:
+    """A minimal PDF with one line of Helvetica text per string"""
+    objects = ["<< /Type /Catalog /Pages 2 0 R >>", None, "<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica >>"]
+    page_ids = []
+    for lines in pages:
+        stream = "BT /F1 9 Tf 11 TL 40 800 Td " + " ".join(f"({line}) '" for line in lines) + " ET"
+        objects.append(f"<< /Length {len(stream)} >>\nstream\n{stream}\nendstream")
+        objects.append(
+            f"<< /Type /Page /Parent 2 0 R /MediaBox [0 0 595 842] "
+            f"/Resources << /Font << /F1 3 0 R >> >> /Contents {len(objects)} 0 R >>"
+        )
+        page_ids.append(len(objects))
+    objects[1] = f"<< /Type /Pages /Kids [{' '.join(f'{i} 0 R' for i in page_ids)}] /Count {len(page_ids)} >>"
+
+    out = b"%PDF-1.4\n"
+    offsets = []
+    for number, body in enumerate(objects, 1):
+        offsets.append(len(out))
+        out += f"{number} 0 obj\n{body}\nendobj\n".encode("latin-1")
+    xref = len(out)
+    out += f"xref\n0 {len(objects) + 1}\n0000000000 65535 f \n".encode("latin-1")
+    out += "".join(f"{offset:010d} 00000 n \n" for offset in offsets).encode("latin-1")
+    out += f"trailer\n<< /Size {len(objects) + 1} /Root 1 0 R >>\nstartxref\n{xref}\n%%EOF\n".encode("latin-1")
+    return out
+
+def write_large_pdf(path: str, pages: int, padding_bytes: int, lines_per_page: int = 30) -> int:
+    """
+    Write a PDF of `pages` text pages, each carrying an image of `padding_bytes` random
+    bytes, straight to `path` (never held in memory). Returns the file size.
+    """
+    import os
+    import random
+    rng = random.Random(pages)
+    words = ["".join(rng.choice("abcdefghijklmnopqrstuvwxyz") for _ in range(rng.randint(3, 10))) for _ in range(2000)]
+    offsets = []
+    with open(path, "wb") as f:
+        def write_object(body: bytes):
+            offsets.append(f.tell())
+            f.write(f"{len(offsets)} 0 obj\n".encode("latin-1") + body + b"\nendobj\n")
+
+        f.write(b"%PDF-1.4\n")
+        write_object(b"<< /Type /Catalog /Pages 2 0 R >>")
+        kids = " ".join(f"{4 + page * 3 + 2} 0 R" for page in range(pages))
+        write_object(f"<< /Type /Pages /Kids [{kids}] /Count {pages} >>".encode("latin-1"))
+        write_object(b"<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica >>")
+        for page in range(pages):
+            number = 4 + page * 3
+            lines = [" ".join(rng.choice(words) for _ in range(10)) for _ in range(lines_per_page)]
+            stream = "BT /F1 9 Tf 11 TL 40 800 Td " + " ".join(f"({line}) '" for line in lines) + " ET"
+            write_object(f"<< /Length {len(stream)} >>\nstream\n{stream}\nendstream".encode("latin-1"))
+            side = int(padding_bytes ** 0.5)
+            write_object(
+                f"<< /Type /XObject /Subtype /Image /Width {side} /Height {side} /ColorSpace /DeviceGray "
+                f"/BitsPerComponent 8 /Length {side * side} >>\nstream\n".encode("latin-1")
+                + os.urandom(side * side) + b"\nendstream"
+            )
+            write_object(
+                f"<< /Type /Page /Parent 2 0 R /MediaBox [0 0 595 842] /Resources << /Font << /F1 3 0 R >> "
+                f"/XObject << /Im1 {number + 1} 0 R >> >> /Contents {number} 0 R >>".encode("latin-1")
+            )
+        xref = f.tell()
+        f.write(f"xref\n0 {len(offsets) + 1}\n0000000000 65535 f \n".encode("latin-1"))
+        f.write("".join(f"{offset:010d} 00000 n \n" for offset in offsets).encode("latin-1"))
+        f.write(f"trailer\n<< /Size {len(offsets) + 1} /Root 1 0 R >>\nstartxref\n{xref}\n%%EOF\n".encode("latin-1"))
+        return f.tell()
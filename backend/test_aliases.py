@@ -0,0 +1,112 @@
+"""
+Alias test: an alias keeps the content it was uploaded as.
+
+Stores a file, registers byte-identical uploads under other names as aliases, then
+updates the original to a new version that shares some pages with the old one. The
+oldest alias must end up owning the old version's chunks (cited under its own name),
+the other aliases must point to it, the original must hold only the new version,
+and the two must share no chunk records. Deleting the original afterwards must
+leave the aliases' content in place.
+
+Run with pytest, or directly: python test_aliases.py
+"""
+import hashlib
+import os
+import random
+import sys
+import tempfile
+from typing import Dict, List
+from pdf_fixtures import make_pdf
+
+BACKEND_DIR = os.path.dirname(os.path.abspath(__file__))
+PAGES = 6
+SHARED_PAGES = 3
+
+def make_version(marker: str, shared_seed: int) -> bytes:
+    """Pages 0..SHARED_PAGES-1 are the same in every version; the rest carry `marker`"""
+    pages = []
+    for page in range(PAGES):
+        if page < SHARED_PAGES:
+            rng = random.Random(shared_seed * 100 + page)
+            tag = f"sharedpage{page}"
+        else:
+            rng = random.Random(f"{marker}-{page}")
+            tag = f"{marker}page{page}"
+        words = ["".join(rng.choice("abcdefghijklmnopqrstuvwxyz") for _ in range(rng.randint(4, 9))) for _ in range(400)]
+        pages.append([f"{tag} " + " ".join(rng.choice(words) for _ in range(10)) for _ in range(40)])
+    return make_pdf(pages)
+
+def chunk_texts(collection, chunk_ids: List[str]) -> Dict[str, Dict]:
+    page = collection.get(ids=chunk_ids, include=["documents", "metadatas"])
+    return {chunk_id: {"text": text, "filename": meta["filename"]}
+            for chunk_id, text, meta in zip(page["ids"], page["documents"], page["metadatas"])}
+
+def run_alias_test(workdir: str) -> List[str]:
+    os.environ.update({
+        "CHROMA_DB_PATH": os.path.join(workdir, "store"),
+        "VECTOR_STORE_MODE": "embedded",
+        "EMBEDDING_PROVIDER": "local",
+        "OPENAI_API_KEY": os.getenv("OPENAI_API_KEY", "sk-alias-test")
+    })
+    sys.path.insert(0, BACKEND_DIR)
+    from app.database import get_collection
+    from app.file_registry import get_file_registry
+    from app.vector_store import add_pdf_to_store, alias_file, update_file, delete_file
+
+    failures: List[str] = []
+    collection = get_collection()
+    registry = get_file_registry()
+    old_version = make_version("old", 1)
+    new_version = make_version("new", 1)
+
+    add_pdf_to_store(old_version, "original.pdf")
+    old_ids = registry.get_chunk_ids("original.pdf")
+    alias_file("copy.pdf", "original.pdf")
+    alias_file("copy2.pdf", "original.pdf")
+
+    result = update_file("original.pdf", new_version)
+    if result.get("old_version_kept_by") != "copy.pdf":
+        failures.append(f"old version should go to the oldest alias, got {result.get('old_version_kept_by')}")
+
+    copy = registry.get("copy.pdf")
+    if copy["alias_of"] is not None or copy["content_hash"] != hashlib.sha256(old_version).hexdigest():
+        failures.append(f"copy.pdf should own the old content: {copy}")
+    if registry.get("copy2.pdf")["alias_of"] != "copy.pdf":
+        failures.append(f"copy2.pdf should now point to copy.pdf: {registry.get('copy2.pdf')}")
+    if registry.get("original.pdf")["content_hash"] != hashlib.sha256(new_version).hexdigest():
+        failures.append("original.pdf should hold the new content")
+
+    copy_ids = registry.get_chunk_ids("copy.pdf")
+    original_ids = registry.get_chunk_ids("original.pdf")
+    if sorted(copy_ids) != sorted(old_ids):
+        failures.append("copy.pdf should keep exactly the old version's chunk records")
+    if set(copy_ids) & set(original_ids):
+        failures.append("the two versions must not share chunk records")
+    if registry.hidden_among(copy_ids + original_ids):
+        failures.append("no chunk of either version should be hidden from search")
+
+    copy_chunks = chunk_texts(collection, copy_ids)
+    copy_text = " ".join(chunk["text"] for chunk in copy_chunks.values())
+    if len(copy_chunks) != len(copy_ids) or "newpage" in copy_text or "oldpage" not in copy_text:
+        failures.append("copy.pdf's chunks should hold the old content only")
+    if any(chunk["filename"] != "copy.pdf" for chunk in copy_chunks.values()):
+        failures.append("copy.pdf's chunks should be cited as copy.pdf")
+    original_text = " ".join(chunk["text"] for chunk in chunk_texts(collection, original_ids).values())
+    if "oldpage" in original_text or "newpage" not in original_text or "sharedpage" not in original_text:
+        failures.append("original.pdf's chunks should hold the new content only")
+
+    delete_file("original.pdf")
+    if len(chunk_texts(collection, copy_ids)) != len(copy_ids):
+        failures.append("deleting the original must not delete the aliases' content")
+    return failures
+
+def test_update_keeps_alias_content():
+    with tempfile.TemporaryDirectory() as workdir:
+        failures = run_alias_test(workdir)
+    assert not failures, "\n".join(failures)
+
+if __name__ == "__main__":
+    with tempfile.TemporaryDirectory() as workdir:
+        failures = run_alias_test(workdir)
+    print("\n".join(failures) or "ok")
+    sys.exit(1 if failures else 0)
@@ -0,0 +1,328 @@
+"""
+Concurrent-load test for the multi-worker deployment (VECTOR_STORE_MODE=http).
+
+Starts a local Chroma server, a stand-in OpenAI chat endpoint and the backend with
+several uvicorn workers, then uploads, updates and deletes files from many threads
+while other threads keep chatting and listing files. Jobs are polled through whichever
+worker answers. Afterwards the collection, its vector index, the file registry and the
+keyword index must agree with each other, and every stored chunk must hold text from
+the right version of the right file.
+
+Run with pytest, or directly: python test_concurrent_store.py [--workers N] [--files N]
+"""
+import argparse
+import json
+import os
+import random
+import socket
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, List, Set, Tuple
+import chromadb
+import httpx
+from chromadb.config import Settings
+from pdf_fixtures import make_pdf
+
+BACKEND_DIR = os.path.dirname(os.path.abspath(__file__))
+COLLECTION_NAME = "load_test_documents"
+PAGES_PER_FILE = 4
+LINES_PER_PAGE = 40
+WORDS_PER_LINE = 10
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+class Corpus:
+    """Synthetic documents whose words identify the file and version they belong to"""
+
+    def __init__(self, seed: int = 7):
+        self.random = random.Random(seed)
+        self.owner: Dict[str, Tuple[str, int]] = {}
+
+    def _word(self) -> str:
+        # Random letters, unique across the corpus: each word names one version of one file
+        while True:
+            word = "".join(self.random.choice("abcdefghijklmnopqrstuvwxyz") for _ in range(8))
+            if word not in self.owner:
+                return word
+
+    def document(self, filename: str, version: int) -> bytes:
+        vocabulary = []
+        for _ in range(300):
+            word = self._word()
+            self.owner[word] = (filename, version)
+            vocabulary.append(word)
+        pages = [
+            [" ".join(self.random.choice(vocabulary) for _ in range(WORDS_PER_LINE)) for _ in range(LINES_PER_PAGE)]
+            for _ in range(PAGES_PER_FILE)
+        ]
+        return make_pdf(pages)
+
+    def versions_in(self, text: str) -> Set[Tuple[str, int]]:
+        return {self.owner[word] for word in text.split() if word in self.owner}
+
+class FakeChatHandler(BaseHTTPRequestHandler):
+    """Answers every OpenAI chat completion request with a fixed reply"""
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        body = json.dumps({
+            "id": "chatcmpl-load-test",
+            "object": "chat.completion",
+            "created": int(time.time()),
+            "model": "fake",
+            "choices": [{"index": 0, "message": {"role": "assistant", "content": "ok"}, "finish_reason": "stop"}],
+            "usage": {"prompt_tokens": 1, "completion_tokens": 1, "total_tokens": 2}
+        }).encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+def wait_for(url: str, process: subprocess.Popen, timeout: float = 90.0):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError(f"{' '.join(process.args)} exited with {process.returncode}")
+        try:
+            if httpx.get(url, timeout=2).status_code == 200:
+                return
+        except httpx.HTTPError:
+            pass
+        time.sleep(0.5)
+    raise RuntimeError(f"{url} did not come up within {timeout}s")
+
+class LoadTest:
+    def __init__(self, workers: int, files: int):
+        self.workers = workers
+        self.file_count = files
+        self.corpus = Corpus()
+        self.failures: List[str] = []
+        self.failures_lock = threading.Lock()
+        self.processes: List[subprocess.Popen] = []
+
+    def fail(self, message: str):
+        with self.failures_lock:
+            self.failures.append(message)
+
+    def start(self, workdir: str):
+        chroma_port, backend_port = free_port(), free_port()
+        chroma = subprocess.Popen(
+            [sys.executable, "-c", "from chromadb.cli.cli import app; app()", "run",
+             "--path", os.path.join(workdir, "chroma_server"), "--port", str(chroma_port)],
+            cwd=workdir, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL
+        )
+        self.processes.append(chroma)
+        wait_for(f"http://localhost:{chroma_port}/api/v1/heartbeat", chroma)
+
+        self.llm_server = ThreadingHTTPServer(("127.0.0.1", 0), FakeChatHandler)
+        threading.Thread(target=self.llm_server.serve_forever, daemon=True).start()
+
+        self.side_store_path = os.path.join(workdir, "side")
+        env = dict(
+            os.environ,
+            VECTOR_STORE_MODE="http",
+            CHROMA_SERVER_HOST="localhost",
+            CHROMA_SERVER_HTTP_PORT=str(chroma_port),
+            CHROMA_DB_PATH=self.side_store_path,
+            COLLECTION_NAME=COLLECTION_NAME,
+            EMBEDDING_PROVIDER="local",
+            OPENAI_API_KEY="sk-load-test",
+            OPENAI_BASE_URL=f"http://127.0.0.1:{self.llm_server.server_port}/v1",
+            AZURE_OPENAI_ENDPOINT="",
+            AZURE_OPENAI_API_KEY="",
+            PDF_EXTRACT_WORKERS="1",
+            UPLOAD_TMP_DIR=workdir
+        )
+        backend = subprocess.Popen(
+            [sys.executable, "-m", "uvicorn", "main:app", "--port", str(backend_port), "--workers", str(self.workers)],
+            cwd=BACKEND_DIR, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL
+        )
+        self.processes.append(backend)
+        self.base_url = f"http://localhost:{backend_port}"
+        wait_for(f"{self.base_url}/ready", backend)
+        # Every worker has to finish its startup, not just the first one
+        time.sleep(3)
+        self.chroma = chromadb.HttpClient(
+            host="localhost", port=str(chroma_port), settings=Settings(anonymized_telemetry=False)
+        )
+
+    def stop(self):
+        for process in reversed(self.processes):
+            process.terminate()
+            try:
+                process.wait(timeout=20)
+            except subprocess.TimeoutExpired:
+                process.kill()
+        if hasattr(self, "llm_server"):
+            self.llm_server.shutdown()
+
+    def upload(self, client: httpx.Client, filename: str, version: int):
+        content = self.corpus.document(filename, version)
+        response = client.post("/api/files/upload", files={"file": (filename, content, "application/pdf")})
+        if response.status_code != 202:
+            return self.fail(f"upload {filename}: {response.status_code} {response.text}")
+        job_id = response.json()["job_id"]
+        # Each poll may be answered by a different worker than the one running the job
+        deadline = time.time() + 120
+        while time.time() < deadline:
+            job = client.get(f"/api/files/jobs/{job_id}")
+            if job.status_code != 200:
+                return self.fail(f"job {job_id} of {filename}: {job.status_code} {job.text}")
+            if job.json()["status"] in ("completed", "failed"):
+                if job.json()["status"] != "completed":
+                    self.fail(f"job of {filename} failed: {job.json()['error']}")
+                return
+            time.sleep(0.2)
+        self.fail(f"job of {filename} did not finish")
+
+    def update(self, client: httpx.Client, filename: str, version: int):
+        content = self.corpus.document(filename, version)
+        response = client.put(f"/api/files/{filename}", files={"file": (filename, content, "application/pdf")})
+        if response.status_code != 200:
+            self.fail(f"update {filename} to v{version}: {response.status_code} {response.text}")
+
+    def delete(self, client: httpx.Client, filename: str):
+        response = client.delete(f"/api/files/{filename}")
+        if response.status_code != 200:
+            self.fail(f"delete {filename}: {response.status_code} {response.text}")
+
+    def read_loop(self, reader: int, stop: threading.Event) -> int:
+        """Chat against the corpus and list files until told to stop"""
+        requests_made = 0
+        words = None
+        with httpx.Client(base_url=self.base_url, timeout=60) as client:
+            while not stop.is_set():
+                if not words and self.corpus.owner:
+                    words = list(self.corpus.owner)
+                question = " ".join(random.sample(words, 3)) if words else "hello"
+                response = client.post("/api/chat/", json={
+                    "message": question,
+                    "conversation_id": f"reader-{reader}"
+                })
+                if response.status_code != 200:
+                    self.fail(f"chat: {response.status_code} {response.text}")
+                listing = client.get("/api/files/", params={"limit": 1000})
+                if listing.status_code != 200:
+                    self.fail(f"list files: {listing.status_code} {listing.text}")
+                requests_made += 2
+        return requests_made
+
+    def run(self) -> Dict:
+        filenames = [f"doc-{i:03d}.pdf" for i in range(self.file_count)]
+        deleted = set(filenames[:self.file_count // 4])
+        updated = filenames[self.file_count // 4:self.file_count // 2]
+        contested = filenames[-1]
+
+        stop = threading.Event()
+        started = time.time()
+        with ThreadPoolExecutor(max_workers=4) as readers, ThreadPoolExecutor(max_workers=12) as writers:
+            reads = [readers.submit(self.read_loop, i, stop) for i in range(4)]
+            with httpx.Client(base_url=self.base_url, timeout=120) as client:
+                # Phase 1: concurrent uploads
+                list(writers.map(lambda name: self.upload(client, name, 1), filenames))
+                # Phase 2: concurrent deletes and updates, with two conflicting updates of one file
+                tasks = [writers.submit(self.delete, client, name) for name in deleted]
+                tasks += [writers.submit(self.update, client, name, 2) for name in updated]
+                tasks += [writers.submit(self.update, client, contested, version) for version in (2, 3)]
+                for task in tasks:
+                    task.result()
+            stop.set()
+            read_requests = sum(future.result() for future in reads)
+
+        self.verify(set(filenames) - deleted)
+        return {
+            "workers": self.workers,
+            "files": self.file_count,
+            "read_requests": read_requests,
+            "seconds": round(time.time() - started, 1),
+            "failures": self.failures
+        }
+
+    def verify(self, expected: Set[str]):
+        """Check that the collection and every side store agree"""
+        collection = self.chroma.get_collection(COLLECTION_NAME)
+        stored = collection.get(include=["metadatas", "documents", "embeddings"])
+        chunks_by_file: Dict[str, Dict[str, str]] = {}
+        for chunk_id, metadata, document in zip(stored["ids"], stored["metadatas"], stored["documents"]):
+            chunks_by_file.setdefault(metadata.get("filename"), {})[chunk_id] = document
+
+        registry = sqlite3.connect(os.path.join(self.side_store_path, "file_registry.sqlite3"))
+        registered = {
+            filename: set(json.loads(chunk_ids))
+            for filename, chunk_ids in registry.execute("SELECT filename, chunk_ids FROM files")
+        }
+        hidden = registry.execute("SELECT COUNT(*) FROM hidden_chunks").fetchone()[0]
+        registry.close()
+
+        if set(registered) != expected:
+            self.fail(f"registry holds {sorted(registered)}, expected {sorted(expected)}")
+        if set(chunks_by_file) != expected:
+            self.fail(f"collection holds chunks of {sorted(chunks_by_file)}, expected {sorted(expected)}")
+        if hidden:
+            self.fail(f"{hidden} chunks are still hidden")
+
+        for filename in expected:
+            chunks = chunks_by_file.get(filename, {})
+            if set(chunks) != registered.get(filename, set()):
+                self.fail(f"{filename}: registry and collection chunk ids differ")
+            versions = set()
+            for document in chunks.values():
+                versions |= self.corpus.versions_in(document)
+            if len(versions) != 1 or next(iter(versions))[0] != filename:
+                self.fail(f"{filename}: chunks mix content from {sorted(versions)}")
+
+        # Every stored chunk must be reachable through the vector index, as its own nearest neighbour
+        if stored["ids"]:
+            nearest = collection.query(query_embeddings=stored["embeddings"], n_results=1, include=[])
+            unreachable = sum(1 for chunk_id, ids in zip(stored["ids"], nearest["ids"]) if ids[:1] != [chunk_id])
+            if unreachable:
+                self.fail(f"{unreachable} of {len(stored['ids'])} chunks are missing from the vector index")
+
+        keyword_index = sqlite3.connect(os.path.join(self.side_store_path, "keyword_index.sqlite3"))
+        indexed = {row[0] for row in keyword_index.execute("SELECT chunk_id FROM chunk_map")}
+        keyword_index.close()
+        if indexed != set(stored["ids"]):
+            self.fail(f"keyword index has {len(indexed)} chunks, collection has {len(stored['ids'])}")
+
+        for name in os.listdir(self.side_store_path):
+            if name.endswith(".sqlite3"):
+                conn = sqlite3.connect(os.path.join(self.side_store_path, name))
+                result = conn.execute("PRAGMA integrity_check").fetchone()[0]
+                conn.close()
+                if result != "ok":
+                    self.fail(f"{name}: integrity check returned {result}")
+
+def run_load_test(workers: int = 3, files: int = 16) -> Dict:
+    test = LoadTest(workers, files)
+    with tempfile.TemporaryDirectory() as workdir:
+        try:
+            test.start(workdir)
+            return test.run()
+        finally:
+            test.stop()
+
+def test_concurrent_store():
+    result = run_load_test()
+    assert not result["failures"], "\n".join(result["failures"])
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--workers", type=int, default=3)
+    parser.add_argument("--files", type=int, default=16)
+    args = parser.parse_args()
+    result = run_load_test(args.workers, args.files)
+    print(json.dumps(result, indent=2))
+    sys.exit(1 if result["failures"] else 0)
@@ -0,0 +1,65 @@
+"""
+Import-time budget for the backend.
+
+Imports main in fresh interpreters and checks that the best run stays within
+IMPORT_TIME_BUDGET seconds and that none of the heavy modules (Chroma, the OpenAI
+clients, langchain chains, pypdf, tiktoken) were loaded: those belong to the
+background warmup, not to the import path.
+
+Run with pytest, or directly: python test_import_time.py [--runs N] [--budget SECONDS]
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+from typing import Dict
+
+BACKEND_DIR = os.path.dirname(os.path.abspath(__file__))
+IMPORT_TIME_BUDGET = float(os.getenv("IMPORT_TIME_BUDGET", "2.5"))
+HEAVY_MODULES = ["chromadb", "langchain_openai", "langchain.chains", "langchain.memory", "pypdf", "openai", "tiktoken"]
+
+PROBE = """
+import json, sys, time
+started = time.perf_counter()
+import main
+elapsed = time.perf_counter() - started
+print(json.dumps({"seconds": elapsed, "loaded": [name for name in %r if name in sys.modules]}))
+""" % (HEAVY_MODULES,)
+
+def measure_import(runs: int = 3) -> Dict:
+    """Import main in `runs` fresh interpreters; the fastest run and the heavy modules any run loaded"""
+    best = None
+    loaded = set()
+    with tempfile.TemporaryDirectory() as workdir:
+        env = dict(
+            os.environ,
+            CHROMA_DB_PATH=os.path.join(workdir, "chroma_db"),
+            OPENAI_API_KEY=os.getenv("OPENAI_API_KEY", "sk-import-time-test"),
+            PYTHONDONTWRITEBYTECODE="1"
+        )
+        for _ in range(runs):
+            output = subprocess.run(
+                [sys.executable, "-c", PROBE], cwd=BACKEND_DIR, env=env,
+                capture_output=True, text=True, check=True
+            ).stdout
+            result = json.loads(output.strip().splitlines()[-1])
+            best = result["seconds"] if best is None else min(best, result["seconds"])
+            loaded.update(result["loaded"])
+    return {"seconds": best, "budget": IMPORT_TIME_BUDGET, "loaded": sorted(loaded)}
+
+def test_import_time():
+    result = measure_import()
+    assert not result["loaded"], f"heavy modules imported at startup: {', '.join(result['loaded'])}"
+    assert result["seconds"] <= result["budget"], f"importing main took {result['seconds']:.2f}s (budget {result['budget']:g}s)"
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--runs", type=int, default=3)
+    parser.add_argument("--budget", type=float, default=IMPORT_TIME_BUDGET)
+    args = parser.parse_args()
+    IMPORT_TIME_BUDGET = args.budget
+    result = measure_import(args.runs)
+    print(json.dumps(result, indent=2))
+    sys.exit(1 if result["loaded"] or result["seconds"] > result["budget"] else 0)
@@ -0,0 +1,105 @@
+"""
+Keyword fast-path test: only identifier lookups skip the embedding.
+
+Checks which queries count as identifier lookups (acronyms and natural-language
+questions must not), then stores a PDF and checks that a lookup of a rare identifier
+is answered from the keyword index without embedding the query, while lookups with
+no chunk holding every identifier, or whose identifier is in every chunk (a weak
+BM25 score), fall back to hybrid search. The checks run in a fresh interpreter, as
+the app reads its configuration once on import.
+
+Run with pytest, or directly: python test_keyword_lookup.py
+"""
+import os
+import random
+import subprocess
+import sys
+import tempfile
+from typing import List
+from pdf_fixtures import make_pdf
+
+BACKEND_DIR = os.path.dirname(os.path.abspath(__file__))
+LOOKUPS = ["ERR-4021", "section 3.2.1", "error ERR-4021", "A1234", "v2.0", "part 12-B"]
+NOT_LOOKUPS = [
+    "What is HIPAA", "HIPAA", "GPT-4 limits", "USA policy", "what does section 3.2.1 say about refunds",
+    "2024", "termination clause", "How do I fix ERR-4021?"
+]
+
+def check_lookup_classification() -> List[str]:
+    from app.keyword_index import looks_like_lookup
+
+    failures = [f"{query!r} should take the keyword fast path" for query in LOOKUPS if not looks_like_lookup(query)]
+    failures += [f"{query!r} should not take the keyword fast path" for query in NOT_LOOKUPS if looks_like_lookup(query)]
+    return failures
+
+def run_fast_path_test() -> List[str]:
+    from app import vector_store
+    from app.vector_store import add_pdf_to_store, search_similar_documents
+
+    rng = random.Random(15)
+    words = ["".join(rng.choice("abcdefghijklmnopqrstuvwxyz") for _ in range(rng.randint(4, 9))) for _ in range(400)]
+    pages = []
+    for page in range(8):
+        lines = [f"DOC-7 manual page {page} " + " ".join(rng.choice(words) for _ in range(10)) for _ in range(40)]
+        if page == 5:
+            lines[10] = "Fault ERR-4021 means the pump lost pressure " + lines[10]
+        pages.append(lines)
+    add_pdf_to_store(make_pdf(pages), "manual.pdf")
+
+    embedded: List[str] = []
+    embed_query_cached = vector_store.embed_query_cached
+    def counting_embed(query: str):
+        embedded.append(query)
+        return embed_query_cached(query)
+    vector_store.embed_query_cached = counting_embed
+
+    failures: List[str] = []
+    try:
+        hits = search_similar_documents("ERR-4021")
+        if embedded or not hits or "ERR-4021" not in hits[0]["document"]:
+            failures.append("a rare identifier should be answered from the keyword index without embedding the query")
+        for query, reason in [
+            ("ERR-4021 ERR-9999", "no chunk holds every identifier"),
+            ("DOC-7", "the identifier is in every chunk, so its BM25 score is weak"),
+        ]:
+            embedded.clear()
+            search_similar_documents(query)
+            if embedded != [query]:
+                failures.append(f"{query!r} should fall back to hybrid search: {reason}")
+    finally:
+        vector_store.embed_query_cached = embed_query_cached
+    return failures
+
+def run_checks() -> List[str]:
+    """Run both checks in a fresh interpreter against a new store; returns the failures"""
+    with tempfile.TemporaryDirectory() as workdir:
+        env = dict(
+            os.environ,
+            CHROMA_DB_PATH=os.path.join(workdir, "store"),
+            VECTOR_STORE_MODE="embedded",
+            EMBEDDING_PROVIDER="local",
+            OPENAI_API_KEY=os.getenv("OPENAI_API_KEY", "sk-keyword-test"),
+            PYTHONDONTWRITEBYTECODE="1"
+        )
+        result = subprocess.run(
+            [sys.executable, os.path.abspath(__file__), "--in-process"], cwd=BACKEND_DIR, env=env,
+            capture_output=True, text=True
+        )
+    lines = result.stdout.strip().splitlines()
+    if result.returncode not in (0, 1) or not lines:
+        return [f"checks crashed: {result.stderr.strip()[-2000:]}"]
+    return [] if lines[-1] == "ok" else [line for line in lines if line.startswith("FAIL ")]
+
+def test_keyword_fast_path():
+    failures = run_checks()
+    assert not failures, "\n".join(failures)
+
+if __name__ == "__main__":
+    if "--in-process" in sys.argv:
+        sys.path.insert(0, BACKEND_DIR)
+        failures = check_lookup_classification() + run_fast_path_test()
+        print("\n".join(f"FAIL {failure}" for failure in failures) or "ok")
+    else:
+        failures = run_checks()
+        print("\n".join(failures) or "ok")
+    sys.exit(1 if failures else 0)
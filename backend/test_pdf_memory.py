@@ -0,0 +1,105 @@
+"""
+PDF memory test: extracting a PDF from a path never holds the whole file in memory.
+
+Writes two PDFs with the same pages, one padded with large images (PDF_MEMORY_PADDING
+bytes per page), and extracts each from its path in a fresh interpreter, once in
+process and once across the page-extraction pool. The peak memory of the main process
+and of the extraction workers must hardly differ between the two: it may grow with
+the pages, not with the size of the file.
+
+Run with pytest, or directly: python test_pdf_memory.py
+"""
+import json
+import os
+import subprocess
+import sys
+import tempfile
+from typing import Dict, List, Optional
+from pdf_fixtures import write_large_pdf
+
+BACKEND_DIR = os.path.dirname(os.path.abspath(__file__))
+PAGES = 200
+PDF_MEMORY_PADDING = int(os.getenv("PDF_MEMORY_PADDING", "400000"))
+# Most peak memory growth allowed, as a share of the extra file size
+MAX_GROWTH_SHARE = 0.1
+
+def peak_kb(pid="self") -> Optional[int]:
+    """High-water mark of a process's resident memory, in KiB (None where /proc isn't available)"""
+    try:
+        with open(f"/proc/{pid}/status") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1])
+    except OSError:
+        return None
+    return None
+
+def probe(path: str) -> Dict:
+    """Extract every page of `path`; peak memory growth of this process and peak of each worker"""
+    from app import pdf_processor
+
+    before = peak_kb()
+    pages = sum(1 for _ in pdf_processor.iter_pdf_pages(path))
+    after = peak_kb()
+    pool = pdf_processor._process_pool
+    workers = [peak_kb(pid) for pid in pool._processes] if pool is not None else []
+    pdf_processor.shutdown_process_pool()
+    return {
+        "pages": pages,
+        "main_growth_kb": after - before if before is not None and after is not None else None,
+        "worker_peak_kb": max(workers) if workers and None not in workers else None
+    }
+
+def run_probe(path: str, workers: int) -> Dict:
+    env = dict(
+        os.environ,
+        CHROMA_DB_PATH=os.path.join(os.path.dirname(path), "store"),
+        OPENAI_API_KEY=os.getenv("OPENAI_API_KEY", "sk-pdf-memory-test"),
+        PDF_EXTRACT_WORKERS=str(workers),
+        PDF_PARALLEL_MIN_PAGES="1",
+        PDF_PAGES_PER_TASK="10",
+        PYTHONDONTWRITEBYTECODE="1"
+    )
+    output = subprocess.run(
+        [sys.executable, os.path.abspath(__file__), "--probe", path], cwd=BACKEND_DIR, env=env,
+        capture_output=True, text=True, check=True
+    ).stdout
+    return json.loads(output.strip().splitlines()[-1])
+
+def run_memory_test() -> List[str]:
+    failures: List[str] = []
+    with tempfile.TemporaryDirectory() as workdir:
+        small = os.path.join(workdir, "small.pdf")
+        large = os.path.join(workdir, "large.pdf")
+        small_size = write_large_pdf(small, PAGES, 0)
+        large_size = write_large_pdf(large, PAGES, PDF_MEMORY_PADDING)
+        allowed_kb = (large_size - small_size) * MAX_GROWTH_SHARE / 1024
+        for workers, label in [(1, "in process"), (2, "with extraction workers")]:
+            small_result = run_probe(small, workers)
+            large_result = run_probe(large, workers)
+            if large_result["pages"] != PAGES:
+                failures.append(f"{label}: extracted {large_result['pages']} of {PAGES} pages")
+            for key, who in [("main_growth_kb", "the main process"), ("worker_peak_kb", "an extraction worker")]:
+                if small_result[key] is None or large_result[key] is None:
+                    continue
+                extra_kb = large_result[key] - small_result[key]
+                print(f"{label}: {who} peaked {extra_kb / 1024:.1f} MiB higher for a file {(large_size - small_size) / 2**20:.0f} MiB larger")
+                if extra_kb > allowed_kb:
+                    failures.append(
+                        f"{label}: {who} used {extra_kb / 1024:.1f} MiB more for a file {(large_size - small_size) / 2**20:.0f} MiB "
+                        f"larger (allowed {allowed_kb / 1024:.1f} MiB); the PDF is being read into memory"
+                    )
+    return failures
+
+def test_pdf_extraction_memory():
+    failures = run_memory_test()
+    assert not failures, "\n".join(failures)
+
+if __name__ == "__main__":
+    if len(sys.argv) == 3 and sys.argv[1] == "--probe":
+        sys.path.insert(0, BACKEND_DIR)
+        print(json.dumps(probe(sys.argv[2])))
+        sys.exit(0)
+    failures = run_memory_test()
+    print("\n".join(failures) or "ok")
+    sys.exit(1 if failures else 0)
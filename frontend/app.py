@@ -3,12 +3,17 @@ Streamlit Frontend for Sicko Bot - RAG Enabled Chatbot with PDF Management
 """
 import streamlit as st
 import requests
+from requests.adapters import HTTPAdapter
 import json
+import itertools
+import threading
 from typing import List, Dict, Optional
 import time
 
 # Backend API URL
 BACKEND_URL = "http://localhost:8000"
+# Keep-alive connections to the backend, shared by all browser sessions of this server
+HTTP_POOL_SIZE = 20
 
 # Page configuration
 st.set_page_config(
@@ -48,22 +53,49 @@ if "conversation_id" not in st.session_state:
 if "files" not in st.session_state:
     st.session_state.files = []
 
+@st.cache_resource
+def get_http_session():
+    """Pooled HTTP session for all backend calls, so reruns reuse connections instead of opening new ones"""
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=HTTP_POOL_SIZE, pool_maxsize=HTTP_POOL_SIZE)
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
+
+@st.cache_resource
+def get_files_cache():
+    """Last file list seen and its ETag (the backend's corpus version), shared by all browser sessions"""
+    return {"etag": None, "files": [], "lock": threading.Lock()}
+
 def check_backend_connection():
     """Check if backend is running"""
     try:
-        response = requests.get(f"{BACKEND_URL}/health", timeout=2)
+        response = get_http_session().get(f"{BACKEND_URL}/health", timeout=2)
         return response.status_code == 200
     except:
         return False
 
 def get_files_list():
-    """Get list of all PDF files from backend"""
+    """
+    Get list of all PDF files from backend. The request carries the ETag of the
+    cached list, so while the corpus is unchanged the backend answers 304 and
+    the cached list is used.
+    """
+    cache = get_files_cache()
+    with cache["lock"]:
+        etag, files = cache["etag"], cache["files"]
+    headers = {"If-None-Match": etag} if etag else {}
     try:
-        response = requests.get(f"{BACKEND_URL}/api/files/", timeout=5)
+        response = get_http_session().get(f"{BACKEND_URL}/api/files/", params={"limit": 1000}, headers=headers, timeout=5)
+        if response.status_code == 304:
+            return files
         if response.status_code == 200:
             files = response.json()
             # Ensure we return a list
-            return files if isinstance(files, list) else []
+            files = files if isinstance(files, list) else []
+            with cache["lock"]:
+                cache["etag"], cache["files"] = response.headers.get("ETag"), files
+            return files
         return []
     except requests.exceptions.ConnectionError:
         return []
@@ -72,11 +104,11 @@ def get_files_list():
         return []
 
 def upload_pdf(file):
-    """Upload PDF file to backend"""
+    """Upload PDF file to backend (returns the queued ingestion job)"""
     try:
         files = {'file': (file.name, file.getvalue(), 'application/pdf')}
-        response = requests.post(f"{BACKEND_URL}/api/files/upload", files=files, timeout=60)
-        if response.status_code == 200:
+        response = get_http_session().post(f"{BACKEND_URL}/api/files/upload", files=files, timeout=60)
+        if response.status_code in [200, 202]:
             return True, response.json()
         else:
             try:
@@ -91,10 +123,37 @@ def upload_pdf(file):
     except Exception as e:
         return False, f"Upload error: {str(e)}"
 
+def get_job_status(job_id: str):
+    """Get status and progress of an ingestion job"""
+    try:
+        response = get_http_session().get(f"{BACKEND_URL}/api/files/jobs/{job_id}", timeout=5)
+        if response.status_code == 200:
+            return response.json()
+        return None
+    except Exception:
+        return None
+
+def describe_job_progress(job: Dict):
+    """Turn job progress into (fraction done, status text) for a progress bar"""
+    stage = job.get('stage', 'queued')
+    progress = job.get('progress', {})
+    pages_total = progress.get('pages_total') or 0
+    pages = progress.get('pages_extracted', 0)
+    chunks = progress.get('chunks_written', 0)
+    
+    # Pages are extracted, chunked, embedded and stored as one streaming pipeline
+    if stage == 'extracting' and pages_total:
+        return 0.95 * pages / pages_total, f"Processing page {pages}/{pages_total} ({chunks} chunks stored)"
+    if stage == 'finalizing':
+        return 0.95, f"Finalizing {chunks} chunks..."
+    if stage == 'done':
+        return 1.0, "Done"
+    return 0.0, "Waiting to be processed..."
+
 def delete_file(filename: str):
     """Delete PDF file from backend"""
     try:
-        response = requests.delete(f"{BACKEND_URL}/api/files/{filename}", timeout=5)
+        response = get_http_session().delete(f"{BACKEND_URL}/api/files/{filename}", timeout=5)
         if response.status_code == 200:
             return True, response.json()
         else:
@@ -106,7 +165,7 @@ def update_file(filename: str, file):
     """Update PDF file in backend"""
     try:
         files = {'file': (file.name, file.getvalue(), 'application/pdf')}
-        response = requests.put(f"{BACKEND_URL}/api/files/{filename}", files=files, timeout=60)
+        response = get_http_session().put(f"{BACKEND_URL}/api/files/{filename}", files=files, timeout=60)
         if response.status_code == 200:
             return True, response.json()
         else:
@@ -114,26 +173,46 @@ def update_file(filename: str, file):
     except Exception as e:
         return False, str(e)
 
-def send_chat_message(message: str, use_context: bool = True):
-    """Send chat message to backend"""
-    try:
-        payload = {
-            "message": message,
-            "conversation_id": st.session_state.conversation_id,
-            "use_context": use_context
-        }
-        response = requests.post(f"{BACKEND_URL}/api/chat/", json=payload, timeout=30)
-        if response.status_code == 200:
-            return True, response.json()
-        else:
-            return False, response.json().get('detail', 'Chat failed')
-    except Exception as e:
-        return False, str(e)
+def stream_chat_message(message: str, use_context: bool = True):
+    """
+    Send chat message to the streaming endpoint and yield (event, data) pairs
+    as server-sent events arrive.
+    """
+    payload = {
+        "message": message,
+        "conversation_id": st.session_state.conversation_id,
+        "use_context": use_context
+    }
+    # (connect timeout, max wait between streamed chunks)
+    with get_http_session().post(f"{BACKEND_URL}/api/chat/stream", json=payload, stream=True, timeout=(5, 60)) as response:
+        if response.status_code != 200:
+            try:
+                detail = response.json().get('detail', 'Chat failed')
+            except:
+                detail = response.text[:200] if response.text else 'Chat failed'
+            yield "error", {"detail": detail}
+            return
+        
+        event = "message"
+        data_lines = []
+        for line in response.iter_lines(decode_unicode=True):
+            if line is None:
+                continue
+            if line == "":
+                # Blank line terminates an event
+                if data_lines:
+                    yield event, json.loads("\n".join(data_lines))
+                event = "message"
+                data_lines = []
+            elif line.startswith("event:"):
+                event = line[len("event:"):].strip()
+            elif line.startswith("data:"):
+                data_lines.append(line[len("data:"):].strip())
 
 def clear_conversation():
     """Clear conversation history"""
     try:
-        response = requests.delete(f"{BACKEND_URL}/api/chat/conversation/{st.session_state.conversation_id}", timeout=5)
+        response = get_http_session().delete(f"{BACKEND_URL}/api/chat/conversation/{st.session_state.conversation_id}", timeout=5)
         st.session_state.messages = []
         st.session_state.conversation_id = f"conv_{int(time.time())}"
         return response.status_code in [200, 404]  # 404 means conversation doesn't exist, which is fine
@@ -164,34 +243,62 @@ with st.sidebar:
     
     if uploaded_file is not None:
         if st.button("📤 Upload PDF", use_container_width=True):
-            with st.spinner("Uploading and processing PDF..."):
+            with st.spinner("Uploading PDF..."):
                 success, result = upload_pdf(uploaded_file)
-                if success:
-                    filename = result.get('filename', 'File') if isinstance(result, dict) else 'File'
-                    chunks = result.get('chunks_added', 0) if isinstance(result, dict) else 0
+            if success:
+                filename = result.get('filename', 'File') if isinstance(result, dict) else 'File'
+                job_id = result.get('job_id') if isinstance(result, dict) else None
+                
+                if isinstance(result, dict) and not job_id and result.get('duplicate_of'):
+                    # Identical content was already stored, so nothing was queued
+                    st.success(f"✅ {filename}: {result.get('message', 'already stored')}")
+                    if result.get('status') == 'aliased':
+                        st.info(f"🔗 Added as an alias of {result['duplicate_of']}")
+                    st.session_state.uploaded_file = None
+                    time.sleep(0.5)
+                    st.rerun()
+                
+                # Poll the ingestion job until it finishes
+                progress_bar = st.progress(0.0, text="Waiting to be processed...")
+                job = None
+                while job_id:
+                    job = get_job_status(job_id)
+                    if job is None or job.get('status') in ['completed', 'failed']:
+                        break
+                    fraction, status_text = describe_job_progress(job)
+                    progress_bar.progress(min(fraction, 1.0), text=status_text)
+                    time.sleep(1)
+                
+                if job and job.get('status') == 'completed':
+                    progress_bar.progress(1.0, text="Done")
+                    job_result = job.get('result') or {}
+                    chunks = job_result.get('chunks_added', 0)
                     st.success(f"✅ {filename} uploaded successfully!")
-                    st.info(f"📊 {chunks} chunks added to knowledge base")
-                    # Force refresh file list - wait a bit for backend to process
-                    time.sleep(1.5)  # Give backend time to process and index
+                    if job_result.get('duplicate_of'):
+                        st.info(f"🔗 Identical content is already stored as {job_result['duplicate_of']}")
+                    else:
+                        st.info(f"📊 {chunks} chunks added to knowledge base")
                     # Clear the file uploader
                     st.session_state.uploaded_file = None
+                    time.sleep(0.5)
                     st.rerun()
                 else:
-                    error_msg = result if isinstance(result, str) else str(result)
-                    st.error(f"❌ Upload failed: {error_msg}")
-                    st.info("💡 Make sure the backend server is running and the PDF file is valid")
+                    progress_bar.empty()
+                    error_msg = job.get('error') if job else "Lost track of the ingestion job"
+                    st.error(f"❌ Processing failed: {error_msg}")
+            else:
+                error_msg = result if isinstance(result, str) else str(result)
+                st.error(f"❌ Upload failed: {error_msg}")
+                st.info("💡 Make sure the backend server is running and the PDF file is valid")
     
     st.markdown("---")
     
-    # List of files - refresh on every render
+    # List of files - revalidated on every render (a 304 while nothing has changed)
     st.subheader("📋 Uploaded Files")
-    # Always fetch fresh list from backend
-    current_files = get_files_list()
-    st.session_state.files = current_files
+    st.session_state.files = get_files_list()
     
     # Show refresh button
     if st.button("🔄 Refresh List", key="refresh_files", use_container_width=True):
-        st.session_state.files = get_files_list()
         st.rerun()
     
     if st.session_state.files:
@@ -203,7 +310,10 @@ with st.sidebar:
                 col1, col2 = st.columns([3, 1])
                 with col1:
                     st.markdown(f"**{filename}**")
-                    st.caption(f"{chunk_count} chunks")
+                    if file_info.get('alias_of'):
+                        st.caption(f"{chunk_count} chunks · same as {file_info['alias_of']}")
+                    else:
+                        st.caption(f"{chunk_count} chunks")
                 
                 with col2:
                     if st.button("🗑️", key=f"delete_{filename}", help="Delete file"):
@@ -211,7 +321,6 @@ with st.sidebar:
                             success, result = delete_file(filename)
                             if success:
                                 st.success(f"✅ {filename} deleted")
-                                st.session_state.files = get_files_list()
                                 time.sleep(0.5)
                                 st.rerun()
                             else:
@@ -242,8 +351,11 @@ with st.sidebar:
                 success, result = update_file(file_to_update, update_file_upload)
                 if success:
                     st.success(f"✅ {file_to_update} updated successfully!")
-                    st.info(f"📊 {result.get('chunks_added', 0)} chunks added")
-                    st.session_state.files = get_files_list()
+                    st.info(
+                        f"📊 {result.get('chunks_added', 0)} chunks added, "
+                        f"{result.get('chunks_unchanged', 0)} unchanged, "
+                        f"{result.get('chunks_removed', 0)} removed"
+                    )
                     time.sleep(0.5)
                     st.rerun()
                 else:
@@ -296,54 +408,75 @@ if prompt := st.chat_input("Ask me anything about your documents..."):
     
     # Get response from backend
     with st.chat_message("assistant"):
-        with st.spinner("Thinking..."):
-            # Always check current file list to determine if context should be used
-            current_files = get_files_list()
-            use_context = len(current_files) > 0  # Use context if files are available
-            if use_context:
-                st.info(f"🔍 Searching through {len(current_files)} document(s)...")
-            success, response = send_chat_message(prompt, use_context=use_context)
+        # The sidebar revalidated the file list earlier in this run
+        current_files = st.session_state.files
+        use_context = len(current_files) > 0  # Use context if files are available
+        if use_context:
+            st.info(f"🔍 Searching through {len(current_files)} document(s)...")
+        
+        response_placeholder = st.empty()
+        response_text = ""
+        citations = []
+        error = None
+        
+        try:
+            with st.spinner("Thinking..."):
+                events = stream_chat_message(prompt, use_context=use_context)
+                # Keep the spinner up until the first event (citations) arrives
+                first_event = next(events, None)
             
-            if success:
-                response_text = response.get('response', '')
-                citations = response.get('citations', [])
-                
-                # Display response
-                st.markdown(response_text)
-                
-                # Display citations
-                if citations:
-                    st.markdown("### 📚 Sources")
-                    for i, citation in enumerate(citations, 1):
-                        # Format relevance score properly
-                        relevance_score = citation.get('relevance_score')
-                        if relevance_score is not None:
-                            relevance_str = f"{relevance_score:.2f}"
-                        else:
-                            relevance_str = "N/A"
-                        
-                        st.markdown(f"""
-                        <div class="citation">
-                            <strong>Source {i}:</strong> {citation.get('source', 'Unknown')}<br>
-                            <em>Relevance Score: {relevance_str}</em>
-                        </div>
-                        """, unsafe_allow_html=True)
-                        with st.expander(f"View content from {citation.get('source', 'Unknown')}"):
-                            st.text(citation.get('content', ''))
-                
-                # Add assistant message to chat
-                st.session_state.messages.append({
-                    "role": "assistant",
-                    "content": response_text,
-                    "citations": citations
-                })
-            else:
-                error_msg = f"❌ Error: {response}"
-                st.error(error_msg)
-                st.session_state.messages.append({
-                    "role": "assistant",
-                    "content": error_msg
-                })
+            if first_event is not None:
+                for event, data in itertools.chain([first_event], events):
+                    if event == "citations":
+                        citations = data.get('citations', [])
+                    elif event == "token":
+                        response_text += data.get('token', '')
+                        response_placeholder.markdown(response_text + "▌")
+                    elif event == "done":
+                        response_text = data.get('response', response_text)
+                    elif event == "error":
+                        error = data.get('detail', 'Chat failed')
+                        break
+        except Exception as e:
+            error = str(e)
+        
+        if error is None:
+            # Display response
+            response_placeholder.markdown(response_text)
+            
+            # Display citations
+            if citations:
+                st.markdown("### 📚 Sources")
+                for i, citation in enumerate(citations, 1):
+                    # Format relevance score properly
+                    relevance_score = citation.get('relevance_score')
+                    if relevance_score is not None:
+                        relevance_str = f"{relevance_score:.2f}"
+                    else:
+                        relevance_str = "N/A"
+                    
+                    st.markdown(f"""
+                    <div class="citation">
+                        <strong>Source {i}:</strong> {citation.get('source', 'Unknown')}<br>
+                        <em>Relevance Score: {relevance_str}</em>
+                    </div>
+                    """, unsafe_allow_html=True)
+                    with st.expander(f"View content from {citation.get('source', 'Unknown')}"):
+                        st.text(citation.get('content', ''))
+            
+            # Add assistant message to chat
+            st.session_state.messages.append({
+                "role": "assistant",
+                "content": response_text,
+                "citations": citations
+            })
+        else:
+            error_msg = f"❌ Error: {error}"
+            response_placeholder.error(error_msg)
+            st.session_state.messages.append({
+                "role": "assistant",
+                "content": error_msg
+            })
 
 # Footer
 st.markdown("---")